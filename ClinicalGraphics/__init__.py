@@ -7,16 +7,53 @@ if backend == 'qt4':
     os.environ['ETS_TOOLKIT'] = 'qt4'
 
 
-def run(datapath = None, metadatapath = None):
-
+def run(datapath = None, metadatapath = None, batched = False, timings = None, vocabulary = None, journaled = False):
+    """
+    Open the annotation editor
+    datapath is a DICOM file, or a directory or list of DICOM files to use as a worklist
+    If timings is given, the hot paths of the editor are instrumented, and their timings
+    shown on the plot and written to the JSON file timings every ten seconds
+    vocabulary is the label vocabulary of the project, or the directory holding it;
+    it is created if it does not exist, and saved along with the annotations
+    If journaled, every edit is appended to a journal next to the sidecar file as it is made,
+    and compacted into the sidecar in the background; see DataModel
+    """
 
     from .gui import Main, filedialog
     from .datamodels import DataModel
+    from .worklist import Worklist
+    from .vocabulary import Vocabulary
+    from . import instrument
+
+    if timings is not None:
+        instrument.enable(timings)
 
     if datapath is None:
         datapath = r'c:\docs\001'
 ##        datapath = filedialog()
         print datapath
-    datamodel = DataModel(datapath, metadatapath)
-    main = Main(datamodel)
+    if vocabulary is not None:
+        vocabulary = Vocabulary.load(vocabulary)
+    if isinstance(datapath, list) or os.path.isdir(datapath):
+        worklist = Worklist(datapath, journaled=journaled, vocabulary=vocabulary)
+        datamodel = worklist.current
+    else:
+        worklist = None
+        datamodel = DataModel(datapath, metadatapath, journaled=journaled, vocabulary=vocabulary)
+    main = Main(datamodel, batched, worklist, timings is not None)
     main.configure_traits()
+    if timings is not None:
+        instrument.disable()
+
+
+def browse(root, index = None, journaled = False):
+    """
+    Open the study browser on an archive
+    The index of the archive is created, or updated, first; by default it is stored in root
+    If journaled, the studies opened from it journal their edits, as in run
+    """
+
+    from .gui import Browser
+    from .index import Index
+
+    Browser(Index(root, index), journaled).configure_traits()
@@ -0,0 +1,194 @@
+"""
+Headless batch export of annotations
+
+Walks a directory tree for DICOM files with sidecar .json or binary .cgs annotation files,
+and writes all annotations to a single CSV, JSONL or Parquet file.
+Files are processed in a process pool, and results are written as they arrive.
+Only DICOM headers are read; pixel data is never touched.
+
+Usage:
+    python -m clinicalgraphics.batch <root> <output> [--format csv|jsonl|parquet] [--processes N]
+"""
+
+import os
+import sys
+import csv
+import json
+import argparse
+import multiprocessing
+
+from .datamodels import DataModel, TYPES
+from .sidecar import EXTENSIONS
+from .pixels import DICOM_EXTENSIONS, is_dicom, walk
+
+
+#columns of the export; one row per annotation
+HEADER_COLUMNS = ['sidecar', 'dicom', 'sop_instance_uid', 'rows', 'columns']
+COLUMNS = HEADER_COLUMNS + ['type', 'label', 'frame'] + \
+    sorted(set(f for cls in TYPES for f in cls.fields + cls.attributes))
+
+
+def find(root):
+    """
+    Yield (datapath, metadatapath) pairs for all sidecar files below root
+    datapath is None if no matching DICOM file is present
+    If a file has sidecar files in both formats, only the JSON one is used, as when editing
+    Hidden files and directories, such as the project vocabulary, are skipped
+    """
+    for dirpath, filenames in walk(root):
+        names = set(filenames)
+        #the DICOM file of each stem, with the most preferred extension
+        dicoms = {}
+        for name in filenames:
+            if is_dicom(name):
+                stem, ext = os.path.splitext(name)
+                dicoms.setdefault(stem, []).append((DICOM_EXTENSIONS.index(ext.lower()), name))
+        for name in filenames:
+            stem, ext = os.path.splitext(name)
+            if ext.lower() not in EXTENSIONS or \
+                    any(stem + e in names for e in EXTENSIONS[:EXTENSIONS.index(ext.lower())]):
+                continue
+            datapath = os.path.join(dirpath, min(dicoms[stem])[1]) if stem in dicoms else None
+            yield datapath, os.path.join(dirpath, name)
+
+
+def export_file(paths):
+    """
+    Load a single DICOM header and sidecar, and return its annotations as export rows
+    Returns a (rows, error) tuple; failures are reported rather than raised
+    """
+    datapath, metadatapath = paths
+    try:
+        datamodel = DataModel(datapath, metadatapath)
+        header = {'sidecar': metadatapath, 'dicom': datapath}
+        if datamodel.header is not None:
+            h = datamodel.header
+            header.update(
+                sop_instance_uid = getattr(h, 'SOPInstanceUID', None),
+                rows = int(h.Rows),
+                columns = int(h.Columns))
+        rows = []
+        for record in datamodel._annotations.to_json():
+            record.setdefault('frame', 0)
+            record.update(header)
+            rows.append(record)
+        return rows, None
+    except Exception as e:
+        return [], '{0}: {1}'.format(metadatapath, e)
+
+
+class CSVWriter(object):
+    def __init__(self, path):
+        self.fh = open(path, 'wb')
+        self.writer = csv.DictWriter(self.fh, COLUMNS, extrasaction='ignore')
+        self.writer.writeheader()
+
+    def write(self, rows):
+        for r in rows:
+            self.writer.writerow(dict(
+                (k, v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in r.items()))
+
+    def close(self):
+        self.fh.close()
+
+
+class JSONLWriter(object):
+    def __init__(self, path):
+        self.fh = open(path, 'w')
+
+    def write(self, rows):
+        for r in rows:
+            self.fh.write(json.dumps(r, sort_keys=True))
+            self.fh.write('\n')
+
+    def close(self):
+        self.fh.close()
+
+
+class ParquetWriter(object):
+    """
+    Columnar export; requires pyarrow
+    Rows are buffered and written as row groups
+    """
+
+    group_size = 65536
+
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise Exception('Parquet export requires pyarrow; pip install pyarrow')
+        self.pa = pyarrow
+        self.path = path
+        self.writer = None
+        self.rows = []
+
+    def write(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.group_size:
+            self._flush()
+
+    def _flush(self):
+        if not self.rows:
+            return
+        columns = dict((c, [r.get(c) for r in self.rows]) for c in COLUMNS)
+        table = self.pa.Table.from_arrays(
+            [self.pa.array(columns[c]) for c in COLUMNS], COLUMNS)
+        if self.writer is None:
+            self.writer = self.pa.parquet.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        self._flush()
+        if self.writer is not None:
+            self.writer.close()
+
+
+WRITERS = {
+    'csv':      CSVWriter,
+    'jsonl':    JSONLWriter,
+    'parquet':  ParquetWriter,
+}
+
+
+def export(root, output, format = 'csv', processes = None, chunksize = 64):
+    """
+    Export all annotations below root to output
+    Returns the number of files processed, annotations written and a list of errors
+    """
+    writer = WRITERS[format](output)
+    pool = multiprocessing.Pool(processes)
+    files, annotations, errors = 0, 0, []
+    try:
+        for rows, error in pool.imap_unordered(export_file, find(root), chunksize):
+            files += 1
+            if error:
+                errors.append(error)
+            writer.write(rows)
+            annotations += len(rows)
+    finally:
+        pool.close()
+        pool.join()
+        writer.close()
+    return files, annotations, errors
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Export DICOM annotations in bulk')
+    parser.add_argument('root', help='directory to scan for sidecar files')
+    parser.add_argument('output', help='file to write the export to')
+    parser.add_argument('--format', choices=sorted(WRITERS), default='csv')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    files, annotations, errors = export(args.root, args.output, args.format, args.processes)
+    for e in errors:
+        sys.stderr.write(e + '\n')
+    sys.stdout.write('{0} annotations from {1} files, {2} errors\n'.format(annotations, files, len(errors)))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
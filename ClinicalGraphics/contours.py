@@ -0,0 +1,131 @@
+"""
+Geometry of contour annotations
+Simplification of drawn strokes, vectorized hit-testing against many polygons,
+and the compact encoding of vertex arrays in sidecar files
+"""
+
+import base64
+import binascii
+
+import numpy as np
+
+
+def simplify(points, tolerance):
+    """
+    Simplify a polyline with the Douglas-Peucker algorithm
+    Returns the subset of the points, including both end points, such that
+    no point is further than tolerance from the simplified polyline
+    """
+    points = np.asarray(points, np.float64).reshape(-1, 2)
+    n = len(points)
+    if n < 3:
+        return points.astype(np.int32)
+    keep = np.zeros(n, np.bool_)
+    keep[[0, -1]] = True
+    stack = [(0, n - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        a, b = points[i], points[j]
+        d = b - a
+        inner = points[i+1:j] - a
+        length = np.hypot(*d)
+        if length:
+            distance = np.abs(inner[:, 0] * d[1] - inner[:, 1] * d[0]) / length
+        else:
+            distance = np.hypot(inner[:, 0], inner[:, 1])
+        k = int(np.argmax(distance))
+        if distance[k] > tolerance:
+            k += i + 1
+            keep[k] = True
+            stack.extend([(i, k), (k, j)])
+    return points[keep].astype(np.int32)
+
+
+def distance(polygons, p):
+    """
+    Test the position p against a list of closed polygons, vectorized over all their edges
+    Returns a boolean array, whether p lies inside each polygon,
+    and an array of the distances of p to the nearest edge of each polygon
+    """
+    p = np.asarray(p, np.float64)
+    starts = np.cumsum([0] + [len(v) for v in polygons[:-1]])
+    a = np.concatenate(polygons).astype(np.float64)
+    b = np.concatenate([np.roll(v, -1, axis=0) for v in polygons]).astype(np.float64)
+    d = b - a
+
+    #crossing number of a ray from p along the first axis
+    straddle = (a[:, 1] > p[1]) != (b[:, 1] > p[1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = a[:, 0] + (p[1] - a[:, 1]) * d[:, 0] / d[:, 1]
+    crossings = (straddle & (p[0] < x)).astype(np.int64)
+    inside = np.add.reduceat(crossings, starts) % 2 == 1
+
+    #distance to the nearest point on each edge
+    t = np.clip(((p - a) * d).sum(axis=1) / np.maximum((d * d).sum(axis=1), 1e-12), 0, 1)
+    nearest = a + t[:, None] * d - p
+    edge = np.minimum.reduceat(np.hypot(nearest[:, 0], nearest[:, 1]), starts)
+    return inside, edge
+
+
+#vertex arrays are encoded as a type code, followed by the base64 encoded bytes
+#of the first vertex as int32, and the deltas between subsequent vertices,
+#in the smallest of these little endian integer types that holds all of them;
+#vertices are int32, so that their deltas always fit in int64
+TYPECODES = 'bhiq'
+INT32 = np.iinfo(np.int32)
+
+
+def _check_range(vertices):
+    """Raise ValueError unless all vertices fit in int32"""
+    if len(vertices) and (vertices.min() < INT32.min or vertices.max() > INT32.max):
+        raise ValueError('Vertices out of range')
+
+
+def encode(vertices):
+    """
+    Encode an (n, 2) array of integer vertices as a compact string
+    Raises ValueError if the vertices do not fit in int32
+    """
+    vertices = np.asarray(vertices, np.int64).reshape(-1, 2)
+    _check_range(vertices)
+    deltas = np.diff(vertices, axis=0)
+    for code in TYPECODES:
+        info = np.iinfo(np.dtype(code))
+        if not len(deltas) or (deltas.min() >= info.min and deltas.max() <= info.max):
+            break
+    data = vertices[:1].astype('<i4').tostring() + deltas.astype('<' + code).tostring()
+    return code + base64.b64encode(data)
+
+
+def decode(value):
+    """
+    Decode vertices, either encoded as a string, or given as a sequence of pairs
+    Returns an (n, 2) int32 array; raises ValueError if the value is not valid,
+    or if its vertices are not integers within the int32 range, rather than truncating them
+    """
+    if not isinstance(value, basestring):
+        try:
+            vertices = np.array(value, np.float64)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid vertices')
+        if vertices.ndim != 2 or vertices.shape[1] != 2 or not (vertices == np.round(vertices)).all():
+            raise ValueError('Invalid vertices')
+        _check_range(vertices)
+        return vertices.astype(np.int32)
+    try:
+        code = value[0]
+        if code not in TYPECODES:
+            raise ValueError
+        data = base64.b64decode(value[1:])
+        first = np.frombuffer(data[:8], '<i4')
+        deltas = np.frombuffer(data[8:], '<' + code)
+    except (IndexError, TypeError, ValueError, binascii.Error):
+        raise ValueError('Invalid vertices')
+    if len(first) != 2 or len(deltas) % 2:
+        raise ValueError('Invalid vertices')
+    steps = np.concatenate([first, deltas]).astype(np.int64).reshape(-1, 2)
+    vertices = np.cumsum(steps, axis=0)
+    _check_range(vertices)
+    return vertices.astype(np.int32)
@@ -8,10 +8,22 @@ and exposes various methods for manipulation by a view
 
 import os
 import json
-import dicom
+import threading
+from decimal import Decimal
+from collections import OrderedDict
+import numpy as np
 
 
-from traits.api import HasTraits, Bool, Event, Instance, Int
+import contours
+from traits.api import HasTraits, Bool, Event, Instance, Int, Property
+
+from store import AnnotationStore, LabelTable, Table, ContourTable, InvalidAnnotation, Selection
+from pixels import PixelData, read_header
+from journal import Journal, Compactor, atomic_write, digest, read as read_journal
+from loader import HashingReader, iter_records, DECODE_ERRORS, CHUNKSIZE
+from instrument import timed
+import sidecar
+from history import History
 
 
 class DataModel(HasTraits):
@@ -25,64 +37,267 @@ class DataModel(HasTraits):
 
     _annotations = []
     selected = None
-
-    def __init__(self, datapath, metadatapath = None):
+    header = None
+    pixels = None
+    journal = None
+    history = None
+    vocabulary = None
+
+    updated = Event()   #fired on any change to the annotations or the selection
+    rebuilt = Event()   #fired after bulk edits, which do not notify the individual annotations
+    modified = Bool(False)  #whether there are edits not yet saved
+    frame = Int(0)      #index of the frame being viewed and annotated
+
+    def __init__(self, datapath, metadatapath = None, journaled = False, vocabulary = None):
         """
         Bind the datamodel to a DICOM file
         If a seperate metadatapath is given, this is where annotations will be read and written
-        If none is given, the DICOM file path with a .json extension is used
+        If none is given, the DICOM file path with a .cgs extension is used if that file exists,
+        and with a .json extension otherwise; the format is detected when reading,
+        and metadata is written in the binary format to paths with a .cgs extension
+        If journaled, every edit is appended to a journal next to the metadata file,
+        which is compacted into the metadata file in the background
+        If a vocabulary is given, labels are interned in it, and have the same ids in all
+        datamodels sharing it; labels not yet in the vocabulary are added to it
         """
         self.datapath = datapath
-        self.metadatapath = os.path.splitext(datapath)[0]+'.json' if metadatapath == None else metadatapath
+        self.metadatapath = sidecar.sidecar_path(datapath) if metadatapath == None else metadatapath
+        self.journaled = journaled
+        self.vocabulary = vocabulary
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
 
         if not self.datapath is None:
             self.load_data()
         self.load_metadata()
 
+        if journaled:
+            self._compactor = Compactor(self)
+            self._compactor.start()
+
 ##        self.selected = None
 
 
+    @timed('load_data')
     def load_data(self):
         """
-        Load the DICOM file
+        Load the DICOM header
+        Pixel data is only mapped or decoded once data is accessed
         """
-        fh = dicom.read_file(self.datapath)
-        self.data = fh.pixel_array
+        self.header, offset = read_header(self.datapath)
+        self.pixels = PixelData(self.datapath, self.header, offset)
+
+    @property
+    def data(self):
+        """The current frame of the DICOM image as an array"""
+        return self.pixels.frame(self.frame)
 
+    @property
+    def frames(self):
+        """The number of frames of the DICOM image"""
+        return self.pixels.frames
+
+    @timed('load_metadata')
     def load_metadata(self):
-        """Load the metadata, if present"""
+        """
+        Load the metadata, if present, and replay any journaled edits on top of it
+        Records are streamed from the file, and inserted into the store in chunks
+        This starts a new undo history
+        """
+        self._annotations = AnnotationStore(TYPES, self.vocabulary)
+        self.history = History()
+        if sidecar.is_binary(self.metadatapath):
+            base = self._load_binary()
+        else:
+            base = self._load_json()
+
+        if self.journaled:
+            self._replay(base)
+
+    def _load_json(self):
+        """
+        Stream annotations from a JSON metadata file; returns the digest of the file
+        An empty file loads as empty; a file which cannot be decoded, or breaks off after its
+        first records, raises InvalidAnnotation, so that its records are not lost on the next save
+        """
         try:
-            metadata = json.load(open( self.metadatapath))
-        except:
-            metadata = []
-        self._annotations = [self.parse_annotation(m) for m in metadata]
+            fh = open(self.metadatapath, 'rb')
+        except IOError:
+            return None
+        with fh:
+            reader = HashingReader(fh)
+            chunk, loaded = [], 0
+            try:
+                for attrs in iter_records(reader):
+                    chunk.append(attrs)
+                    if len(chunk) == CHUNKSIZE:
+                        self._annotations.load(chunk)
+                        loaded, chunk = loaded + len(chunk), []
+            except DECODE_ERRORS:
+                fh.seek(0)
+                text = fh.read()
+                if loaded or chunk or text.strip():
+                    raise InvalidAnnotation('Metadata file cannot be decoded after {0} records'.format(
+                        loaded + len(chunk)), 'corrupt', index=loaded + len(chunk))
+                return digest(text)
+            self._annotations.load(chunk)
+            return reader.digest
+
+    def _load_binary(self):
+        """
+        Load annotations from a binary metadata file; returns the digest of the file
+        A corrupt file raises InvalidAnnotation, as for JSON metadata files
+        """
+        sidecar.load(self._annotations, self.metadatapath)
+        with open(self.metadatapath, 'rb') as fh:
+            return digest(fh.read())
+
+    def _serialize(self):
+        """The contents of the metadata file, in the format given by its extension"""
+        if os.path.splitext(self.metadatapath)[1].lower() == sidecar.EXTENSION:
+            return sidecar.dumps(self._annotations)
+        return json.dumps(self._annotations.to_json(), indent=4)
+
+    def _replay(self, base):
+        """
+        Apply the journals written on top of the metadata file with the given digest,
+        and open the journal for appending
+        Journals written on top of other versions of the metadata file are discarded
+        """
+        path = self.metadatapath + '.journal'
+        old_base, old = read_journal(path + '.old')
+        new_base, new = read_journal(path)
+
+        if old is not None and old_base == base:
+            #interrupted compaction; the new journal continues on the renumbered state
+            for record in old:
+                self._apply(record)
+            self._annotations.renumber()
+            for record in new or []:
+                self._apply(record)
+            #complete the compaction before discarding either journal
+            self._annotations.renumber()
+            text = self._serialize()
+            atomic_write(self.metadatapath, text)
+            base, new = digest(text), None
+        elif new is not None and new_base == base:
+            for record in new:
+                self._apply(record)
+
+        if new is None or new_base != base:
+            if os.path.exists(path):
+                os.remove(path)
+        self.journal = Journal(path, base)
+        self.journal.discard_old()
+
+    def _apply(self, record):
+        """
+        Apply a journal record to the annotations
+        """
+        store = self._annotations
+        op = record['op']
+        if op == 'add':
+            store.append(self.parse_annotation(record['attrs']), record['id'])
+            return
+        if op == 'update':
+            for id, attrs in zip(record['ids'], record['records']):
+                annotation = store.find(id)
+                annotation.assign(attrs)
+                annotation.label = attrs['label']
+                annotation.frame = attrs.get('frame', 0)
+            return
+        if op == 'remove':
+            for id in record['ids']:
+                store.remove(store.find(id))
+            return
+        annotation = store.find(record['id'])
+        if op == 'move':
+            annotation.move(record['delta'])
+        elif op == 'relabel':
+            annotation.label = record['label']
+        elif op == 'delete':
+            store.remove(annotation)
+
+    def _log(self, op, annotation, **attrs):
+        """
+        Record an edit, and append it to the journal, if any
+        """
+        self.modified = True
+        if self.journal is not None:
+            attrs.update(op=op, id=self._annotations.seq(annotation))
+            self.journal.append(attrs)
 
+    def _log_rows(self, snapshot):
+        """
+        Record a bulk edit of the rows of a snapshot, taken before the edit,
+        and append it to the journal, if any, as one update and one remove record,
+        and an add record for each restored annotation
+        """
+        self.modified = True
+        if self.journal is None:
+            return
+        for table, rows, saved in snapshot:
+            data = table._data[rows]
+            was, now = ~saved['removed'], ~data['removed']
+            if (was & ~now).any():
+                self.journal.append({'op': 'remove', 'ids': saved['seq'][was & ~now].tolist()})
+            if (was & now).any():
+                self.journal.append({'op': 'update', 'ids': data['seq'][was & now].tolist(),
+                                     'records': table.to_json(data[was & now])})
+            for seq, attrs in zip(data['seq'][~was & now].tolist(), table.to_json(data[~was & now])):
+                self.journal.append({'op': 'add', 'id': seq, 'attrs': attrs})
 
     def parse_annotation(self, attrs):
         """
         Try and construct a valid annotation from an attr dict
+        Raises InvalidAnnotation, with the kind of problem as its code, if the record is not valid
         """
         try:
-            cls = eval(attrs['type'])
-        except:
-            raise Exception('Invalid annotation type')
-        try:
-            a = cls(**attrs)
-        except:
-            raise Exception('Invalid attributes {0}'.format(str(attrs)))
-        return a
+            cls = REGISTRY[attrs['type']]
+        except (KeyError, TypeError):
+            raise InvalidAnnotation('Invalid annotation type', 'type', attrs)
+        cls.validate(attrs)
+        return cls(**attrs)
 
+    @timed('save')
     def save(self):
         """
         Write the metadata to disk
+        The file is replaced atomically; in journaled mode, this compacts the journal
         """
-        metadata = [a.to_json() for a in self._annotations]
-        json.dump(metadata, open(self.metadatapath, 'w'), indent=4)
+        if self.journaled:
+            self.compact()
+        else:
+            atomic_write(self.metadatapath, self._serialize())
+        self.modified = False
+
+    def compact(self):
+        """
+        Write all annotations to the metadata file, and start a fresh journal on top of it
+        Edits are only blocked while the annotations are serialized, not while they are written
+        """
+        with self._compact_lock:
+            with self._lock:
+                self._annotations.renumber()
+                text = self._serialize()
+                self.journal.rotate(digest(text))
+            atomic_write(self.metadatapath, text)
+            self.journal.discard_old()
+
+    def close(self):
+        """
+        Stop background compaction, and sync the journal to disk
+        Closing a datamodel more than once has no further effect
+        """
+        if self.journaled and self._compactor is not None:
+            self._compactor.stop()
+            self._compactor = None
+            self.journal.close()
 
     @property
     def shape(self):
-        """The shape of the DICOM image"""
-        return self.data.shape
+        """The shape of a single frame of the DICOM image, as read from its header"""
+        return self.pixels.frame_shape
 
     @property
     def annotations(self):
@@ -93,56 +308,341 @@ class DataModel(HasTraits):
         """
         Add an annotation to the datamodel
         """
-        self._annotations.append(annotation)
+        with self._lock:
+            self._annotations.append(annotation)
+            self._log('add', annotation, attrs=annotation.to_json())
+            self.history.record('add', annotation)
+        self.updated = True
 
     def delete_selected(self):
         """
         Delete the annotation currently set as the selected annotation on the datamodel
         """
         if not self.selected is None:
-            self._annotations.remove(self.selected)
-            self.selected.removed = True
+            with self._lock:
+                self._log('delete', self.selected)
+                self._annotations.remove(self.selected)
+                self.history.record('delete', self.selected)
+            self.selected = None
+            self.updated = True
+
+    def move(self, annotation, delta, merge = False):
+        """
+        Translate an annotation by a given amount
+        If merge is set, consecutive moves of the same annotation are undone as one,
+        as for the steps of a single drag
+        """
+        with self._lock:
+            annotation.move(delta)
+            self._log('move', annotation, delta=list(delta))
+            self.history.record_move(annotation, delta, merge)
+        self.updated = True
+
+    def relabel(self, annotation, label):
+        """
+        Change the label of an annotation
+        """
+        with self._lock:
+            old = annotation.label
+            annotation.label = label
+            self._log('relabel', annotation, label=label)
+            self.history.record('relabel', annotation, old, label)
+        annotation.changed += 1
+        self.updated = True
+
+    def undo(self):
+        """
+        Revert the last edit
+        Returns whether there was an edit to undo
+        """
+        with self._lock:
+            entry = self.history.pop_undo()
+            if entry is not None:
+                self._replay_entry(entry, True)
+        if entry is not None:
+            if entry[0] == 'rows':
+                self.rebuilt = True
+            self.updated = True
+        return entry is not None
+
+    def redo(self):
+        """
+        Repeat the last undone edit
+        Returns whether there was an edit to redo
+        """
+        with self._lock:
+            entry = self.history.pop_redo()
+            if entry is not None:
+                self._replay_entry(entry, False)
+        if entry is not None:
+            if entry[0] == 'rows':
+                self.rebuilt = True
+            self.updated = True
+        return entry is not None
+
+    def _replay_entry(self, entry, undo):
+        """
+        Apply a history entry, or its inverse if undo is set; the change is journaled as any edit
+        Bulk edits are recorded as a snapshot of the rows before the edit, which is swapped
+        with the current rows both to undo and to redo
+        """
+        op, annotation = entry[:2]
+        store = self._annotations
+        if op == 'rows':
+            snapshot = store.swap(entry[1][0])
+            entry[1][0] = snapshot
+            self._log_rows(snapshot)
+            self._deselect_removed()
+        elif op in ('add', 'delete'):
+            if (op == 'add') == undo:
+                if annotation is self.selected:
+                    annotation.selected = False
+                    self.selected = None
+                self._log('delete', annotation)
+                store.remove(annotation)
+            else:
+                store.restore(annotation)
+                self._log('add', annotation, attrs=annotation.to_json())
+        elif op == 'move':
+            delta = [-d for d in entry[2]] if undo else list(entry[2])
+            annotation.move(delta)
+            self._log('move', annotation, delta=delta)
+        elif op == 'relabel':
+            label = entry[2] if undo else entry[3]
+            annotation.label = label
+            self._log('relabel', annotation, label=label)
+            annotation.changed += 1
+
+    def query(self, label = None, bbox = None, frame = None):
+        """
+        Return a Selection of the annotations matching all of the given criteria
+        label is a label or a collection of labels, bbox an (l0, h0, l1, h1) box
+        intersecting the annotations, and frame a frame index
+        """
+        return self._annotations.query(label, bbox, frame)
+
+    def selection(self, mask = None):
+        """
+        Return a Selection of all annotations, or of those where a boolean mask is set;
+        the mask has one element per annotation, in order of insertion
+        """
+        if isinstance(mask, Selection):
+            return mask
+        return self._annotations.selection(mask)
+
+    def _bulk(self, selection, edit):
+        """
+        Apply a bulk edit to a selection, or to all annotations if it is None, as a single undoable edit
+        Individual annotations are not notified; views are rebuilt once, by the rebuilt event
+        """
+        with self._lock:
+            selection = self.selection(selection)
+            snapshot = self._annotations.snapshot(selection)
+            for table, rows in selection.items():
+                if len(rows):
+                    edit(table, rows)
+            self._annotations._order = None
+            self.history.record('rows', [snapshot])
+            self._log_rows(snapshot)
+            self._deselect_removed()
+        self.rebuilt = True
+        self.updated = True
+        return len(selection)
+
+    def _deselect_removed(self):
+        if self.selected is not None and self.selected.removed:
+            self.selected.selected = False
             self.selected = None
 
+    def translate(self, delta, selection = None):
+        """
+        Translate the selected annotations by delta
+        Returns the number of annotations edited
+        """
+        return self._bulk(selection, lambda table, rows: table.translate(rows, delta))
+
+    def scale(self, factor, origin = (0, 0), selection = None):
+        """
+        Scale the selected annotations relative to origin, by a positive factor or (factor0, factor1)
+        Returns the number of annotations edited
+        """
+        if isinstance(factor, NUMBER):
+            factor = factor, factor
+        if not all(f > 0 for f in factor):
+            raise ValueError('Scale factors must be positive')
+        return self._bulk(selection, lambda table, rows: table.scale(rows, factor, origin))
+
+    def remap_labels(self, mapping, selection = None):
+        """
+        Relabel the selected annotations according to a dict of old to new labels
+        Returns the number of annotations edited
+        """
+        labels = self._annotations.labels
+        new = dict((old, labels.intern(label)) for old, label in mapping.items() if old in labels.ids)
+        lut = np.arange(len(labels), dtype=np.int32)
+        for old, i in new.items():
+            lut[labels.ids[old]] = i
+        def edit(table, rows):
+            table._data['label'][rows] = lut[table._data['label'][rows]]
+        return self._bulk(selection, edit)
+
+    def delete_where(self, selection):
+        """
+        Delete the annotations in a selection, or where a boolean mask over all annotations is set
+        Returns the number of annotations deleted
+        """
+        def edit(table, rows):
+            table._data['removed'][rows] = True
+            for r in rows:
+                table.remove(r)
+        return self._bulk(selection, edit)
+
+    @timed('select')
     def select(self, p):
         """
         Update selection, based on hit-testing versus the position p
+        Only annotations on the current frame in the grid cell containing p are tested,
+        and the nearest of the hits is selected
         Returns the selected annotation, if any
         """
         if not self.selected is None:
             self.selected.selected = False
 
-        for a in self._annotations:
-            if a.hit_test(p):
-                self.selected = a
-                a.selected = True
-                return a
-
-        self.selected = None
+        self.selected = self._annotations.select(p, self.frame)
+        if not self.selected is None:
+            self.selected.selected = True
+        self.updated = True
 
         return self.selected
 
 
 
+NUMBER = (int, long, float, Decimal)
+INT32 = np.iinfo(np.int32)      #range of the coordinate and frame columns of the tables
+
+
+def is_coordinate(value):
+    """Whether a value is an integral number, within the range of the coordinate columns"""
+    if isinstance(value, bool) or not isinstance(value, NUMBER):
+        return False
+    try:
+        return value == int(value) and INT32.min <= value <= INT32.max
+    except (ValueError, OverflowError, ArithmeticError):
+        return False    #nan and infinity
+
+
+def column(name, readonly = False):
+    """
+    Property exposing a field of the table row backing an annotation
+    """
+    def get(self):
+        return self._table._data[name][self._row].item()
+    def set(self, value):
+        self._table._data[name][self._row] = value
+        self._table.reindex([self._row])
+    return property(get, None if readonly else set)
+
+
 class Annotation(HasTraits):
     """
     Annotation base class
+
+    Annotations are proxies onto a row of a columnar Table
+    Until added to a datamodel, an annotation owns a private single-row table
     """
 
     distance = 50   #margin for hit-tests
+    fields = ()     #names of the coordinate columns
+    axes = ()       #image axis of each coordinate column
+    attributes = () #names of additional coordinate attributes of records, beyond the fields
+    storage = Table #class of the table storing annotations of this type
 
-    selected = Bool(False)
-    removed = Bool(False)
+    selected = Property(Bool)
+    removed = Property(Bool)
     changed = Int(0)
 
-    def __init__(self):
+    def __init__(self, label = None, coords = (), frame = 0):
         super(Annotation, self).__init__()
+        if label is not None:
+            self._table = self.storage(type(self), LabelTable(), indexed=False, capacity=1)
+            self._row = int(self._table.extend([coords], [label], [0], [frame])[0])
 
-    def to_json():
+    @classmethod
+    def proxy(cls, table, row):
+        """
+        Create an annotation object for an existing table row
+        """
+        self = cls.__new__(cls)
+        Annotation.__init__(self)
+        self._table, self._row = table, row
+        return self
+
+    def _get_flag(self, name):
+        return bool(self._table._data[name][self._row])
+    def _set_flag(self, name, value):
+        old, value = self._get_flag(name), bool(value)
+        self._table._data[name][self._row] = value
+        if old != value:
+            self.trait_property_changed(name, old, value)
+
+    def _get_selected(self):
+        return self._get_flag('selected')
+    def _set_selected(self, value):
+        self._set_flag('selected', value)
+
+    def _get_removed(self):
+        return self._get_flag('removed')
+    def _set_removed(self, value):
+        self._set_flag('removed', value)
+
+    def _get_label(self):
+        return self._table.labels[self._table._data['label'][self._row]]
+    def _set_label(self, label):
+        self._table._data['label'][self._row] = self._table.labels.intern(label)
+    label = property(_get_label, _set_label)
+
+    frame = column('frame')
+
+    @property
+    def coords(self):
+        """Tuple of the coordinate fields"""
+        return tuple(getattr(self, f) for f in self.fields)
+
+    def assign(self, attrs):
+        """
+        Set the coordinates of the annotation from an attr dict
+        """
+        for f in self.fields:
+            setattr(self, f, attrs[f])
+
+    @classmethod
+    def validate(cls, attrs):
+        """
+        Check an attr dict against the schema of the annotation type;
+        a string label, valid coordinates, and optionally a non-negative integer frame
+        """
+        try:
+            frame = attrs.get('frame', 0)
+            valid = isinstance(attrs['label'], basestring) and cls.valid_coords(attrs) and \
+                isinstance(frame, (int, long)) and not isinstance(frame, bool) and 0 <= frame <= INT32.max
+        except (KeyError, TypeError):
+            valid = False
+        if not valid:
+            raise InvalidAnnotation('Invalid attributes {0}'.format(str(attrs)), 'attributes', attrs)
+
+    @classmethod
+    def valid_coords(cls, attrs):
+        """
+        Whether an attr dict holds an integral number for each of the coordinate fields
+        Coordinates are stored as int32; fractional or larger values are rejected, rather than truncated
+        """
+        return all(is_coordinate(attrs[f]) for f in cls.fields)
+
+    def to_json(self):
         """
         Create a JSON represetation of the annotation
         """
-        raise NotImplemented()
+        return self._table.to_json(self._table._data[self._row:self._row+1])[0]
     def from_json():
         raise NotImplemented()
     def hit_test(self):
@@ -151,6 +651,35 @@ class Annotation(HasTraits):
         returns a boolean denoting hit status
         """
         raise NotImplemented()
+    def hit_distance(self, p):
+        """
+        Distance between the annotation and the position p, used to rank multiple hits
+        """
+        raise NotImplemented()
+
+    @classmethod
+    def column_extent(cls, data):
+        """
+        Return an (n, 4) array of bounding boxes (l0, h0, l1, h1) of the given table rows
+        """
+        raise NotImplemented()
+
+    @classmethod
+    def column_bounds(cls, data):
+        """
+        Return an (n, 4) array of bounding boxes (l0, h0, l1, h1) of the given table rows,
+        padded by the hit-test margin
+        """
+        d = cls.distance
+        return cls.column_extent(data) + [-d, d, -d, d]
+
+    @classmethod
+    def column_hit(cls, data, p):
+        """
+        Vectorized hit-test of the given table rows versus the position p
+        Returns a boolean hit mask and the distances to p
+        """
+        raise NotImplemented()
 
     @property
     def center(self):
@@ -168,7 +697,8 @@ class Annotation(HasTraits):
         """
         Translate the annotation by a given amount
         """
-        raise NotImplemented()
+        self._table.translate([self._row], delta)
+        self.changed +=1
 
 
 
@@ -176,62 +706,143 @@ class Rectangle(Annotation):
     """
     Bounding rectangle data model class
     """
-    def __init__(self, label, l0, h0, l1, h1, **kwargs):
-        super(Rectangle, self).__init__()
-        self.l0, self.h0, self.l1, self.h1 = l0, h0, l1, h1
-        self.label = label
+    fields = ('l0', 'h0', 'l1', 'h1')
+    axes = (0, 0, 1, 1)
 
-    def to_json(self):
-        return {
-            'type':   'Rectangle',
-            'label':  self.label,
-            'l0':     self.l0,
-            'h0':     self.h0,
-            'l1':     self.l1,
-            'h1':     self.h1,
-        }
+    l0, h0, l1, h1 = map(column, fields)
+
+    def __init__(self, label, l0, h0, l1, h1, frame = 0, **kwargs):
+        super(Rectangle, self).__init__(label, (l0, h0, l1, h1), frame)
 
     def hit_test(self, p):
         p0, p1 = p
         return p0>self.l0-self.distance and p0<self.h0+self.distance and p1>self.l1-self.distance and p1<self.h1+self.distance
 
+    def hit_distance(self, p):
+        p0, p1 = p
+        d0 = max(self.l0-p0, 0, p0-self.h0)
+        d1 = max(self.l1-p1, 0, p1-self.h1)
+        return (d0**2+d1**2)**0.5
+
+    @classmethod
+    def column_extent(cls, data):
+        return np.column_stack([data['l0'], data['h0'], data['l1'], data['h1']])
+
+    @classmethod
+    def column_hit(cls, data, p):
+        p0, p1 = p
+        d0 = np.maximum(np.maximum(data['l0']-p0, p0-data['h0']), 0)
+        d1 = np.maximum(np.maximum(data['l1']-p1, p1-data['h1']), 0)
+        return (d0 < cls.distance) & (d1 < cls.distance), np.hypot(d0, d1)
+
     @property
     def center(self):
         return (self.l0+self.h0)/2, (self.l1+self.h1)/2
 
-    def move(self, delta):
-        self.l0 += delta[0]
-        self.l1 += delta[1]
-        self.h0 += delta[0]
-        self.h1 += delta[1]
-        self.changed +=1
-
 
 class Marker(Annotation):
     """
     Single point marker annotation
     """
-    def __init__(self, label, c0, c1, **kwargs):
-        self.c0, self.c1 = c0, c1
-        self.label = label
+    fields = ('c0', 'c1')
+    axes = (0, 1)
 
-    def to_json(self):
-        return {
-            'type':   'Marker',
-            'label':  self.label,
-            'c0':     self.c0,
-            'c1':     self.c1,
-        }
+    c0, c1 = map(column, fields)
+
+    def __init__(self, label, c0, c1, frame = 0, **kwargs):
+        super(Marker, self).__init__(label, (c0, c1), frame)
 
     def hit_test(self, p):
         p0, p1 = p
         return (p0-self.c0)**2+(p1-self.c1)**2 < self.distance**2
 
+    def hit_distance(self, p):
+        p0, p1 = p
+        return ((p0-self.c0)**2+(p1-self.c1)**2)**0.5
+
+    @classmethod
+    def column_extent(cls, data):
+        return np.column_stack([data['c0'], data['c0'], data['c1'], data['c1']])
+
+    @classmethod
+    def column_hit(cls, data, p):
+        distance = np.hypot(data['c0']-p[0], data['c1']-p[1])
+        return distance < cls.distance, distance
+
     @property
     def center(self):
         return self.c0, self.c1
 
-    def move(self, delta):
-        self.c0 += delta[0]
-        self.c1 += delta[1]
-        self.changed +=1
+
+class Polygon(Annotation):
+    """
+    Closed polygon annotation, with any number of vertices
+    The fields hold the bounding box; the vertices are kept as an array by the table
+    """
+    fields = ('l0', 'h0', 'l1', 'h1')
+    axes = (0, 0, 1, 1)
+    attributes = ('vertices',)
+    storage = ContourTable
+
+    l0, h0, l1, h1 = [column(f, readonly=True) for f in fields]
+
+    def __init__(self, label, vertices, frame = 0, **kwargs):
+        """vertices is an (n, 2) array or sequence of pairs, or encoded as in the sidecar"""
+        super(Polygon, self).__init__(label, contours.decode(vertices), frame)
+
+    def _get_vertices(self):
+        return self._table.vertices(self._row)
+    def _set_vertices(self, vertices):
+        self._table.assign(self._row, contours.decode(vertices))
+    vertices = property(_get_vertices, _set_vertices)
+
+    @property
+    def coords(self):
+        return self.vertices
+
+    def assign(self, attrs):
+        self.vertices = attrs['vertices']
+
+    @classmethod
+    def valid_coords(cls, attrs):
+        """Whether an attr dict holds at least three vertices"""
+        try:
+            return len(contours.decode(attrs['vertices'])) >= 3
+        except ValueError:
+            return False
+
+    def hit_test(self, p):
+        return self.hit_distance(p) < self.distance
+
+    def hit_distance(self, p):
+        inside, edge = contours.distance([self.vertices], p)
+        return 0.0 if inside[0] else float(edge[0])
+
+    @classmethod
+    def column_extent(cls, data):
+        return np.column_stack([data['l0'], data['h0'], data['l1'], data['h1']])
+
+    @classmethod
+    def column_hit(cls, data, p):
+        """Bounding box prefilter; the table tests the polygons that pass exactly"""
+        p0, p1 = p
+        d0 = np.maximum(np.maximum(data['l0']-p0, p0-data['h0']), 0)
+        d1 = np.maximum(np.maximum(data['l1']-p1, p1-data['h1']), 0)
+        return (d0 < cls.distance) & (d1 < cls.distance), np.hypot(d0, d1)
+
+    @property
+    def center(self):
+        c0, c1 = self.vertices.mean(axis=0)
+        return int(round(c0)), int(round(c1))
+
+
+class Freehand(Polygon):
+    """
+    Closed contour drawn freehand
+    The drawn stroke is simplified while drawing, to within tolerance pixels
+    """
+    tolerance = 1.5
+
+
+TYPES = [Rectangle, Marker, Polygon, Freehand]     #annotation types supported by the datamodel, in storage order
+REGISTRY = OrderedDict((cls.__name__, cls) for cls in TYPES)
@@ -0,0 +1,277 @@
+"""
+Decoders for encapsulated (compressed) DICOM pixel data
+
+Decoders are registered per transfer syntax; RLE is decoded in pure Python and NumPy,
+and baseline and extended JPEG and JPEG 2000 through Pillow, if it is installed.
+Transfer syntaxes without a registered decoder fall back on pydicom.
+
+Frames are read from the file individually, using the basic offset table where present,
+and decoded frames are kept in a cache keyed by SOPInstanceUID. Multiple frames, or the
+segments of a single RLE frame, are decoded in parallel in a process pool, once they hold
+at least PARALLEL_BYTES of compressed data: all frames when an image is decoded at once,
+and a window of the next frames not yet cached when a single frame is requested,
+as when browsing a multi-frame image
+
+Named decoders rather than codecs, to avoid shadowing the standard library module
+"""
+
+import io
+import struct
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+ITEM = (0xFFFE, 0xE000)
+SEQUENCE_DELIMITER = (0xFFFE, 0xE0DD)
+
+PROCESSES = None            #size of the decoding process pool; None for the number of cores
+PARALLEL_BYTES = 1 << 20    #least amount of compressed data decoded in the process pool
+
+
+class FrameCache(object):
+    """
+    Bounded LRU cache of decoded frames, safe to use from multiple threads
+    """
+
+    def __init__(self, size = 32):
+        self.size = size
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, decode):
+        """Return the frame stored under key, decoding it with decode(key) if not cached"""
+        with self._lock:
+            try:
+                frame = self._frames.pop(key)
+                self._frames[key] = frame
+                return frame
+            except KeyError:
+                pass
+        frame = decode(key)
+        with self._lock:
+            self._frames[key] = frame
+            while len(self._frames) > self.size:
+                self._frames.popitem(last=False)
+        return frame
+
+    def put(self, key, frame):
+        """Store a frame decoded ahead of its use, unless already cached"""
+        with self._lock:
+            if key not in self._frames:
+                self._frames[key] = frame
+                while len(self._frames) > self.size:
+                    self._frames.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._frames
+
+    def __len__(self):
+        return len(self._frames)
+
+
+cache = FrameCache(64)      #decoded frames of all files, keyed by (SOPInstanceUID, frame)
+
+
+class Format(object):
+    """
+    Pixel format of a frame; passed to decoders in the worker processes
+    """
+
+    def __init__(self, rows, columns, samples, dtype, planar = 0):
+        self.rows, self.columns, self.samples = rows, columns, samples
+        self.dtype = np.dtype(dtype)
+        self.planar = planar
+
+    @classmethod
+    def from_header(cls, header, dtype):
+        return cls(int(header.Rows), int(header.Columns), int(getattr(header, 'SamplesPerPixel', 1)),
+                   dtype, int(getattr(header, 'PlanarConfiguration', 0) or 0))
+
+    @property
+    def shape(self):
+        return (self.rows, self.columns) + ((self.samples,) if self.samples > 1 else ())
+
+
+#transfer syntax UID -> decoder(data, format), returning a frame array
+DECODERS = OrderedDict()
+
+
+def register(*transfer_syntaxes):
+    """
+    Decorator registering a function decoding a single frame for the given transfer syntaxes
+    """
+    def decorator(f):
+        for ts in transfer_syntaxes:
+            DECODERS[ts] = f
+        return f
+    return decorator
+
+
+def decoder_for(transfer_syntax):
+    """The decoder registered for a transfer syntax, or None"""
+    return DECODERS.get(transfer_syntax)
+
+
+def read_items(fh):
+    """
+    Read the items of an encapsulated pixel data value, starting after its element header
+    Returns the basic offset table and the list of fragments
+    """
+    items = []
+    while True:
+        group, element, length = struct.unpack('<HHL', fh.read(8))
+        if (group, element) == SEQUENCE_DELIMITER:
+            break
+        if (group, element) != ITEM:
+            raise ValueError('Invalid item tag ({0:04X},{1:04X}) in encapsulated pixel data'.format(group, element))
+        items.append(fh.read(length))
+    if not items:
+        raise ValueError('Encapsulated pixel data without offset table')
+    table = items[0]
+    offsets = list(struct.unpack('<{0}L'.format(len(table) // 4), table))
+    return offsets, items[1:]
+
+
+def split_frames(offsets, fragments, frames):
+    """
+    Group fragments into frames, by the basic offset table, or else by fragment count
+    Returns a list of the compressed data of each frame
+    """
+    if frames == 1:
+        return [b''.join(fragments)]
+    if offsets:
+        starts, position = [], 0
+        for f in fragments:
+            starts.append(position)
+            position += 8 + len(f)
+        index = [starts.index(o) for o in offsets] + [len(fragments)]
+        return [b''.join(fragments[a:b]) for a, b in zip(index[:-1], index[1:])]
+    if len(fragments) == frames:
+        return fragments
+    #JPEG frames start with a start of image marker
+    groups = []
+    for f in fragments:
+        if f[:2] == b'\xff\xd8' or not groups:
+            groups.append([])
+        groups[-1].append(f)
+    if len(groups) != frames:
+        raise ValueError('Cannot split {0} fragments into {1} frames'.format(len(fragments), frames))
+    return [b''.join(g) for g in groups]
+
+
+def read_frames(path, offset, frames):
+    """
+    Read the compressed data of all frames from a file, given the offset of the pixel data value
+    """
+    with open(path, 'rb') as fh:
+        fh.seek(offset)
+        offsets, fragments = read_items(fh)
+    return split_frames(offsets, fragments, frames)
+
+
+def packbits(data):
+    """
+    Decode a PackBits encoded byte string, as used by the segments of DICOM RLE
+    """
+    data = bytearray(data)
+    out = bytearray()
+    i, n = 0, len(data)
+    while i < n:
+        c = data[i]
+        if c < 128:
+            out += data[i+1:i+c+2]
+            i += c + 2
+        elif c > 128:
+            out += data[i+1:i+2] * (257 - c)
+            i += 2
+        else:
+            i += 1
+    return bytes(out)
+
+
+def rle_segments(data):
+    """Split a DICOM RLE frame into its segments"""
+    header = struct.unpack('<16L', data[:64])
+    count, offsets = header[0], list(header[1:1 + header[0]])
+    return [data[a:b] for a, b in zip(offsets, offsets[1:] + [len(data)])]
+
+
+def rle_combine(segments, format):
+    """
+    Combine decoded RLE segments into a frame
+    Segments hold the bytes of each sample, most significant first
+    """
+    size = format.rows * format.columns
+    nbytes = format.dtype.itemsize
+    planes = [np.frombuffer(s[:size], np.uint8) for s in segments]
+    frame = np.zeros((format.samples, size), format.dtype.newbyteorder('='))
+    unsigned = frame.view(frame.dtype.str.replace('i', 'u'))
+    for s in range(format.samples):
+        for b in range(nbytes):
+            unsigned[s] |= planes[s * nbytes + b].astype(unsigned.dtype) << (8 * (nbytes - 1 - b))
+    frame = frame.reshape((format.samples, format.rows, format.columns))
+    return np.rollaxis(frame, 0, 3) if format.samples > 1 else frame[0]
+
+
+@register('1.2.840.10008.1.2.5')
+def decode_rle(data, format):
+    return rle_combine([packbits(s) for s in rle_segments(data)], format)
+
+
+if Image is not None:
+    @register(
+        '1.2.840.10008.1.2.4.50',       #JPEG baseline
+        '1.2.840.10008.1.2.4.51',       #JPEG extended
+        '1.2.840.10008.1.2.4.90',       #JPEG 2000 lossless
+        '1.2.840.10008.1.2.4.91')       #JPEG 2000
+    def decode_pillow(data, format):
+        image = Image.open(io.BytesIO(data))
+        if format.samples == 3 and image.mode != 'RGB':
+            image = image.convert('RGB')
+        return np.asarray(image).astype(format.dtype.newbyteorder('='), copy=False).reshape(format.shape)
+
+
+def _decode(task):
+    """Decode a single frame in a worker process"""
+    transfer_syntax, data, format = task
+    return DECODERS[transfer_syntax](data, format)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def pool():
+    """The process pool used for decoding, created on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = multiprocessing.Pool(PROCESSES)
+        return _pool
+
+
+def decode_frames(transfer_syntax, frames, format):
+    """
+    Decode a list of compressed frames
+    Multiple frames are decoded in the process pool, as are the segments of a single RLE frame,
+    unless the compressed data is small, or this is itself a worker process of a pool,
+    such as those of the archive index and batch tools, which cannot have children
+    """
+    decoder = DECODERS[transfer_syntax]
+    parallel = sum(len(f) for f in frames) >= PARALLEL_BYTES and \
+        not multiprocessing.current_process().daemon
+    if len(frames) > 1:
+        if parallel:
+            return pool().map(_decode, [(transfer_syntax, f, format) for f in frames])
+        return [decoder(f, format) for f in frames]
+    if decoder is decode_rle and parallel:
+        return [rle_combine(pool().map(packbits, rle_segments(frames[0])), format)]
+    return [decoder(frames[0], format)]
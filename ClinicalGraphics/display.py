@@ -0,0 +1,108 @@
+"""
+Display pipeline for DICOM images
+Maps stored pixel values to RGBA through the modality rescale, window/level and a color palette,
+combined into a single lookup table indexed by stored value
+"""
+
+import numpy as np
+
+from instrument import timed
+
+
+BLOCK = 1 << 18     #pixels colormapped at a time without a lookup table, bounding temporary float buffers
+
+
+def first(value):
+    """First value of a possibly multi-valued DICOM element, as a float, or None"""
+    if value is None:
+        return None
+    try:
+        value = value[0] if not isinstance(value, basestring) else value
+    except (TypeError, IndexError):
+        pass
+    return float(value)
+
+
+class Pipeline(object):
+    """
+    Window/level display pipeline
+
+    For integer data of at most 16 bits, the rescale, window and palette are precomputed
+    into a lookup table over all stored values; changing the window only requires
+    recomputing the table, and one vectorized lookup of the displayed image.
+    The resulting RGBA buffer is cached until the window or image changes.
+    Images are never copied or converted as a whole; the RGBA buffer is the only full-size allocation.
+    """
+
+    def __init__(self, header, palette):
+        """
+        header is the DICOM header of the image, palette a (256, 4) uint8 RGBA color table
+        """
+        self.palette = palette
+        self.slope = float(getattr(header, 'RescaleSlope', 1))
+        self.intercept = float(getattr(header, 'RescaleIntercept', 0))
+        self.invert = getattr(header, 'PhotometricInterpretation', '') == 'MONOCHROME1'
+        self.center = first(getattr(header, 'WindowCenter', None))
+        self.width = first(getattr(header, 'WindowWidth', None))
+
+        self._lut = None        #(dtype, table)
+        self._cache = None      #(image, window, buffer)
+
+    @property
+    def window(self):
+        return self.center, self.width
+
+    def set_window(self, center, width):
+        """Set the window, in rescaled (modality) units"""
+        self.center, self.width = float(center), max(float(width), 1.0)
+        self._lut = None
+
+    def auto_window(self, image):
+        """Set the window to span the full range of values in an image, unless the header specified one"""
+        if self.center is None or self.width is None:
+            lo, hi = [v * self.slope + self.intercept for v in (image.min(), image.max())]
+            self.set_window((lo + hi) / 2.0, hi - lo)
+
+    def grey(self, stored):
+        """
+        Linear DICOM window function, mapping stored values to 8 bit grey values
+        """
+        x = stored * self.slope + self.intercept
+        y = (x - (self.center - 0.5)) / max(self.width - 1, 1e-6) + 0.5
+        grey = (np.clip(y, 0, 1) * 255).astype(np.uint8)
+        return 255 - grey if self.invert else grey
+
+    def _index_dtype(self, dtype):
+        """Unsigned dtype of the same size and byte order, used to index the lookup table"""
+        return np.dtype('{0}u{1}'.format(dtype.byteorder, dtype.itemsize))
+
+    def lut(self, dtype):
+        """
+        The RGBA lookup table over all stored values of an integer dtype
+        """
+        if self._lut is None or self._lut[0] != dtype:
+            index = np.arange(2 ** (8 * dtype.itemsize), dtype=self._index_dtype(dtype).newbyteorder('='))
+            stored = index.view(dtype.newbyteorder('='))
+            self._lut = dtype, self.palette[self.grey(stored)]
+        return self._lut[1]
+
+    @timed('colormap')
+    def render(self, image):
+        """
+        Return the RGBA display buffer of an image; cached until the window or image changes
+        """
+        if image.ndim == 3:
+            return image        #color images are displayed as is
+        if self._cache is not None and self._cache[0] is image and self._cache[1] == self.window:
+            return self._cache[2]
+
+        if image.dtype.kind in 'ui' and image.dtype.itemsize <= 2:
+            buffer = self.lut(image.dtype)[image.view(self._index_dtype(image.dtype))]
+        else:
+            buffer = np.empty(image.shape + (4,), np.uint8)
+            rows = max(1, BLOCK // max(image.shape[1], 1))
+            for i in range(0, image.shape[0], rows):
+                buffer[i:i+rows] = self.palette[self.grey(image[i:i+rows])]
+
+        self._cache = image, self.window, buffer
+        return buffer
@@ -2,23 +2,40 @@
 """
 User interface code
 """
+import threading
+
 import numpy as np
 
 import datamodels
 import views
 import tools
+import pyramid
+import display
+import instrument
+from worklist import Worklist
+from vocabulary import Vocabulary
 
 
-from traits.api import HasTraits, Instance, Button, Enum, Str, List, Bool
-from traitsui.api import Item, View, EnumEditor
+from traits.api import HasTraits, Instance, Button, Enum, Str, List, Bool, Int, Any, on_trait_change
+from traitsui.api import Item, View, HGroup, VGroup, EnumEditor, RangeEditor, TabularEditor, Handler
+from traitsui.tabular_adapter import TabularAdapter
 from chaco.api import  \
-    ArrayPlotData, Plot, jet
+    ArrayPlotData, Plot, DataRange1D, jet
     #jet, GridDataSource, GridMapper, DataRange2D, DataRange1D, ImageData, CMapImagePlot
 from enable.api import ComponentEditor
+from pyface.api import GUI
 #import chaco.default_colormaps as dc
 
 
 
+def palette(colormap):
+    """
+    Sample a chaco colormap into a (256, 4) uint8 RGBA table
+    """
+    cmap = colormap(DataRange1D(low=0, high=255))
+    return (cmap.map_screen(np.arange(256)) * 255).astype(np.uint8)
+
+
 def filedialog():
     """
     Open a simple file dialog to pick a file
@@ -34,6 +51,13 @@ def filedialog():
 
 
 
+class MainHandler(Handler):
+    """Closes the datamodels of the editor along with its window"""
+
+    def closed(self, info, is_ok):
+        info.object.close()
+
+
 class Main(HasTraits):
     """
     Main UI component
@@ -42,46 +66,248 @@ class Main(HasTraits):
     """
     plot = Instance(Plot)
 
-    tools   = Enum("Select", "Rectangle", "Marker")
+    tools   = Enum("Select", "Rectangle", "Marker", "Polygon", "Freehand", "WindowLevel")
     save    = Button()
     delete  = Button()
+    undo    = Button()
+    redo    = Button()
     text    = Str()
+    picker  = Instance(tools.LabelPicker)
+
+    worklist = Instance(Worklist)
+    previous = Button()
+    next     = Button()
+
+    frame    = Int(0)       #frame of a multi-frame image being displayed
+    last     = Int(0)       #index of the last frame
 
     _annotations = List()   #list of all currently active annotation views
+    batched = Bool(False)   #draw all annotations with a single AnnotationLayer, rather than a view each
+    timings = Bool(False)   #show the frame rate and stage timings on the plot
+
+    width = 800             #initial width of the editor window
+    preview = 256           #size of the preview shown while an image is loading
 
+    pyramid = None          #pyramid of the displayed frame; None while loading
+    step = None             #full resolution pixels per displayed pixel; None for the placeholder
+    display = None          #display pipeline of the datamodel
+    _generation = 0         #incremented for each image load; results of superseded loads are dropped
 
-    def __init__(self, datamodel):
+
+    def __init__(self, datamodel, batched = False, worklist = None, timings = False):
         """
         Instantiate user interface
         Bind it to a datamodel by default
+        If a worklist is given, the user can step through its files
+        If timings is set, an overlay shows the timings of the instrumented stages
+        Labels are picked from the vocabulary of the datamodel; without one,
+        from the labels already used in the file
         """
-        super(Main, self).__init__()
+        super(Main, self).__init__(batched=batched, worklist=worklist, timings=timings)
         self.datamodel = datamodel
+        vocabulary = datamodel.vocabulary
+        if vocabulary is None:
+            vocabulary = Vocabulary(datamodel._annotations.labels.strings)
+        self.picker = tools.LabelPicker(vocabulary)
+        self.last = datamodel.frames - 1
+        datamodel.on_trait_change(self._rebuild, 'rebuilt')
         self._load_visuals()
         self._tools_changed()
+        if timings:
+            self.plot.overlays.append(views.TimingOverlay(component=self.plot))
+
+    def set_datamodel(self, datamodel):
+        """
+        Bind the user interface to another datamodel, reusing the plot
+        The previous datamodel is closed, unless it is still cached by the worklist,
+        which closes it once it is evicted
+        """
+        self._unload_visuals()
+        self.datamodel.on_trait_change(self._rebuild, 'rebuilt', remove=True)
+        if self.worklist is None or not self.worklist.owns(self.datamodel):
+            self.datamodel.close()
+        elif self.datamodel.journaled:
+            self.datamodel.journal.sync()
+        self.datamodel = datamodel
+        datamodel.on_trait_change(self._rebuild, 'rebuilt')
+        if datamodel.vocabulary is None:
+            for label in datamodel._annotations.labels.strings:
+                self.picker.vocabulary.intern(label)
+        self.last = datamodel.frames - 1
+        self.trait_setq(frame = datamodel.frame)
+        self._load_image()
+        self._load_visuals()
+
+    def _rebuild(self):
+        """
+        Recreate the views after a bulk edit of the datamodel; the batched layer follows by itself
+        """
+        if not self.batched:
+            self._unload_visuals()
+            self._load_visuals()
+        self.plot.invalidate_and_redraw()
 
+    def _frame_changed(self):
+        """
+        Display another frame; the display pipeline, and its window, are kept
+        Only the annotations on the displayed frame are shown, and can be selected
+        """
+        if self.datamodel.selected is not None:
+            self.datamodel.selected.selected = False
+            self.datamodel.selected = None
+        self._unload_visuals()
+        self.datamodel.frame = self.frame
+        self._load_image(self.display)
+        self._load_visuals()
+        self.text = 'Frame {0}/{1}'.format(self.frame + 1, self.last + 1)
+
+    def _unload_visuals(self):
+        """
+        Remove the visual components of all annotations
+        """
+        if self.batched:
+            self.layer.detach()
+        for view in self._annotations:
+            view.detach()
+        self._annotations = []
+
+    @instrument.timed('load_visuals')
     def _load_visuals(self):
         """
         Create visual components for annotations which have been read from disk
         """
-        for a in self.datamodel._annotations:
-            if isinstance(a, datamodels.Rectangle):
-                viewcls = views.Rectangle
-            if isinstance(a, datamodels.Marker):
-                viewcls = views.Marker
-            self._annotations.append(viewcls(a, self.plot))
+        if self.batched:
+            self.layer = views.AnnotationLayer(self.datamodel, self.plot)
+        else:
+            for a in self.datamodel._annotations:
+                if a.frame != self.datamodel.frame:
+                    continue
+                if isinstance(a, datamodels.Rectangle):
+                    viewcls = views.Rectangle
+                if isinstance(a, datamodels.Marker):
+                    viewcls = views.Marker
+                if isinstance(a, datamodels.Polygon):
+                    viewcls = views.Polygon
+                self._annotations.append(viewcls(a, self.plot))
+        instrument.stats.count('renderers', len(self.plot.plots))
+        instrument.stats.count('overlays', len(self.plot.overlays))
         self.plot.invalidate_and_redraw()
 
+    def _load_image(self, pipeline = None):
+        """
+        Start loading the image of the current frame of the datamodel on a worker thread
+        Until it is loaded, a placeholder, and then a low resolution preview, are displayed;
+        annotations can be edited meanwhile
+        The display pipeline is kept if given; otherwise a new one is set up, taking its initial window
+        from the DICOM header, or else from the preview or the coarsest pyramid level
+        """
+        self.display = pipeline or display.Pipeline(self.datamodel.header, palette(jet))
+        self.pyramid = None
+        self.level = None
+        self._generation += 1
+        self._set_image(np.zeros((1, 1, 4), np.uint8))
+
+        worker = threading.Thread(target=self._load_worker,
+            args=(self._generation, self.datamodel, self.datamodel.frame))
+        worker.daemon = True
+        worker.start()
+
+    def _load_worker(self, generation, datamodel, frame):
+        """
+        Load a preview, if it can be read without decoding the full image,
+        and then the pyramid levels needed for display; runs on a worker thread
+        Results are passed to the user interface thread
+        """
+        try:
+            pixels = datamodel.pixels
+            if not pixels.compressed or pixels.loaded:
+                GUI.invoke_later(self._show_preview, generation, pixels.preview(frame, self.preview),
+                                 pixels.preview_step(self.preview))
+            image = pyramid.get(datamodel.datapath, pixels.frame(frame), frame)
+            image[len(image) - 1]
+            image[image.level_for(max(datamodel.shape[:2]) / float(self.width))]
+            GUI.invoke_later(self._show_image, generation, image)
+        except Exception as e:
+            GUI.invoke_later(setattr, self, 'text', 'Failed to load image: {0}'.format(e))
+
+    def _show_preview(self, generation, image, step):
+        if generation != self._generation or self.pyramid is not None:
+            return
+        self.display.auto_window(image)
+        self._set_image(image, step)
+
+    def _show_image(self, generation, image):
+        if generation != self._generation:
+            return
+        self.display.auto_window(image[len(image) - 1])
+        self.pyramid = image
+        self._update_level()
+
+    def _set_image(self, image, step = None):
+        """
+        Display an image subsampled from the full resolution image, with step full resolution
+        pixels per pixel; its last row and column are clipped to the full image coordinates
+        Without a step, the image is stretched over the full image coordinates
+        """
+        h, w = self.datamodel.shape[:2]
+        self.displayed, self.step = image, step
+        rgba = image if image.ndim == 3 and image.shape[2] == 4 else self.display.render(image)
+        if getattr(self, 'img_plot', None) is None:
+            return
+        if step is None:
+            x, y = np.linspace(0, w, image.shape[1]+1), np.linspace(0, h, image.shape[0]+1)
+        else:
+            x = np.minimum(np.arange(image.shape[1]+1) * step, w)
+            y = np.minimum(np.arange(image.shape[0]+1) * step, h)
+        self.img_plot.index.set_data(x, y)
+        self.plotdata.set_data('imagedata', rgba)
+
     def _plot_default(self):
         """
         Construct the default plot container, data source and image plot
+        The image is displayed from a pyramid, at a level matching the window size,
+        and colormapped by the display pipeline
         """
-        self.plotdata = ArrayPlotData(imagedata = self.datamodel.data)
+        h, w = self.datamodel.shape[:2]
+        self.plotdata = ArrayPlotData(imagedata = np.zeros((1, 1, 4), np.uint8))
         plot = Plot(self.plotdata)
-        img_plot = plot.img_plot("imagedata", colormap=jet, origin='top left')
+        self.img_plot = plot.img_plot("imagedata", origin='top left',
+                                      xbounds=np.linspace(0, w, 2),
+                                      ybounds=np.linspace(0, h, 2))[0]
 
+        plot.index_mapper.on_trait_change(self._update_level, 'updated')
+        plot.on_trait_change(self._update_level, 'bounds')
+        self._load_image()
         return plot
 
+    def _update_level(self):
+        """
+        Switch to the pyramid level matching the current zoom and screen resolution
+        Full resolution is only displayed when zoomed in
+        """
+        if self.pyramid is None:
+            return
+        plot = self.plot
+        if plot.width <= 0 or plot.height <= 0:
+            scale = max(self.datamodel.shape[:2]) / float(self.width)
+        else:
+            xr, yr = plot.index_range, plot.value_range
+            scale = max((xr.high - xr.low) / plot.width, (yr.high - yr.low) / plot.height)
+        level = self.pyramid.level_for(scale)
+        if level == self.level:
+            return
+
+        self.level = level
+        self._set_image(self.pyramid[level], 2 ** level)
+
+    def set_window(self, center, width):
+        """
+        Change the display window; only the lookup table and the displayed level are recomputed
+        """
+        self.display.set_window(center, width)
+        self._set_image(self.displayed, self.step)
+        self.text = 'Window {0:.0f}, level {1:.0f}'.format(self.display.width, self.display.center)
+
     def _tools_changed(self):
         """
         activate different tool
@@ -107,11 +333,12 @@ class Main(HasTraits):
         l0, h0 = min(x), max(x)
         l1, h1 = min(y), max(y)
 
-        rmodel = datamodels.Rectangle(label, l0, h0, l1, h1)
+        rmodel = datamodels.Rectangle(label, l0, h0, l1, h1, self.datamodel.frame)
         self.datamodel.add_annotation(rmodel)
 
-        rview = views.Rectangle(rmodel, self.plot)
-        self._annotations.append(rview)
+        if not self.batched:
+            rview = views.Rectangle(rmodel, self.plot)
+            self._annotations.append(rview)
 
         self.plot.invalidate_and_redraw()
 
@@ -119,25 +346,96 @@ class Main(HasTraits):
         """
         Add a marker to the datamodel and to the visualization
         """
-        mmodel = datamodels.Marker(label, *p)
+        mmodel = datamodels.Marker(label, p[0], p[1], self.datamodel.frame)
         self.datamodel.add_annotation(mmodel)
 
-        mview = views.Marker(mmodel, self.plot)
-        self._annotations.append(mview)
+        if not self.batched:
+            mview = views.Marker(mmodel, self.plot)
+            self._annotations.append(mview)
+
+        self.plot.invalidate_and_redraw()
+
+    def add_polygon(self, points, label, freehand = False):
+        """
+        Add a polygon, or a freehand contour, to the datamodel and to the visualization
+        """
+        cls = datamodels.Freehand if freehand else datamodels.Polygon
+        pmodel = cls(label, points, self.datamodel.frame)
+        self.datamodel.add_annotation(pmodel)
+
+        if not self.batched:
+            pview = views.Polygon(pmodel, self.plot)
+            self._annotations.append(pview)
 
         self.plot.invalidate_and_redraw()
 
 
+    def quick_key(self, key):
+        """
+        Choose the label bound to a quick key, and give it to the selected annotation, if any
+        Returns whether the key is bound
+        """
+        label = self.picker.quick_key(key)
+        if label is None:
+            return False
+        selected = self.datamodel.selected
+        if selected is not None and selected.label != label:
+            self.datamodel.relabel(selected, label)
+            self.plot.invalidate_and_redraw()
+        self.text = 'Label: {0}'.format(label)
+        return True
+
     def _save_fired(self):
         """
-        Save the datamodel to disk
+        Save the datamodel to disk, and the vocabulary, if it belongs to a project
         """
         try:
             self.datamodel.save()
+            vocabulary = self.datamodel.vocabulary
+            if vocabulary is not None and vocabulary.path is not None:
+                vocabulary.save()
             self.text = 'Datamodel saved'
         except Exception as e:
             self.text = str(e)
 
+    def _navigate(self, delta):
+        """
+        Step through the worklist, saving any edits to the current file
+        Journaled edits are already on disk, and are compacted in the background
+        """
+        if self.datamodel.modified and not self.datamodel.journaled:
+            self.datamodel.save()
+        self.set_datamodel(self.worklist.step(delta))
+        self.text = '{0}/{1}: {2}'.format(self.worklist.index + 1, len(self.worklist), self.datamodel.datapath)
+
+    def close(self):
+        """
+        Close the datamodel and the worklist, if any, stopping background compaction
+        and syncing the journals to disk; called when the editor window is closed
+        """
+        if self.worklist is not None:
+            self.worklist.close()
+        self.datamodel.close()
+
+    def _previous_fired(self):
+        self._navigate(-1)
+
+    def _next_fired(self):
+        self._navigate(1)
+
+    def _undo_fired(self):
+        """
+        Revert the last edit; views follow the changes to the annotations
+        """
+        if not self.datamodel.undo():
+            self.text = 'Nothing to undo'
+        self.plot.invalidate_and_redraw()
+
+    def _redo_fired(self):
+        if not self.datamodel.redo():
+            self.text = 'Nothing to redo'
+        self.plot.invalidate_and_redraw()
+
     def _delete_fired(self):
         """
         Delete the currently selected annotation from the datamodel
@@ -148,13 +446,103 @@ class Main(HasTraits):
 
     traits_view = View(
         Item('plot', editor=ComponentEditor(), show_label=False),
+        Item('frame', editor=RangeEditor(low=0, high_name='last', mode='slider'),
+             defined_when='last > 0'),
         Item('tools', show_label=False, style='custom'),
+        Item('picker', show_label=False, style='custom'),
         Item('delete', show_label=False),
+        HGroup(
+            Item('undo', show_label=False),
+            Item('redo', show_label=False)),
         Item('save', show_label=False),
+        HGroup(
+            Item('previous', show_label=False),
+            Item('next', show_label=False),
+            defined_when='worklist is not None'),
         Item('text', show_label=False),
-        width=800, height=900, resizable=True, title="Annotation Editor")
+        width=width, height=900, resizable=True, title="Annotation Editor", handler=MainHandler())
+
+
+
+
+class StudyAdapter(TabularAdapter):
+    """
+    Adapter showing the rows of an index query in a table
+    """
+    columns = [('Path', 'path'), ('Modality', 'modality'), ('Date', 'study_date'),
+               ('Rows', 'rows'), ('Columns', 'columns'), ('Frames', 'frames'),
+               ('Annotations', 'annotations')]
+
+    def get_content(self, object, trait, row, column):
+        value = getattr(object, trait)[row].get(self.column_map[column])
+        return '' if value is None else value
+
+
+class Browser(HasTraits):
+    """
+    Overview of the studies in an indexed archive
+    Studies are filtered by label and annotation status using the index,
+    and shown with their thumbnail; the selected study is opened in the editor
+    """
+    label     = Str()
+    annotated = Enum('All', 'Annotated', 'Unannotated')
+    studies   = List()
+    selected  = Any()
+    preview   = Instance(Plot)
+    open      = Button()
+    text      = Str()
+
+    def __init__(self, index, journaled = False):
+        """
+        index is an Index of an archive; it is brought up to date first
+        If journaled, studies are opened with their edits journaled, as in DataModel
+        """
+        super(Browser, self).__init__()
+        self.index = index
+        self.journaled = journaled
+        self.vocabulary = Vocabulary.load(index.root)
+        scanned, errors = index.update()
+        self.text = '{0} files scanned, {1} errors'.format(scanned, len(errors))
+        self.query()
+
+    @on_trait_change('label, annotated')
+    def query(self):
+        annotated = {'All': None, 'Annotated': True, 'Unannotated': False}[self.annotated]
+        self.studies = self.index.query(self.label or None, annotated)
+
+    def _preview_default(self):
+        self.previewdata = ArrayPlotData(thumbnail = np.zeros((1, 1), np.uint8))
+        plot = Plot(self.previewdata)
+        plot.img_plot('thumbnail', origin='top left', colormap=jet)
+        plot.x_axis.visible = plot.y_axis.visible = False
+        return plot
 
+    def _selected_changed(self):
+        if self.selected is None:
+            return
+        thumbnail = self.index.thumbnail(self.selected['path'])
+        if thumbnail is not None:
+            self.previewdata.set_data('thumbnail', thumbnail)
+        labels = self.index.labels(self.selected['path'])
+        self.text = ', '.join('{0} ({1})'.format(l, c) for l, c in sorted(labels.items()))
+
+    def _open_fired(self):
+        if self.selected is None:
+            return
+        datamodel = datamodels.DataModel(self.selected['path'], self.selected['sidecar'],
+                                         journaled=self.journaled, vocabulary=self.vocabulary)
+        Main(datamodel).edit_traits()
 
+    traits_view = View(
+        HGroup(Item('label'), Item('annotated', show_label=False)),
+        HGroup(
+            Item('studies', editor=TabularEditor(adapter=StudyAdapter(), selected='selected', editable=False),
+                 show_label=False),
+            VGroup(
+                Item('preview', editor=ComponentEditor(), show_label=False, width=256, height=256),
+                Item('open', show_label=False))),
+        Item('text', show_label=False, style='readonly'),
+        width=1000, height=700, resizable=True, title="Study Browser")
 
 
 class Panel(HasTraits):
@@ -0,0 +1,66 @@
+"""
+Undo/redo history of edits to the annotations
+
+Each edit is recorded as a small tuple, holding the edited annotation and the change
+made to it, rather than a copy of its state; deleted annotations keep their table row,
+flagged as removed, so that deleting and restoring them costs nothing either
+"""
+
+
+class History(object):
+    """
+    Unbounded undo and redo stacks of edits
+
+    Entries are tuples (op, annotation, *change):
+        ('add', annotation)
+        ('delete', annotation)
+        ('move', annotation, delta)
+        ('relabel', annotation, old, new)
+    """
+
+    def __init__(self):
+        self.undo = []
+        self.redo = []
+
+    def __len__(self):
+        return len(self.undo)
+
+    def record(self, op, annotation, *change):
+        """
+        Record an edit; this clears the redo stack
+        """
+        self.undo.append((op, annotation) + change)
+        del self.redo[:]
+
+    def record_move(self, annotation, delta, merge = False):
+        """
+        Record a move; if merge is set, and the previous edit moved the same annotation,
+        the delta is added to that entry instead
+        """
+        if merge and self.undo:
+            last = self.undo[-1]
+            if last[0] == 'move' and last[1] is annotation:
+                self.undo[-1] = 'move', annotation, tuple(a + b for a, b in zip(last[2], delta))
+                del self.redo[:]
+                return
+        self.record('move', annotation, tuple(delta))
+
+    def pop_undo(self):
+        """Move the last edit onto the redo stack, and return it, or None"""
+        if not self.undo:
+            return None
+        entry = self.undo.pop()
+        self.redo.append(entry)
+        return entry
+
+    def pop_redo(self):
+        """Move the last undone edit back onto the undo stack, and return it, or None"""
+        if not self.redo:
+            return None
+        entry = self.redo.pop()
+        self.undo.append(entry)
+        return entry
+
+    def clear(self):
+        del self.undo[:]
+        del self.redo[:]
@@ -0,0 +1,288 @@
+"""
+Persistent index of a DICOM archive
+
+Stores header fields, a small thumbnail and the annotation counts and labels of every
+DICOM file below a root directory in an SQLite database, so that studies can be
+browsed and queried without opening each file. The index is updated incrementally;
+only files whose DICOM or sidecar modification time changed are rescanned,
+in a process pool. Labels are interned to integer ids, so that label queries
+compare integers.
+
+Usage:
+    python -m clinicalgraphics.index <root> [--label LABEL] [--unannotated] [--processes N]
+"""
+
+import os
+import sys
+import sqlite3
+import argparse
+import multiprocessing
+from collections import Counter
+
+import numpy as np
+
+from .pixels import PixelData, read_header, find as find_dicom
+from .display import Pipeline
+from .datamodels import DataModel
+from .sidecar import sidecar_path
+
+
+FILENAME = '.clinicalgraphics.sqlite'   #default location of the index, in the root directory
+THUMBNAIL = 64                          #maximum thumbnail size, in pixels
+VERSION = 2                             #schema version; indices of other versions are rebuilt
+
+#header fields stored per file, as (column, DICOM keyword)
+HEADER_FIELDS = [
+    ('sop_instance_uid',    'SOPInstanceUID'),
+    ('study_instance_uid',  'StudyInstanceUID'),
+    ('patient_id',          'PatientID'),
+    ('study_date',          'StudyDate'),
+    ('modality',            'Modality'),
+    ('description',         'SeriesDescription'),
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS studies (
+    path TEXT PRIMARY KEY,
+    sidecar TEXT,
+    mtime REAL,
+    sidecar_mtime REAL,
+    {0},
+    rows INTEGER,
+    columns INTEGER,
+    frames INTEGER,
+    annotations INTEGER,
+    thumbnail BLOB,
+    thumbnail_shape TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS vocabulary (
+    id INTEGER PRIMARY KEY,
+    label TEXT UNIQUE
+);
+CREATE TABLE IF NOT EXISTS labels (
+    path TEXT REFERENCES studies(path) ON DELETE CASCADE,
+    label_id INTEGER REFERENCES vocabulary(id),
+    count INTEGER
+);
+CREATE INDEX IF NOT EXISTS labels_label ON labels(label_id);
+CREATE INDEX IF NOT EXISTS labels_path ON labels(path);
+""".format(',\n    '.join('{0} TEXT'.format(c) for c, k in HEADER_FIELDS))
+
+
+def mtime(path):
+    """Modification time of a file, or None if it does not exist"""
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def find(root):
+    """
+    Yield the paths of all DICOM files below root, with the paths of their sidecar files
+    Hidden files and directories are skipped, as are files with other extensions
+    """
+    for path in find_dicom(root):
+        yield path, sidecar_path(path)
+
+
+def thumbnail(pixels, size = THUMBNAIL):
+    """
+    Return an 8 bit grey thumbnail of the first frame of the pixel data
+    The image is subsampled with a stride, so that only a few rows are read from a mapped file
+    """
+    image = pixels.preview(0, size)
+    if image.ndim == 3:
+        image = image.mean(axis=2)
+    pipeline = Pipeline(pixels.header, None)
+    pipeline.auto_window(image)
+    return pipeline.grey(image)
+
+
+def scan_file(task):
+    """
+    Read the header, thumbnail and annotations of a single file
+    task is a (path, sidecar, header) tuple; if header is false, only the sidecar is read
+    Returns the path, a dict of column values, a Counter of labels, and an error or None
+    """
+    path, sidecar, header = task
+    columns = {'sidecar': sidecar, 'mtime': mtime(path), 'sidecar_mtime': mtime(sidecar), 'error': None}
+    labels = Counter()
+    try:
+        if header:
+            h, offset = read_header(path)
+            pixels = PixelData(path, h, offset)
+            for column, keyword in HEADER_FIELDS:
+                value = getattr(h, keyword, None)
+                columns[column] = None if value is None else str(value)
+            columns.update(rows=int(h.Rows), columns=int(h.Columns), frames=pixels.frames)
+            thumb = thumbnail(pixels)
+            columns.update(thumbnail=thumb.tostring(),
+                           thumbnail_shape='{0},{1}'.format(*thumb.shape))
+        if columns['sidecar_mtime'] is not None:
+            labels.update(r['label'] for r in DataModel(None, sidecar)._annotations.to_json())
+        columns['annotations'] = sum(labels.values())
+        return path, columns, labels, None
+    except Exception as e:
+        columns['error'] = str(e)
+        return path, columns, labels, '{0}: {1}'.format(path, e)
+
+
+class Index(object):
+    """
+    SQLite index of the DICOM files below a root directory
+    """
+
+    def __init__(self, root, path = None):
+        """
+        Open or create the index of root; by default stored in the root directory itself
+        """
+        self.root = root
+        self.path = os.path.join(root, FILENAME) if path is None else path
+        self.db = sqlite3.connect(self.path)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA foreign_keys = ON')
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != VERSION:
+            self.db.executescript('DROP TABLE IF EXISTS labels; DROP TABLE IF EXISTS studies;'
+                                  'DROP TABLE IF EXISTS vocabulary;')
+            self.db.execute('PRAGMA user_version = {0}'.format(VERSION))
+        self.db.executescript(SCHEMA)
+        self.ids = dict((l, i) for i, l in self.db.execute('SELECT id, label FROM vocabulary'))
+
+    def close(self):
+        self.db.close()
+
+    def stale(self):
+        """
+        Return the scan tasks of all new and modified files, and the paths of removed files
+        """
+        known = dict((p, (m, s)) for p, m, s in
+                     self.db.execute('SELECT path, mtime, sidecar_mtime FROM studies'))
+        tasks = []
+        for path, sidecar in find(self.root):
+            stored = known.pop(path, None)
+            current = mtime(path), mtime(sidecar)
+            if stored is None or stored[0] != current[0]:
+                tasks.append((path, sidecar, True))
+            elif stored[1] != current[1]:
+                tasks.append((path, sidecar, False))
+        return tasks, sorted(known)
+
+    def update(self, processes = None, chunksize = 16):
+        """
+        Bring the index up to date with the files on disk
+        Returns the number of files scanned and a list of errors
+        """
+        tasks, removed = self.stale()
+        with self.db:
+            self.db.executemany('DELETE FROM studies WHERE path = ?', [(p,) for p in removed])
+        if not tasks:
+            return 0, []
+
+        errors = []
+        pool = multiprocessing.Pool(processes)
+        try:
+            with self.db:
+                for path, columns, labels, error in pool.imap_unordered(scan_file, tasks, chunksize):
+                    if error:
+                        errors.append(error)
+                    self._store(path, columns, labels)
+        finally:
+            pool.close()
+            pool.join()
+        return len(tasks), errors
+
+    def _store(self, path, columns, labels):
+        """Insert or update the row of a file, and replace its labels"""
+        if columns.get('thumbnail') is not None:
+            columns['thumbnail'] = sqlite3.Binary(columns['thumbnail'])
+        names = sorted(columns)
+        exists = self.db.execute('SELECT 1 FROM studies WHERE path = ?', (path,)).fetchone()
+        if exists:
+            self.db.execute('UPDATE studies SET {0} WHERE path = ?'.format(
+                ', '.join(n + ' = ?' for n in names)), [columns[n] for n in names] + [path])
+        else:
+            self.db.execute('INSERT INTO studies (path, {0}) VALUES (?, {1})'.format(
+                ', '.join(names), ', '.join('?' * len(names))), [path] + [columns[n] for n in names])
+        self.db.execute('DELETE FROM labels WHERE path = ?', (path,))
+        self.db.executemany('INSERT INTO labels (path, label_id, count) VALUES (?, ?, ?)',
+                            [(path, self.intern(l), c) for l, c in labels.items()])
+
+    def intern(self, label):
+        """Return the id of a label, adding it to the vocabulary of the index if needed"""
+        try:
+            return self.ids[label]
+        except KeyError:
+            i = self.ids[label] = self.db.execute('INSERT INTO vocabulary (label) VALUES (?)', (label,)).lastrowid
+            return i
+
+    def query(self, label = None, annotated = None, modality = None):
+        """
+        Return the rows of the indexed files as dicts, ordered by path, optionally filtered
+        label selects files with at least one annotation with the given label,
+        annotated files with or without annotations
+        """
+        where, args = [], []
+        if label is not None:
+            where.append('path IN (SELECT path FROM labels WHERE label_id = ?)')
+            args.append(self.ids.get(label, -1))
+        if annotated is not None:
+            where.append('annotations > 0' if annotated else 'NOT annotations > 0')
+        if modality is not None:
+            where.append('modality = ?')
+            args.append(modality)
+        columns = ['path', 'sidecar', 'annotations', 'rows', 'columns', 'frames', 'error'] + \
+            [c for c, k in HEADER_FIELDS]
+        sql = 'SELECT {0} FROM studies'.format(', '.join(columns))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return [dict(zip(columns, r)) for r in self.db.execute(sql + ' ORDER BY path', args)]
+
+    def labels(self, path = None):
+        """
+        Return a dict of annotation counts per label, of a single file or of all files
+        """
+        if path is None:
+            rows = self.db.execute('SELECT label_id, SUM(count) FROM labels GROUP BY label_id')
+        else:
+            rows = self.db.execute('SELECT label_id, count FROM labels WHERE path = ?', (path,))
+        labels = dict((i, l) for l, i in self.ids.items())
+        return dict((labels[i], c) for i, c in rows)
+
+    def thumbnail(self, path):
+        """
+        Return the thumbnail of a file as an 8 bit array, or None
+        """
+        row = self.db.execute('SELECT thumbnail, thumbnail_shape FROM studies WHERE path = ?', (path,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        shape = tuple(int(s) for s in row[1].split(','))
+        return np.frombuffer(row[0], np.uint8).reshape(shape)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Index and query a DICOM archive')
+    parser.add_argument('root', help='directory to index')
+    parser.add_argument('--index', default=None, help='index file; by default stored in root')
+    parser.add_argument('--label', default=None, help='list files with annotations with this label')
+    parser.add_argument('--unannotated', action='store_true', help='list files without annotations')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    index = Index(args.root, args.index)
+    try:
+        scanned, errors = index.update(args.processes)
+        for e in errors:
+            sys.stderr.write(e + '\n')
+        annotated = False if args.unannotated else None
+        for row in index.query(args.label, annotated):
+            sys.stdout.write('{path}\t{annotations}\n'.format(**row))
+        sys.stderr.write('{0} files scanned, {1} errors\n'.format(scanned, len(errors)))
+    finally:
+        index.close()
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,193 @@
+"""
+Opt-in instrumentation of the hot paths of the editor
+Stages such as loading, redrawing, hit-testing and saving are timed when enabled,
+and the statistics dumped periodically as JSON, or logged
+When disabled, timed functions only pay for a single attribute lookup
+"""
+
+import json
+import time
+import logging
+import threading
+from functools import wraps
+from collections import deque, OrderedDict
+
+from journal import atomic_write
+
+
+logger = logging.getLogger(__name__)
+
+
+class Stage(object):
+    """
+    Timing statistics of a single stage
+    The most recent samples are kept to report latency percentiles
+    """
+
+    def __init__(self, samples = 256):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=samples)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+    @property
+    def last(self):
+        return self.recent[-1] if self.recent else None
+
+    def percentile(self, q):
+        """The q-th percentile of the recent samples"""
+        if not self.recent:
+            return None
+        recent = sorted(self.recent)
+        return recent[min(int(q / 100.0 * len(recent)), len(recent) - 1)]
+
+    def to_json(self):
+        return {
+            'count':    self.count,
+            'total':    self.total,
+            'mean':     self.total / self.count if self.count else None,
+            'max':      self.max,
+            'last':     self.last,
+            'p50':      self.percentile(50),
+            'p95':      self.percentile(95),
+        }
+
+
+class Stats(object):
+    """
+    Collection of stage timings and counters
+    Stages may be timed from multiple threads
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = OrderedDict()
+            self.counters = OrderedDict()
+            self.frames = deque(maxlen=64)      #timestamps of recent redraws of the plot
+
+    def add(self, name, seconds):
+        """Record a timing of the named stage"""
+        with self._lock:
+            try:
+                stage = self.stages[name]
+            except KeyError:
+                stage = self.stages[name] = Stage()
+            stage.add(seconds)
+
+    def count(self, name, value):
+        """Set the current value of a counter, such as the number of live renderers"""
+        with self._lock:
+            self.counters[name] = value
+
+    def frame(self):
+        """Record that a frame was drawn"""
+        with self._lock:
+            self.frames.append(time.time())
+
+    @property
+    def fps(self):
+        """Frame rate over the recent frames; frames more than a second apart are not counted as continuous"""
+        with self._lock:
+            frames = list(self.frames)
+        intervals = [b - a for a, b in zip(frames[:-1], frames[1:]) if b - a < 1.0]
+        if not intervals:
+            return None
+        return len(intervals) / sum(intervals) if sum(intervals) else None
+
+    def last(self, name):
+        """The last timing of the named stage, or None"""
+        with self._lock:
+            stage = self.stages.get(name)
+            return stage.last if stage is not None else None
+
+    def to_json(self):
+        with self._lock:
+            stages = OrderedDict((n, s.to_json()) for n, s in self.stages.items())
+            counters = OrderedDict(self.counters)
+        return {'time': time.time(), 'fps': self.fps, 'stages': stages, 'counters': counters}
+
+
+stats = Stats()
+
+
+def timed(name):
+    """
+    Decorator timing each call of a function as the named stage, if instrumentation is enabled
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not stats.enabled:
+                return f(*args, **kwargs)
+            t = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                stats.add(name, time.time() - t)
+        return wrapper
+    return decorator
+
+
+class Reporter(threading.Thread):
+    """
+    Background thread dumping the statistics every interval seconds
+    If a path is given, they are written to it as JSON; otherwise they are logged
+    """
+
+    def __init__(self, path = None, interval = 10.0):
+        super(Reporter, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            self.report()
+
+    def report(self):
+        text = json.dumps(stats.to_json(), indent=4)
+        if self.path is None:
+            logger.info(text)
+        else:
+            atomic_write(self.path, text)
+
+    def stop(self):
+        """Stop the thread, after a final report"""
+        self._halt.set()
+        self.join()
+        self.report()
+
+
+_reporter = None
+
+def enable(path = None, interval = 10.0):
+    """
+    Start timing the instrumented stages, and report them periodically
+    """
+    global _reporter
+    stats.enabled = True
+    if _reporter is None:
+        _reporter = Reporter(path, interval)
+        _reporter.start()
+
+def disable():
+    """
+    Stop timing, and write a final report
+    """
+    global _reporter
+    stats.enabled = False
+    if _reporter is not None:
+        _reporter.stop()
+        _reporter = None
@@ -0,0 +1,164 @@
+"""
+Journaled persistence of annotations
+
+Every edit is appended as a single JSON line to a journal next to the sidecar file,
+and the journal is periodically compacted into the canonical sidecar JSON.
+
+Each journal starts with a header line holding the SHA1 digest of the sidecar contents
+it applies to. On compaction the journal is first rotated to a .old file, the new sidecar
+is written atomically, and the .old file is discarded; after a crash at any point in
+between, comparing digests tells which journals still need to be replayed.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+def digest(text):
+    """SHA1 digest of the contents of a sidecar file"""
+    return hashlib.sha1(text).hexdigest() if text is not None else None
+
+
+def atomic_write(path, text):
+    """
+    Write a file via a synced temporary file and a rename,
+    so that readers see either the old or the new contents
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fh:
+        fh.write(text)
+        fh.flush()
+        os.fsync(fh.fileno())
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)     #no atomic replace on windows under python 2
+    os.rename(tmp, path)
+
+
+def read(path):
+    """
+    Read a journal file
+    Returns its base digest and its records; a truncated final record is ignored
+    Returns (None, None) if the journal does not exist
+    """
+    if not os.path.exists(path):
+        return None, None
+    base, records = None, []
+    with open(path, 'rb') as fh:
+        for i, line in enumerate(fh):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if i == 0:
+                base = record['base']
+            else:
+                records.append(record)
+    return base, records
+
+
+class Journal(object):
+    """
+    Append-only log of annotation edits
+    Records are fsynced in batches; when sync_count records are pending or
+    sync_interval seconds have passed since the last sync
+    """
+
+    def __init__(self, path, base, sync_count = 64, sync_interval = 1.0):
+        self.path = path
+        self.sync_count = sync_count
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._open(base)
+
+    def _open(self, base):
+        exists = os.path.exists(self.path)
+        self.fh = open(self.path, 'ab')
+        self.records = 0
+        self.pending = 0
+        self.synced = time.time()
+        if not exists:
+            self._write({'base': base})
+            self._sync()
+
+    @property
+    def old(self):
+        """Path of the journal during compaction"""
+        return self.path + '.old'
+
+    def _write(self, record):
+        self.fh.write(json.dumps(record, separators=(',', ':')))
+        self.fh.write('\n')
+
+    def _sync(self):
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.pending = 0
+        self.synced = time.time()
+
+    def append(self, record):
+        """
+        Append a single record to the journal
+        """
+        with self._lock:
+            self._write(record)
+            self.records += 1
+            self.pending += 1
+            if self.pending >= self.sync_count or time.time() - self.synced > self.sync_interval:
+                self._sync()
+
+    def sync(self):
+        """Sync any pending records to disk"""
+        with self._lock:
+            if self.pending:
+                self._sync()
+
+    def rotate(self, base):
+        """
+        Move the current journal aside, and start a new one on top of the sidecar with the given digest
+        """
+        with self._lock:
+            self._sync()
+            self.fh.close()
+            if os.path.exists(self.old):
+                os.remove(self.old)
+            os.rename(self.path, self.old)
+            self._open(base)
+
+    def discard_old(self):
+        """Remove the rotated journal, once its records are part of the sidecar"""
+        if os.path.exists(self.old):
+            os.remove(self.old)
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self.fh.close()
+
+
+class Compactor(threading.Thread):
+    """
+    Background thread syncing the journal of a datamodel,
+    and compacting it into the sidecar once it holds more than threshold records
+    """
+
+    def __init__(self, datamodel, interval = 1.0, threshold = 1000):
+        super(Compactor, self).__init__()
+        self.daemon = True
+        self.datamodel = datamodel
+        self.interval = interval
+        self.threshold = threshold
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            journal = self.datamodel.journal
+            journal.sync()
+            if journal.records >= self.threshold:
+                self.datamodel.compact()
+
+    def stop(self):
+        self._halt.set()
+        self.join()
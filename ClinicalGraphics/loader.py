@@ -0,0 +1,60 @@
+"""
+Streaming reader for sidecar files
+Records are decoded incrementally if ijson is available, so that multi-megabyte
+machine-generated sidecar files need not be decoded into a single list first
+"""
+
+import json
+import hashlib
+from itertools import islice
+
+try:
+    import ijson
+    DECODE_ERRORS = (ValueError, ijson.JSONError)
+except ImportError:
+    ijson = None
+    DECODE_ERRORS = (ValueError,)
+
+
+CHUNKSIZE = 65536       #records inserted into the store at a time
+
+
+class HashingReader(object):
+    """
+    File wrapper computing the SHA1 digest of everything read through it
+    """
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.sha1 = hashlib.sha1()
+
+    def read(self, n = -1):
+        data = self.fh.read(n)
+        self.sha1.update(data)
+        return data
+
+    @property
+    def digest(self):
+        """Digest of the full file; reads any remaining bytes"""
+        while self.read(CHUNKSIZE):
+            pass
+        return self.sha1.hexdigest()
+
+
+def iter_records(fh):
+    """
+    Iterate over the records of a sidecar file
+    """
+    if ijson is not None:
+        return ijson.items(fh, 'item')
+    return iter(json.loads(fh.read()))
+
+
+def chunked(iterable, size = CHUNKSIZE):
+    """Split an iterable into lists of at most size items"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,351 @@
+"""
+Rasterized label masks of annotations, for training segmentation and detection models
+
+Every annotation is painted into a mask at the shape of the frames of its DICOM file,
+with the index of its label in a vocabulary, plus one; zero is background.
+All regions of a frame are painted at once, rather than one at a time: where regions with
+different labels overlap, the label later in the vocabulary is on top, and markers are on top of all. Masks are uint8,
+or uint16 for vocabularies of more than 255 labels, and written one frame at a time,
+as a memory-mapped .npy stack, as an .npz file with a member per frame, or run-length encoded.
+A whole directory tree is exported in a process pool, with a vocabulary shared by all files,
+written to labels.json in the output directory; by default the vocabulary of the project,
+if the archive has one, such that mask values are its label ids plus one.
+
+Usage:
+    python -m clinicalgraphics.masks <root> <output> [--format npz|npy|rle] [--labels a,b,c] [--radius R] [--processes N]
+"""
+
+import io
+import os
+import sys
+import json
+import zipfile
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from .datamodels import DataModel, Rectangle, Marker, Polygon, Freehand
+from .batch import find
+from .journal import atomic_write
+from . import vocabulary
+
+
+def dtype_for(labels):
+    """The smallest unsigned type holding the mask values of a vocabulary"""
+    return np.dtype(np.uint8 if len(labels) < 256 else np.uint16)
+
+
+def fill_boxes(mask, r0, r1, c0, c1, values):
+    """
+    Paint boxes of rows r0 up to r1 and columns c0 up to c1 into a mask, all at once
+    For each value, the coverage of all its boxes is the cumulative sum along both axes of a
+    difference array of their corners; overlapping boxes of different values are resolved
+    in order of value, so that the highest value is on top
+    """
+    h, w = mask.shape
+    r0, r1 = np.clip(r0, 0, h), np.clip(r1, 0, h)
+    c0, c1 = np.clip(c0, 0, w), np.clip(c1, 0, w)
+    keep = (r0 < r1) & (c0 < c1)
+    r0, r1, c0, c1, values = r0[keep], r1[keep], c0[keep], c1[keep], np.asarray(values)[keep]
+    for value in np.unique(values).tolist():
+        i = values == value
+        #the difference array spans the bounding box of the boxes of this value only
+        top, left, bottom, right = r0[i].min(), c0[i].min(), r1[i].max(), c1[i].max()
+        edges = np.zeros((bottom - top + 1, right - left + 1), np.int32)
+        np.add.at(edges, (r0[i] - top, c0[i] - left), 1)
+        np.add.at(edges, (r0[i] - top, c1[i] - left), -1)
+        np.add.at(edges, (r1[i] - top, c0[i] - left), -1)
+        np.add.at(edges, (r1[i] - top, c1[i] - left), 1)
+        covered = np.cumsum(np.cumsum(edges, axis=0, dtype=np.int32), axis=1, dtype=np.int32) > 0
+        mask[top:bottom, left:right][covered[:-1, :-1]] = value
+
+
+def rectangle_boxes(data):
+    """The boxes of rectangle rows, as (r0, r1, c0, c1); l0, h0 span the columns and l1, h1 the rows"""
+    return data['l1'], data['h1'], data['l0'], data['h0']
+
+
+def polygon_boxes(polygons, h):
+    """
+    The spans of pixels whose center lies inside a list of closed polygons, by the even-odd rule,
+    for all rows of all polygons at once, from the crossings of all their edges
+    Returns the spans as single row boxes (r0, r1, c0, c1), and the index of the polygon of each
+    """
+    if not polygons:
+        empty = np.zeros(0, np.int64)
+        return (empty, empty, empty, empty), empty
+    lengths = np.array([len(v) for v in polygons])
+    polygon = np.repeat(np.arange(len(polygons)), lengths)
+    a = np.concatenate(polygons).astype(np.float64)
+    #the next vertex of each vertex, closing each polygon
+    following = np.arange(len(a)) + 1
+    ends = np.cumsum(lengths)
+    following[ends - 1] = ends - lengths
+    b = a[following]
+
+    #edges cross the centers y + 0.5 of rows lo up to hi
+    lo = np.clip(np.ceil(np.minimum(a[:, 1], b[:, 1]) - 0.5), 0, h).astype(np.int64)
+    hi = np.clip(np.ceil(np.maximum(a[:, 1], b[:, 1]) - 0.5), 0, h).astype(np.int64)
+    count = np.maximum(hi - lo, 0)
+    edge = np.repeat(np.arange(len(a)), count)
+    row = lo[edge] + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+    a, b = a[edge], b[edge]
+    x = a[:, 0] + (row + 0.5 - a[:, 1]) * (b[:, 0] - a[:, 0]) / (b[:, 1] - a[:, 1])
+
+    #every row of a closed polygon has an even number of crossings; pair them up in order
+    order = np.lexsort((x, row, polygon[edge]))
+    x, row, polygon = x[order], row[order], polygon[edge][order]
+    #pixel j is inside a span if its center j + 0.5 lies within it
+    start = np.ceil(x[0::2] - 0.5).astype(np.int64)
+    stop = np.ceil(x[1::2] - 0.5).astype(np.int64)
+    row = row[0::2]
+    return (row, row + 1, start, stop), polygon[0::2]
+
+
+def fill_rectangles(mask, data, values):
+    """
+    Paint rectangle rows into a mask; l0, h0 span the columns and l1, h1 the rows
+    """
+    fill_boxes(mask, *(rectangle_boxes(data) + (values,)))
+
+
+def fill_polygons(mask, polygons, values):
+    """
+    Paint closed polygons into a mask; pixels whose center lies inside one are set
+    """
+    boxes, polygon = polygon_boxes(polygons, mask.shape[0])
+    fill_boxes(mask, *(boxes + (np.asarray(values)[polygon],)))
+
+
+def fill_markers(mask, data, values, radius = 0):
+    """
+    Paint marker rows into a mask, as disks of the given radius, all at once
+    """
+    h, w = mask.shape
+    o = np.arange(-radius, radius + 1)
+    o0, o1 = [a.ravel() for a in np.meshgrid(o, o)]
+    disk = o0 ** 2 + o1 ** 2 <= radius ** 2
+    cols = (data['c0'][:, None] + o0[disk]).ravel()
+    rows = (data['c1'][:, None] + o1[disk]).ravel()
+    values = np.repeat(values, disk.sum())
+    inside = (rows >= 0) & (rows < h) & (cols >= 0) & (cols < w)
+    mask[rows[inside], cols[inside]] = values[inside]
+
+
+def rasterize(datamodel, labels, radius = 0):
+    """
+    Yield a label mask for each frame of a datamodel, one at a time
+    labels is the vocabulary; annotations with other labels are not painted
+    """
+    store = datamodel._annotations
+    strings = store.labels.strings
+    ids = dict((l, i + 1) for i, l in enumerate(labels))
+    lut = np.array([ids.get(l, 0) for l in strings] + [0], np.int64)
+    dtype = dtype_for(labels)
+    shape = datamodel.shape[:2]
+
+    tables = [(cls, store.table(cls)) for cls in [Rectangle, Polygon, Freehand, Marker]]
+    live = [(cls, table, table.data[~table.data['removed']]) for cls, table in tables]
+    for frame in range(datamodel.frames):
+        mask = np.zeros(shape, dtype)
+        boxes, polygons, labels = [], [], []
+        for cls, table, data in live:
+            data = data[(data['frame'] == frame) & (lut[data['label']] > 0)]
+            if cls is Marker:
+                markers = data
+            elif cls is Rectangle:
+                boxes.append(rectangle_boxes(data) + (lut[data['label']],))
+            else:
+                polygons.extend(table.contours[i] + (l0, l1) for i, l0, l1 in
+                                zip(data['contour'].tolist(), data['l0'].tolist(), data['l1'].tolist()))
+                labels.append(data['label'])
+        #a single pass over the edges of all polygon and freehand regions of the frame
+        spans, polygon = polygon_boxes(polygons, shape[0])
+        boxes.append(spans + (lut[np.concatenate(labels)][polygon],))
+        fill_boxes(mask, *[np.concatenate(b) for b in zip(*boxes)])
+        fill_markers(mask, markers, lut[markers['label']], radius)
+        yield frame, mask
+
+
+def rle_encode(mask):
+    """
+    Run-length encode a mask, in row-major order
+    Returns the value and length of each run
+    """
+    flat = mask.ravel()
+    starts = np.flatnonzero(np.concatenate([[True], flat[1:] != flat[:-1]]))
+    lengths = np.diff(np.append(starts, len(flat))).astype(np.uint32)
+    return flat[starts], lengths
+
+
+def rle_decode(values, lengths, shape):
+    """Decode a run-length encoded mask"""
+    return np.repeat(values, lengths).reshape(shape)
+
+
+class NpzWriter(object):
+    """
+    Writes the masks of the frames of a file as members frame_00000, frame_00001, ... of an .npz file
+    Frames are compressed and added one at a time
+    """
+
+    extension = '.npz'
+
+    def __init__(self, path, shape, dtype, labels):
+        self.zf = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.add('labels', np.array(labels, dtype=np.unicode_))
+
+    def add(self, name, array):
+        buf = io.BytesIO()
+        np.lib.format.write_array(buf, np.asarray(array))
+        self.zf.writestr(name + '.npy', buf.getvalue())
+
+    def write(self, frame, mask):
+        self.add('frame_{0:05d}'.format(frame), mask)
+
+    def close(self):
+        self.zf.close()
+
+
+class RLEWriter(NpzWriter):
+    """
+    Writes run-length encoded masks, as members values_00000 and lengths_00000 per frame
+    of an .npz file, with the shape of a frame as member shape
+    """
+
+    def __init__(self, path, shape, dtype, labels):
+        super(RLEWriter, self).__init__(path, shape, dtype, labels)
+        self.add('shape', np.array(shape[1:], np.int64))
+
+    def write(self, frame, mask):
+        values, lengths = rle_encode(mask)
+        self.add('values_{0:05d}'.format(frame), values)
+        self.add('lengths_{0:05d}'.format(frame), lengths)
+
+
+class NpyWriter(object):
+    """
+    Writes the masks of all frames into a single memory-mapped (frames, rows, columns) .npy array
+    """
+
+    extension = '.npy'
+
+    def __init__(self, path, shape, dtype, labels):
+        self.array = np.lib.format.open_memmap(path, 'w+', dtype, shape)
+
+    def write(self, frame, mask):
+        self.array[frame] = mask
+
+    def close(self):
+        self.array.flush()
+        del self.array
+
+
+WRITERS = {
+    'npz':  NpzWriter,
+    'npy':  NpyWriter,
+    'rle':  RLEWriter,
+}
+
+
+def export_file(datapath, metadatapath, output, labels, format = 'npz', radius = 0):
+    """
+    Rasterize the annotations of a single file, and write them to output
+    Returns the number of annotations painted
+    """
+    datamodel = DataModel(datapath, metadatapath)
+    shape = (datamodel.frames,) + datamodel.shape[:2]
+    writer = WRITERS[format](output, shape, dtype_for(labels), labels)
+    try:
+        for frame, mask in rasterize(datamodel, labels, radius):
+            writer.write(frame, mask)
+    finally:
+        writer.close()
+    vocabulary = set(labels)
+    return sum(1 for r in datamodel._annotations.to_json() if r['label'] in vocabulary)
+
+
+def read_labels(paths):
+    """Return the set of labels used in a sidecar file, and an error or None"""
+    datapath, metadatapath = paths
+    try:
+        return set(r['label'] for r in DataModel(None, metadatapath)._annotations.to_json()), None
+    except Exception as e:
+        return set(), '{0}: {1}'.format(metadatapath, e)
+
+
+def _export(task):
+    """Export a single file in a worker process; failures are reported rather than raised"""
+    datapath, metadatapath, output, labels, format, radius = task
+    try:
+        directory = os.path.dirname(output)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+        return export_file(datapath, metadatapath, output, labels, format, radius), None
+    except Exception as e:
+        return 0, '{0}: {1}'.format(metadatapath, e)
+
+
+def export(root, output, labels = None, format = 'npz', radius = 0, processes = None, chunksize = 4):
+    """
+    Export label masks of all annotated DICOM files below root, to the same relative paths below output
+    If no vocabulary is given, the project vocabulary in root is used, or if there is none,
+    all labels in use, in sorted order
+    Returns the number of files processed, annotations painted and a list of errors
+    """
+    if labels is None and os.path.exists(os.path.join(root, vocabulary.FILENAME)):
+        labels = vocabulary.Vocabulary.load(root).strings
+    pairs = [(d, m) for d, m in find(root) if d is not None]
+    errors = []
+    pool = multiprocessing.Pool(processes)
+    try:
+        if labels is None:
+            used = set()
+            for found, error in pool.imap_unordered(read_labels, pairs, chunksize):
+                used |= found
+                if error:
+                    errors.append(error)
+            labels = sorted(used)
+        if not os.path.isdir(output):
+            os.makedirs(output)
+        atomic_write(os.path.join(output, 'labels.json'), json.dumps(labels, indent=4))
+
+        extension = WRITERS[format].extension
+        tasks = [(d, m, os.path.join(output, os.path.splitext(os.path.relpath(m, root))[0] + extension),
+                  labels, format, radius) for d, m in pairs]
+        files, annotations = 0, 0
+        for painted, error in pool.imap_unordered(_export, tasks, chunksize):
+            files += 1
+            annotations += painted
+            if error:
+                errors.append(error)
+    finally:
+        pool.close()
+        pool.join()
+    return files, annotations, errors
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Export annotations as rasterized label masks')
+    parser.add_argument('root', help='directory to scan for DICOM files with sidecar files')
+    parser.add_argument('output', help='directory to write the masks to')
+    parser.add_argument('--format', choices=sorted(WRITERS), default='npz')
+    parser.add_argument('--labels', default=None, help='comma separated vocabulary; by default all labels in use')
+    parser.add_argument('--radius', type=int, default=0, help='radius of the disks painted for markers')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    labels = args.labels.split(',') if args.labels else None
+    files, annotations, errors = export(args.root, args.output, labels, args.format, args.radius, args.processes)
+    for e in errors:
+        sys.stderr.write(e + '\n')
+    sys.stdout.write('{0} annotations from {1} files, {2} errors\n'.format(annotations, files, len(errors)))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,256 @@
+"""
+DICOM pixel data access
+Only the header is parsed up front; pixel data is memory-mapped straight from the file
+for uncompressed transfer syntaxes, and decoded on first access for compressed ones
+Multi-frame data is accessed per frame, through a bounded cache of decoded frames,
+shared by all files; see decoders for the supported compressed transfer syntaxes
+
+The pixel data is held once, in a read-only array; the datamodel, the pyramid,
+the display pipeline and the export paths all share views on it
+"""
+
+import os
+import struct
+import threading
+
+import numpy as np
+import dicom
+
+from instrument import timed
+import decoders
+
+
+PIXEL_DATA = (0x7FE0, 0x0010)
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+#transfer syntaxes storing native, unencapsulated pixel data
+UNCOMPRESSED = set([
+    '1.2.840.10008.1.2',        #implicit VR little endian
+    '1.2.840.10008.1.2.1',      #explicit VR little endian
+    '1.2.840.10008.1.2.2',      #explicit VR big endian
+])
+
+READAHEAD = 4       #frames decoded together when a compressed frame is not cached
+
+DICOM_EXTENSIONS = ('', '.dcm', '.dicom')   #extensions of DICOM files, in any case, in order of preference
+
+
+def is_dicom(name):
+    """Whether a file name is that of a DICOM file, judged by its extension"""
+    return os.path.splitext(name)[1].lower() in DICOM_EXTENSIONS
+
+
+def walk(root):
+    """
+    Yield (dirpath, filenames) for all directories below root, in sorted order
+    Hidden files and directories, such as the index and the project vocabulary, are skipped;
+    the batch export, the index and worklists all discover the files of an archive this way
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        yield dirpath, sorted(f for f in filenames if not f.startswith('.'))
+
+
+def find(root):
+    """Yield the paths of all DICOM files below root"""
+    for dirpath, filenames in walk(root):
+        for name in filenames:
+            if is_dicom(name):
+                yield os.path.join(dirpath, name)
+
+
+def read_header(path):
+    """
+    Read the DICOM elements preceding the pixel data
+    Returns the header dataset and the file offset of the pixel data element
+    """
+    with open(path, 'rb') as fh:
+        header = dicom.read_file(fh, stop_before_pixels=True)
+        offset = fh.tell()
+    return header, offset
+
+
+class PixelData(object):
+    """
+    Lazy accessor for the pixel data of a DICOM file
+    """
+
+    def __init__(self, path, header, offset):
+        self.path = path
+        self.header = header
+        self.offset = offset
+        self._array = None
+        self._lock = threading.Lock()
+        self._fragments = None
+
+    @property
+    def transfer_syntax(self):
+        try:
+            return self.header.file_meta.TransferSyntaxUID
+        except AttributeError:
+            return '1.2.840.10008.1.2'
+
+    @property
+    def compressed(self):
+        """Whether the pixel data is encapsulated, and needs decoding"""
+        return self.transfer_syntax not in UNCOMPRESSED
+
+    @property
+    def uid(self):
+        """Key of the decoded frames of this file in the frame cache"""
+        return getattr(self.header, 'SOPInstanceUID', None) or self.path
+
+    @property
+    def frames(self):
+        """The number of frames"""
+        return int(getattr(self.header, 'NumberOfFrames', 1) or 1)
+
+    @property
+    def frame_shape(self):
+        """The shape of a single frame"""
+        h = self.header
+        shape = (h.Rows, h.Columns)
+        samples = getattr(h, 'SamplesPerPixel', 1)
+        if samples > 1:
+            shape = shape + (samples,)
+        return shape
+
+    @property
+    def shape(self):
+        """The shape of all pixel data; frames form the leading axis of multi-frame data"""
+        return ((self.frames,) if self.frames > 1 else ()) + self.frame_shape
+
+    @property
+    def dtype(self):
+        h = self.header
+        kind = 'i' if getattr(h, 'PixelRepresentation', 0) == 1 else 'u'
+        order = '<' if self.header.is_little_endian else '>'
+        return np.dtype('{0}{1}{2}'.format(order, kind, h.BitsAllocated // 8))
+
+    def _value_offset(self):
+        """
+        Parse the pixel data element header
+        Returns the file offset and length of its value
+        """
+        h = self.header
+        order = '<' if h.is_little_endian else '>'
+        with open(self.path, 'rb') as fh:
+            fh.seek(self.offset)
+            tag = struct.unpack(order + 'HH', fh.read(4))
+            if tag != PIXEL_DATA:
+                raise Exception('No pixel data found in {0}'.format(self.path))
+            if h.is_implicit_VR:
+                length, = struct.unpack(order + 'L', fh.read(4))
+            else:
+                fh.read(4)      #VR and reserved bytes
+                length, = struct.unpack(order + 'L', fh.read(4))
+            return fh.tell(), length
+
+    def _map(self):
+        """
+        Memory-map uncompressed pixel data, without reading it
+        """
+        offset, length = self._value_offset()
+        if length == UNDEFINED_LENGTH:
+            return self._decode()
+        shape = self.shape
+        samples = getattr(self.header, 'SamplesPerPixel', 1)
+        if samples > 1 and getattr(self.header, 'PlanarConfiguration', 0) == 1:
+            planar = shape[:-3] + (samples,) + shape[-3:-1]
+            array = np.memmap(self.path, self.dtype, 'r', offset, planar)
+            return np.rollaxis(array, -3, len(shape))
+        return np.memmap(self.path, self.dtype, 'r', offset, shape)
+
+    def _format(self):
+        return decoders.Format.from_header(self.header, self.dtype)
+
+    def _compressed_frames(self):
+        """The compressed data of each frame, read from the file once"""
+        if self._fragments is None:
+            offset, length = self._value_offset()
+            self._fragments = decoders.read_frames(self.path, offset, self.frames)
+        return self._fragments
+
+    @timed('decode')
+    def _decode(self):
+        """
+        Decode compressed pixel data, with a registered decoder if there is one,
+        or else using pydicom
+        """
+        if decoders.decoder_for(self.transfer_syntax) is None:
+            array = dicom.read_file(self.path).pixel_array
+        else:
+            frames = decoders.decode_frames(self.transfer_syntax, self._compressed_frames(), self._format())
+            array = np.array(frames) if self.frames > 1 else frames[0]
+            self._fragments = None
+        array.flags.writeable = False
+        return array
+
+    @property
+    def array(self):
+        """
+        The pixel data as a read-only array; mapped or decoded on first access
+        Safe to access from multiple threads; the data is only decoded once
+        """
+        with self._lock:
+            if self._array is None:
+                self._array = self._decode() if self.compressed else self._map()
+            return self._array
+
+    @property
+    def loaded(self):
+        return self._array is not None
+
+    @property
+    def nbytes(self):
+        """Size of all pixel data, once mapped or decoded"""
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def frame(self, i):
+        """
+        Return frame i
+        Uncompressed frames are views on the memory-mapped file; compressed frames are
+        decoded on demand, and kept in the shared frame cache
+        """
+        if not 0 <= i < self.frames:
+            raise IndexError('Frame {0} out of range'.format(i))
+        if self.frames == 1:
+            return self.array
+        if not self.compressed:
+            return self.array[i]
+        return decoders.cache.get((self.uid, i), self._decode_frame)
+
+    def preview_step(self, size = 256):
+        """The stride with which frames are subsampled for a preview of the given size"""
+        return max(1, int(np.ceil(max(self.frame_shape[:2]) / float(size))))
+
+    def preview(self, i = 0, size = 256):
+        """
+        Return a low resolution copy of frame i, of at most size pixels along each axis
+        The frame is subsampled with a stride, so that only a fraction of the rows of a mapped file is read
+        """
+        step = self.preview_step(size)
+        return np.array(self.frame(i)[::step, ::step])
+
+    @timed('decode_frame')
+    def _decode_frame(self, key):
+        """
+        Decode a compressed frame, given its cache key, along with the next READAHEAD - 1 frames
+        not yet cached; these are decoded in parallel, and stored in the frame cache ahead of use
+        Without a registered decoder, this falls back to decoding all frames with pydicom,
+        and returns a view on the decoded array, rather than a copy
+        """
+        uid, i = key
+        if self.loaded or decoders.decoder_for(self.transfer_syntax) is None:
+            return self.array[i]
+        window = [i] + [j for j in range(i + 1, min(i + READAHEAD, self.frames))
+                        if (uid, j) not in decoders.cache]
+        with self._lock:
+            compressed = self._compressed_frames()
+            data = [compressed[j] for j in window]
+        frames = decoders.decode_frames(self.transfer_syntax, data, self._format())
+        for frame in frames:
+            frame.flags.writeable = False
+        for j, frame in zip(window[1:], frames[1:]):
+            decoders.cache.put((uid, j), frame)
+        return frames[0]
@@ -0,0 +1,130 @@
+"""
+Multi-resolution image pyramids for display
+Large images are shown at the coarsest level that still matches the screen resolution
+
+Level 0 is the pixel data itself, not a copy; the other levels are read-only as well,
+as they are shared between threads and editors
+"""
+
+import os
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from instrument import timed
+
+
+@timed('downsample')
+def downsample(image):
+    """
+    Halve the resolution of an image by averaging 2x2 blocks
+    A trailing odd row or column is kept, averaged over the pixels of its partial blocks,
+    so that pixel i of the result always covers pixels 2i and 2i+1 of the image
+    """
+    h, w = image.shape[0] // 2, image.shape[1] // 2
+    result = np.empty(((image.shape[0] + 1) // 2, (image.shape[1] + 1) // 2) + image.shape[2:], image.dtype)
+    blocks = image[:h*2, :w*2].reshape((h, 2, w, 2) + image.shape[2:])
+    result[:h, :w] = blocks.mean(axis=(1, 3), dtype=np.float32)
+    if image.shape[1] % 2:
+        result[:h, w] = image[:h*2, -1].reshape((h, 2) + image.shape[2:]).mean(axis=1, dtype=np.float32)
+    if image.shape[0] % 2:
+        result[h, :w] = image[-1, :w*2].reshape((w, 2) + image.shape[2:]).mean(axis=1, dtype=np.float32)
+        if image.shape[1] % 2:
+            result[h, w] = image[-1, -1]
+    return result
+
+
+class Pyramid(object):
+    """
+    Image pyramid, with levels computed on first access
+    Level k has a resolution 2**k times lower than the full resolution image at level 0;
+    pixel i of level k covers pixels i*2**k up to (i+1)*2**k of level 0, clipped to the image
+    Levels may be requested from multiple threads
+    """
+
+    def __init__(self, image, minsize = 256):
+        self._lock = threading.Lock()
+        self.levels = [image]
+        size = max(image.shape[:2])
+        self.depth = 1 + max(0, int(math.ceil(math.log(float(size) / minsize, 2)))) if size else 1
+
+    def __len__(self):
+        return self.depth
+
+    def __getitem__(self, level):
+        with self._lock:
+            while len(self.levels) <= level:
+                image = downsample(self.levels[-1])
+                image.flags.writeable = False
+                self.levels.append(image)
+            return self.levels[level]
+
+    def level_for(self, scale):
+        """
+        Return the coarsest level which has at least one pixel per screen pixel,
+        given the scale of the view in full resolution pixels per screen pixel
+        """
+        if not scale > 1:
+            return 0
+        return min(int(math.floor(math.log(scale, 2))), self.depth - 1)
+
+
+def footprint(pixels, minsize = 256):
+    """
+    Estimate the memory used by an open image, in bytes, per component
+
+    mapped:     uncompressed pixel data mapped from the file; held in the page cache,
+                and shared between all editors with the same file open
+    decoded:    compressed pixel data, decoded into private memory
+    pyramid:    the downsampled levels of the displayed frame
+    display:    the RGBA display buffer when zoomed in to full resolution;
+                at lower zoom, the buffer of a coarser level replaces it
+    lut:        the lookup table of the display pipeline
+    transient:  the temporary float buffer when computing the first level
+    peak:       the sum of all private memory
+    """
+    h, w = pixels.frame_shape[:2]
+    samples = pixels.frame_shape[2] if len(pixels.frame_shape) > 2 else 1
+    itemsize = pixels.dtype.itemsize
+    size = max(h, w)
+    depth = 1 + max(0, int(math.ceil(math.log(float(size) / minsize, 2)))) if size else 1
+
+    pyramid, lh, lw = 0, h, w
+    for level in range(1, depth):
+        lh, lw = (lh + 1) // 2, (lw + 1) // 2
+        pyramid += lh * lw * samples * itemsize
+
+    estimate = OrderedDict([
+        ('mapped',      0 if pixels.compressed else pixels.nbytes),
+        ('decoded',     pixels.nbytes if pixels.compressed else 0),
+        ('pyramid',     pyramid),
+        ('display',     h * w * 4 if samples == 1 else 0),
+        ('lut',         4 * 2 ** (8 * itemsize) if samples == 1 and itemsize <= 2 else 0),
+        ('transient',   (h // 2) * (w // 2) * samples * 4 if depth > 1 else 0),
+    ])
+    estimate['peak'] = sum(v for k, v in estimate.items() if k != 'mapped')
+    return estimate
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+CACHE_SIZE = 8          #pyramids kept; matches the default worklist cache
+
+
+def get(path, image, frame = 0):
+    """
+    Return the pyramid for a frame of an image read from path
+    Pyramids are cached per file and frame, and invalidated when the file is modified
+    """
+    key = os.path.abspath(path), os.path.getmtime(path), frame
+    with _cache_lock:
+        try:
+            pyramid = _cache.pop(key)
+        except KeyError:
+            pyramid = Pyramid(image)
+        _cache[key] = pyramid
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return pyramid
@@ -0,0 +1,257 @@
+"""
+Binary sidecar files
+
+A compact alternative to the JSON sidecar, for large machine-generated annotation files.
+The file starts with a magic number, a format version and the length of a JSON header;
+the header holds the label string table and, per annotation type, the offset, type and
+shape of each of its columns. Columns are stored as little endian arrays, aligned to 8 bytes,
+so that they can be memory-mapped and used without parsing:
+    coordinate fields   int32, one column per field
+    label               int32 index into the label table
+    frame               int32
+    order               int64 position of the annotation in order of insertion
+Contour types store the vertices of all annotations as a single (n, 2) int32 column,
+and the offset of the vertices of each annotation in an (count + 1) int64 column.
+
+JSON remains the format for interchange; DataModel detects either format on load,
+and writes binary sidecars to paths with the .cgs extension.
+
+Usage:
+    python -m clinicalgraphics.sidecar <input> <output>
+    python -m clinicalgraphics.sidecar <root> --to cgs|json [--replace]
+"""
+
+import os
+import sys
+import json
+import struct
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+from store import InvalidAnnotation, ContourTable
+from journal import atomic_write
+import pixels
+
+
+MAGIC = b'\x89CGS\r\n\x1a\n'
+VERSION = 1
+EXTENSION = '.cgs'
+EXTENSIONS = ('.json', EXTENSION)   #extensions of sidecar files, in order of preference for reading
+PREAMBLE = struct.Struct('<8sII')   #magic, version, header length
+ALIGN = 8
+
+
+def is_binary(path):
+    """Whether a file is a binary sidecar, judged by its magic number"""
+    try:
+        with open(path, 'rb') as fh:
+            return fh.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+def sidecar_path(datapath):
+    """
+    The sidecar file of a DICOM file; the binary one if it exists, otherwise the JSON one
+    """
+    stem = os.path.splitext(datapath)[0]
+    if os.path.exists(stem + EXTENSION) and not os.path.exists(stem + '.json'):
+        return stem + EXTENSION
+    return stem + '.json'
+
+
+def columns(store):
+    """
+    Return the live annotations of a store as columns per type, in order of insertion,
+    and the label strings they refer to
+    """
+    tables, rows = store._ordered()
+    used = np.zeros(len(store.labels) + 1, np.bool_)
+    result = OrderedDict()
+    for t, table in enumerate(store.tables.values()):
+        order = np.flatnonzero(tables == t)
+        if not len(order):
+            continue
+        data = table._data[rows[order]]
+        c = OrderedDict((f, data[f]) for f in table.cls.fields)
+        if isinstance(table, ContourTable):
+            vertices = [table.contours[i] + (l0, l1) for i, l0, l1 in
+                        zip(data['contour'].tolist(), data['l0'].tolist(), data['l1'].tolist())]
+            c['offsets'] = np.cumsum([0] + [len(v) for v in vertices]).astype(np.int64)
+            c['vertices'] = np.concatenate(vertices).astype(np.int32)
+        c['label'] = data['label']
+        c['frame'] = data['frame']
+        c['order'] = order.astype(np.int64)
+        used[data['label']] = True
+        result[table.cls.__name__] = c
+    #compact label table, of the labels in use only
+    ids = np.flatnonzero(used[:-1])
+    lut = np.zeros(len(used), np.int32)
+    lut[ids] = np.arange(len(ids))
+    for c in result.values():
+        c['label'] = lut[c['label']]
+    return result, [store.labels[i] for i in ids.tolist()]
+
+
+def dumps(store):
+    """Serialize the live annotations of a store to a binary sidecar"""
+    types, labels = columns(store)
+    blocks, header = [], {'labels': labels, 'types': OrderedDict()}
+    offset = 0
+    for name, c in types.items():
+        entry = header['types'][name] = OrderedDict()
+        for column, array in c.items():
+            array = np.ascontiguousarray(array, array.dtype.newbyteorder('<'))
+            entry[column] = [offset, array.dtype.str, list(array.shape)]
+            data = array.tostring()
+            data += b'\0' * (-len(data) % ALIGN)
+            blocks.append(data)
+            offset += len(data)
+    text = json.dumps(header, separators=(',', ':'))
+    text += ' ' * (-(PREAMBLE.size + len(text)) % ALIGN)
+    return PREAMBLE.pack(MAGIC, VERSION, len(text)) + text + b''.join(blocks)
+
+
+def write(path, store):
+    atomic_write(path, dumps(store))
+
+
+class Sidecar(object):
+    """
+    Memory-mapped binary sidecar file
+    Columns are read-only views on the file; nothing is read until they are accessed
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.map = np.memmap(path, np.uint8, 'r')
+        magic, version, length = PREAMBLE.unpack(self.map[:PREAMBLE.size].tostring())
+        if magic != MAGIC:
+            raise InvalidAnnotation('{0} is not a binary sidecar file'.format(path))
+        if version > VERSION:
+            raise InvalidAnnotation('Binary sidecar version {0} is not supported'.format(version))
+        self.version = version
+        try:
+            header = json.loads(self.map[PREAMBLE.size:PREAMBLE.size + length].tostring(),
+                                object_pairs_hook=OrderedDict)
+        except ValueError:
+            raise InvalidAnnotation('Corrupt binary sidecar header')
+        self.labels = header['labels']
+        self.start = PREAMBLE.size + length
+        self._types = header['types']
+
+    @property
+    def types(self):
+        return list(self._types)
+
+    def column(self, name, column):
+        """A column of an annotation type, as a read-only array"""
+        offset, dtype, shape = self._types[name][column]
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        start = self.start + offset
+        if start + count * dtype.itemsize > len(self.map):
+            raise InvalidAnnotation('Truncated binary sidecar')
+        return self.map[start:start + count * dtype.itemsize].view(dtype).reshape(shape)
+
+    def columns(self, name, fields):
+        """
+        Return the columns of an annotation type, as taken by AnnotationStore.load_columns
+        """
+        c = dict((k, self.column(name, k)) for k in ('label', 'frame', 'order'))
+        if 'vertices' in self._types[name]:
+            offsets = self.column(name, 'offsets')
+            vertices = self.column(name, 'vertices')
+            if len(offsets) != len(c['order']) + 1 or offsets[-1] != len(vertices) or \
+                    (np.diff(offsets) < 3).any():
+                raise InvalidAnnotation('Invalid vertices in binary sidecar')
+            c['coords'] = np.split(vertices, offsets[1:-1])
+        else:
+            c['coords'] = np.column_stack([self.column(name, f) for f in fields])
+        n = len(c['order'])
+        if any(len(c[k]) != n for k in c) or (n and (
+                c['label'].min() < 0 or c['label'].max() >= len(self.labels) or c['frame'].min() < 0)):
+            raise InvalidAnnotation('Invalid columns in binary sidecar')
+        return c
+
+
+def load(store, path):
+    """
+    Load a binary sidecar file into an empty store
+    All columns are checked before any annotation is inserted;
+    raises InvalidAnnotation if the file is not a valid binary sidecar
+    """
+    try:
+        sidecar = Sidecar(path)
+        types = OrderedDict()
+        for name in sidecar.types:
+            try:
+                fields = store.tables[name].cls.fields
+            except KeyError:
+                raise InvalidAnnotation('Invalid annotation type', 'type')
+            types[name] = sidecar.columns(name, fields)
+    except (KeyError, TypeError, ValueError, struct.error) as e:
+        raise InvalidAnnotation('Corrupt binary sidecar: {0}'.format(e), 'corrupt')
+    store.load_columns(types, sidecar.labels)
+
+
+def convert(src, dst):
+    """
+    Convert a sidecar file to the format given by the extension of dst
+    """
+    from datamodels import DataModel
+    datamodel = DataModel(None, src)
+    datamodel.metadatapath = dst
+    datamodel.save()
+
+
+def convert_all(root, to = 'cgs', replace = False):
+    """
+    Convert the sidecar of every DICOM file below root to the given format, 'cgs' or 'json'
+    Only the sidecar file DataModel would load is converted; other files, such as the project
+    vocabulary or reports, are not touched. With replace, the source file is removed once
+    converted, so that the converted file is loaded from then on
+    Returns the number of files converted, and a list of (path, error) tuples of the files that failed
+    """
+    target = '.' + to
+    converted, errors = 0, []
+    for datapath in pixels.find(root):
+        src = sidecar_path(datapath)
+        if not os.path.exists(src) or os.path.splitext(src)[1] == target:
+            continue
+        try:
+            if replace and os.path.exists(src + '.journal'):
+                raise InvalidAnnotation('Sidecar has a journal of unsaved edits')
+            convert(src, os.path.splitext(src)[0] + target)
+            if replace:
+                os.remove(src)
+        except (InvalidAnnotation, IOError, OSError) as e:
+            errors.append((src, e))
+            continue
+        converted += 1
+    return converted, errors
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Convert sidecar files between the JSON and binary formats')
+    parser.add_argument('input', help='sidecar file, or directory to convert the sidecar files of all DICOM files below')
+    parser.add_argument('output', nargs='?', default=None, help='converted sidecar file')
+    parser.add_argument('--to', choices=['cgs', 'json'], default='cgs', help='format to convert a directory to')
+    parser.add_argument('--replace', action='store_true',
+                        help='remove the source files once converted; a JSON sidecar is loaded in preference to a binary one')
+    args = parser.parse_args(argv)
+
+    if args.output is not None:
+        convert(args.input, args.output)
+        return 0
+    converted, errors = convert_all(args.input, args.to, args.replace)
+    for path, e in errors:
+        sys.stderr.write('{0}: {1}\n'.format(path, e))
+    sys.stdout.write('{0} files converted, {1} failed\n'.format(converted, len(errors)))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+"""
+Spatial indexing of annotations
+Accelerates hit-testing when a dataset contains many annotations
+"""
+
+import math
+
+
+class GridIndex(object):
+    """
+    Uniform grid over the bounding boxes of a collection of items
+
+    Every item is registered in each cell overlapped by its bounds,
+    such that a point query only needs to consider the items in a single cell
+    """
+
+    def __init__(self, cellsize = 256):
+        self.cellsize = float(cellsize)
+        self._cells = {}    #cell key -> set of items
+        self._keys = {}     #item -> list of cell keys it is registered in
+
+    def _span(self, bounds):
+        """
+        Return the keys of all cells overlapped by the bounds (l0, h0, l1, h1)
+        """
+        l0, h0, l1, h1 = bounds
+        s = self.cellsize
+        return [(i, j)
+                for i in range(int(math.floor(l0 / s)), int(math.floor(h0 / s)) + 1)
+                for j in range(int(math.floor(l1 / s)), int(math.floor(h1 / s)) + 1)]
+
+    def _cell(self, p):
+        """The key of the cell containing the point p"""
+        return tuple(int(math.floor(c / self.cellsize)) for c in p)
+
+    def insert(self, item, bounds):
+        """
+        Register an item with the given bounds
+        """
+        keys = self._span(bounds)
+        for k in keys:
+            self._cells.setdefault(k, set()).add(item)
+        self._keys[item] = keys
+
+    def remove(self, item):
+        """
+        Unregister an item; unknown items are ignored
+        """
+        for k in self._keys.pop(item, []):
+            cell = self._cells[k]
+            cell.discard(item)
+            if not cell:
+                del self._cells[k]
+
+    def update(self, item, bounds):
+        """
+        Re-register an item whose bounds have changed
+        """
+        self.remove(item)
+        self.insert(item, bounds)
+
+    def query(self, p):
+        """
+        Return the set of items whose bounds may contain the point p
+        """
+        return self._cells.get(self._cell(p), set())
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, item):
+        return item in self._keys
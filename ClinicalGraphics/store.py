@@ -0,0 +1,583 @@
+"""
+Columnar annotation storage
+All annotations of a given type share a single NumPy structured array,
+with one row per annotation; annotation objects are thin proxies onto these rows
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+from spatial import GridIndex
+import contours
+
+
+class InvalidAnnotation(Exception):
+    """
+    Raised for annotation records which do not match the schema of their type
+    code identifies the kind of problem, attrs is the offending record,
+    and index its position in the sidecar file, where known
+    """
+
+    def __init__(self, message, code = 'invalid', attrs = None, index = None):
+        super(InvalidAnnotation, self).__init__(message)
+        self.code = code
+        self.attrs = attrs
+        self.index = index
+
+    def to_json(self):
+        return {'code': self.code, 'message': str(self), 'index': self.index}
+
+
+class Selection(object):
+    """
+    Set of annotations in a store, as arrays of row indices per table
+    """
+
+    def __init__(self, store, rows = None):
+        self.store = store
+        self.rows = OrderedDict((name, np.asarray(rows.get(name, ()), np.int64) if rows else np.zeros(0, np.int64))
+                                for name in store.tables)
+
+    def __len__(self):
+        return sum(len(r) for r in self.rows.values())
+
+    def __iter__(self):
+        """The annotation objects of the selection"""
+        for name, rows in self.rows.items():
+            table = self.store.tables[name]
+            for r in rows:
+                yield table.proxy(r)
+
+    def items(self):
+        """(table, rows) pairs"""
+        return [(self.store.tables[name], rows) for name, rows in self.rows.items()]
+
+
+class LabelTable(object):
+    """
+    Table of interned label strings
+    Annotations refer to their label by integer id
+    """
+
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def intern(self, label):
+        """Return the id of a label string, adding it to the table if needed"""
+        try:
+            return self.ids[label]
+        except KeyError:
+            i = self.ids[label] = len(self.strings)
+            self.strings.append(label)
+            return i
+
+    def __getitem__(self, i):
+        return self.strings[i]
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class Table(object):
+    """
+    Growable structured array holding all annotations of a single type
+
+    Each row holds the (pixel) coordinate fields of the annotation type,
+    the frame it is drawn on, its label id, its insertion sequence number
+    and its selected and removed flags
+    """
+
+    columns = []    #additional columns of subclasses, as (name, dtype)
+
+    def __init__(self, cls, labels, indexed = True, capacity = 16):
+        self.cls = cls
+        self.labels = labels
+        self.dtype = np.dtype(
+            [(f, np.int32) for f in cls.fields] + self.columns +
+            [('frame', np.int32), ('label', np.int32), ('seq', np.int64), ('selected', np.bool_), ('removed', np.bool_)])
+        self._data = np.zeros(capacity, self.dtype)
+        self.size = 0
+        self.proxies = {}       #row -> annotation object, created on demand
+        self.index = GridIndex() if indexed else None
+
+    @property
+    def data(self):
+        """View on the rows in use"""
+        return self._data[:self.size]
+
+    def _reserve(self, n):
+        """Make room for n additional rows"""
+        if self.size + n > len(self._data):
+            data = np.zeros(max(2 * len(self._data), self.size + n), self.dtype)
+            data[:self.size] = self._data[:self.size]
+            self._data = data
+
+    def coords(self, records):
+        """
+        Return the coordinates of a list of attribute dicts, in the form taken by extend
+        """
+        fields = self.cls.fields
+        return np.array([[attrs[f] for f in fields] for attrs in records], np.int32).reshape(-1, len(fields))
+
+    def extend(self, coords, labels, seq, frames = 0):
+        """
+        Append rows in bulk
+        coords is an (n, len(fields)) array, labels a sequence of n label strings,
+        seq the n sequence numbers of the new rows, and frames their frame indices
+        Returns the array of new row indices
+        """
+        return self.insert(coords, [self.labels.intern(l) for l in labels], seq, frames)
+
+    def insert(self, coords, ids, seq, frames = 0):
+        """
+        Append rows in bulk, as extend, given the ids of their labels in the label table
+        """
+        n = len(ids)
+        coords = np.asarray(coords).reshape(n, len(self.cls.fields))
+        self._reserve(n)
+        rows = np.arange(self.size, self.size + n)
+        data = self._data
+        for i, f in enumerate(self.cls.fields):
+            data[f][rows] = coords[:, i]
+        data['frame'][rows] = frames
+        data['label'][rows] = ids
+        data['seq'][rows] = seq
+        data['selected'][rows] = False
+        data['removed'][rows] = False
+        self.size += n
+        self.reindex(rows)
+        return rows
+
+    def reindex(self, rows):
+        """
+        Update the spatial index for the given rows
+        """
+        if self.index is None:
+            return
+        bounds = self.cls.column_bounds(self._data[rows])
+        for r, b in zip(np.asarray(rows).tolist(), bounds.tolist()):
+            self.index.update(r, b)
+
+    def translate(self, rows, delta):
+        """
+        Translate the given rows by delta, vectorized over the rows
+        """
+        data = self._data
+        for f, axis in zip(self.cls.fields, self.cls.axes):
+            data[f][rows] += delta[axis]
+        self.reindex(rows)
+
+    def scale(self, rows, factor, origin):
+        """
+        Scale the given rows by a positive factor per axis, relative to origin, vectorized over the rows
+        """
+        data = self._data
+        for f, axis in zip(self.cls.fields, self.cls.axes):
+            scaled = origin[axis] + (data[f][rows] - origin[axis]) * float(factor[axis])
+            data[f][rows] = np.round(scaled)
+        self.reindex(rows)
+
+    def remove(self, row):
+        """Drop a row from the spatial index; the row itself remains, flagged as removed"""
+        if self.index is not None:
+            self.index.remove(row)
+
+    def hit(self, p, frame = None):
+        """
+        Hit-test the rows near the position p, on the given frame if any
+        Returns the rows hit, and their distances to p
+        """
+        rows = np.array(sorted(self.index.query(p)), np.int64)
+        data = self._data[rows]
+        hit, distance = self.cls.column_hit(data, p)
+        hit &= ~data['removed']
+        if frame is not None:
+            hit &= data['frame'] == frame
+        return rows[hit], distance[hit]
+
+    def proxy(self, row):
+        """Return the annotation object for a row, creating it if needed"""
+        row = int(row)
+        try:
+            return self.proxies[row]
+        except KeyError:
+            a = self.proxies[row] = self.cls.proxy(self, row)
+            return a
+
+    def to_json(self, data):
+        """
+        Create JSON representations of a set of rows
+        The frame is only included for annotations beyond the first frame
+        """
+        fields = self.cls.fields
+        labels = self.labels.strings
+        name = self.cls.__name__
+        values = zip(*[data[f].tolist() for f in fields])
+        records = [dict(zip(fields, v), type=name, label=labels[l])
+                   for v, l in zip(values, data['label'].tolist())]
+        for r, frame in zip(records, data['frame'].tolist()):
+            if frame:
+                r['frame'] = frame
+        return records
+
+
+class ContourTable(Table):
+    """
+    Table of annotations with any number of vertices
+
+    The coordinate fields of each row hold the bounding box (l0, h0, l1, h1) of its vertices,
+    which are kept as a read-only (n, 2) array relative to the corner (l0, l1) of the box;
+    the contour column refers to this array. Translation therefore only touches the box.
+    Vertex arrays are never modified, but replaced, such that snapshots of rows remain valid
+    """
+
+    columns = [('contour', np.int32)]
+
+    def __init__(self, cls, labels, indexed = True, capacity = 16):
+        super(ContourTable, self).__init__(cls, labels, indexed, capacity)
+        self.contours = []
+
+    def _intern(self, vertices):
+        """Store a vertex array; returns its id and bounding box"""
+        vertices = np.asarray(vertices, np.int32).reshape(-1, 2)
+        lo, hi = vertices.min(axis=0), vertices.max(axis=0)
+        contour = vertices - lo
+        contour.flags.writeable = False
+        self.contours.append(contour)
+        return len(self.contours) - 1, (lo[0], hi[0], lo[1], hi[1])
+
+    def coords(self, records):
+        """The decoded vertex arrays of a list of attribute dicts"""
+        return [contours.decode(attrs['vertices']) for attrs in records]
+
+    def insert(self, coords, ids, seq, frames = 0):
+        """
+        Append rows in bulk
+        coords is a sequence of n vertex arrays, in absolute coordinates
+        """
+        interned = [self._intern(v) for v in coords]
+        boxes = np.array([box for i, box in interned], np.int32).reshape(-1, 4)
+        rows = super(ContourTable, self).insert(boxes, ids, seq, frames)
+        self._data['contour'][rows] = [i for i, box in interned]
+        return rows
+
+    def vertices(self, row):
+        """The vertices of a row, in absolute coordinates"""
+        data = self._data[row]
+        return self.contours[data['contour']] + np.array([data['l0'], data['l1']], np.int32)
+
+    def assign(self, row, vertices):
+        """Replace the vertices of a row"""
+        i, box = self._intern(vertices)
+        data = self._data
+        data['contour'][row] = i
+        for f, b in zip(self.cls.fields, box):
+            data[f][row] = b
+        self.reindex([row])
+
+    def scale(self, rows, factor, origin):
+        """
+        Scale the vertices of the given rows by a positive factor per axis, relative to origin
+        """
+        origin, factor = np.asarray(origin, np.float64), np.asarray(factor, np.float64)
+        for r in np.asarray(rows).tolist():
+            self.assign(r, np.round(origin + (self.vertices(r) - origin) * factor))
+
+    def hit(self, p, frame = None):
+        """
+        Hit-test the rows near the position p, on the given frame if any
+        Rows are prefiltered on their bounding box, and the remaining polygons
+        tested exactly; points inside a polygon are at distance zero
+        """
+        rows, distance = super(ContourTable, self).hit(p, frame)
+        if len(rows):
+            inside, edge = contours.distance([self.vertices(r) for r in rows], p)
+            distance = np.where(inside, 0, edge)
+            hit = distance < self.cls.distance
+            rows, distance = rows[hit], distance[hit]
+        return rows, distance
+
+    def to_json(self, data):
+        """
+        Create JSON representations of a set of rows
+        Records hold the encoded vertices, and their bounding box for convenience
+        """
+        records = super(ContourTable, self).to_json(data)
+        offsets = zip(data['l0'].tolist(), data['l1'].tolist())
+        for r, i, offset in zip(records, data['contour'].tolist(), offsets):
+            r['vertices'] = contours.encode(self.contours[i] + offset)
+        return records
+
+
+class AnnotationStore(object):
+    """
+    Collection of annotations, stored per type in columnar tables
+
+    Behaves as a sequence of annotation objects, in order of insertion;
+    annotation objects are only created when accessed
+    """
+
+    def __init__(self, types, labels = None):
+        """
+        types are the annotation classes stored; labels is the label table to intern labels in,
+        which may be shared with other stores, such as a project vocabulary
+        """
+        self.labels = LabelTable() if labels is None else labels
+        self.tables = OrderedDict((cls.__name__, cls.storage(cls, self.labels)) for cls in types)
+        self._seq = 0
+        self._order = None
+
+    def table(self, cls):
+        """The table holding annotations of the given type"""
+        return self.tables[cls.__name__]
+
+    def load(self, records):
+        """
+        Bulk-insert a list of attribute dicts, as read from a sidecar file
+        Records are dispatched on their type to the table of that type,
+        and validated against the schema of the type
+        """
+        groups = OrderedDict()
+        for i, attrs in enumerate(records):
+            try:
+                try:
+                    table = self.tables[attrs['type']]
+                except (KeyError, TypeError):
+                    raise InvalidAnnotation('Invalid annotation type', 'type', attrs)
+                table.cls.validate(attrs)
+            except InvalidAnnotation as e:
+                e.index = self._seq + i
+                raise
+            groups.setdefault(table, []).append((i, attrs))
+
+        #convert all coordinates before inserting any, so that a failure leaves the tables untouched
+        try:
+            coords = [table.coords([attrs for i, attrs in group]) for table, group in groups.items()]
+        except (ValueError, TypeError, OverflowError, ArithmeticError) as e:
+            raise InvalidAnnotation('Invalid coordinates: {0}'.format(e), 'coordinates')
+        for (table, group), c in zip(groups.items(), coords):
+            labels = [attrs['label'] for i, attrs in group]
+            frames = [attrs.get('frame', 0) for i, attrs in group]
+            seq = self._seq + np.array([i for i, attrs in group], np.int64)
+            table.extend(c, labels, seq, frames)
+
+        self._seq += len(records)
+        self._order = None
+
+    def load_columns(self, columns, labels):
+        """
+        Bulk-insert annotations given as columns, as read from a binary sidecar file
+        columns is a dict of type name to a dict of arrays: the coordinates as taken by the extend
+        method of the table of the type, and the label, frame and order of insertion of each annotation;
+        labels are indices into the given list of label strings
+        """
+        lut = np.array([self.labels.intern(l) for l in labels] + [0], np.int32)
+        count = 0
+        for name, c in columns.items():
+            try:
+                table = self.tables[name]
+            except KeyError:
+                raise InvalidAnnotation('Invalid annotation type', 'type')
+            table.insert(c['coords'], lut[c['label']], self._seq + c['order'], c['frame'])
+            count += len(c['order'])
+        self._seq += count
+        self._order = None
+
+    def append(self, annotation, seq = None):
+        """
+        Adopt an annotation object into the store
+        Its row is copied into the table of its type, and the object rebound to it
+        Unless given, its sequence number is the next in line
+        """
+        if seq is None:
+            seq = self._seq
+        table = self.table(type(annotation))
+        row = int(table.extend([annotation.coords], [annotation.label], [seq], [annotation.frame])[0])
+        table._data['selected'][row] = annotation.selected
+        self._seq = max(self._seq, seq + 1)
+        self._order = None
+        annotation._table, annotation._row = table, row
+        table.proxies[row] = annotation
+
+    def remove(self, annotation):
+        """
+        Remove an annotation from the store
+        Its row is flagged as removed, which notifies any views of the annotation
+        """
+        annotation._table.remove(annotation._row)
+        annotation.removed = True
+        self._order = None
+
+    def restore(self, annotation):
+        """
+        Restore a removed annotation, unselected, at its original position in order of insertion
+        If its sequence number was reused by renumbering since its removal,
+        it obtains a new one, and is restored as the last annotation
+        """
+        table, row = annotation._table, annotation._row
+        try:
+            self.find(table._data['seq'][row])
+            table._data['seq'][row] = self._seq
+        except KeyError:
+            pass
+        self._seq = max(self._seq, int(table._data['seq'][row]) + 1)
+        table._data['selected'][row] = False
+        table.reindex([row])
+        annotation.removed = False
+        self._order = None
+
+    def selection(self, mask = None):
+        """
+        Return a Selection of the live annotations
+        If given, mask is a boolean array over the annotations, in order of insertion
+        """
+        tables, rows = self._ordered()
+        if mask is not None:
+            mask = np.asarray(mask, np.bool_)
+            if mask.shape != tables.shape:
+                raise ValueError('Mask of {0} annotations given for {1}'.format(len(mask), len(tables)))
+            tables, rows = tables[mask], rows[mask]
+        names = list(self.tables)
+        return Selection(self, dict((names[t], np.sort(rows[tables == t])) for t in range(len(names))))
+
+    def query(self, label = None, bbox = None, frame = None):
+        """
+        Return a Selection of the live annotations matching all of the given criteria
+        label is a label string or a collection of them, bbox an (l0, h0, l1, h1) box
+        which the extent of the annotation intersects, and frame a frame index
+        """
+        if isinstance(label, basestring):
+            label = [label]
+        if label is not None:
+            ids = [self.labels.ids[l] for l in label if l in self.labels.ids]
+        rows = {}
+        for name, table in self.tables.items():
+            data = table.data
+            mask = ~data['removed']
+            if label is not None:
+                mask &= np.in1d(data['label'], ids)
+            if frame is not None:
+                mask &= data['frame'] == frame
+            if bbox is not None:
+                l0, h0, l1, h1 = table.cls.column_extent(data).T
+                mask &= (l0 <= bbox[1]) & (h0 >= bbox[0]) & (l1 <= bbox[3]) & (h1 >= bbox[2])
+            rows[name] = np.flatnonzero(mask)
+        return Selection(self, rows)
+
+    def snapshot(self, selection):
+        """
+        Return a copy of the rows of a selection, which can be restored with swap
+        """
+        return [(table, rows, table._data[rows].copy()) for table, rows in selection.items()]
+
+    def swap(self, snapshot):
+        """
+        Restore the rows of a snapshot, and return a snapshot of the state they replace
+        Sequence numbers are kept, except for restored annotations whose number was reused
+        by renumbering since their removal; these become the last in order of insertion
+        """
+        previous = []
+        live = np.concatenate([t.data['seq'][~t.data['removed']] for t in self.tables.values()])
+        for table, rows, saved in snapshot:
+            data = table._data
+            current = data[rows].copy()
+            previous.append((table, rows, current))
+            for f in table.dtype.names:
+                if f not in ('seq', 'selected'):
+                    data[f][rows] = saved[f]
+
+            restored = rows[current['removed'] & ~saved['removed']]
+            data['selected'][restored] = False
+            reused = restored[np.in1d(data['seq'][restored], live)]
+            data['seq'][reused] = self._seq + np.arange(len(reused))
+            if len(restored):
+                self._seq = max(self._seq, int(data['seq'][restored].max()) + 1)
+
+            for r in rows[saved['removed'] & ~current['removed']]:
+                table.remove(r)
+            table.reindex(rows[~saved['removed']])
+        self._order = None
+        return previous
+
+    def seq(self, annotation):
+        """The sequence number of an annotation, which identifies it in the store"""
+        return int(annotation._table._data['seq'][annotation._row])
+
+    def find(self, seq):
+        """
+        Return the live annotation with the given sequence number
+        """
+        for table in self.tables.values():
+            data = table.data
+            rows = np.flatnonzero((data['seq'] == seq) & ~data['removed'])
+            if len(rows):
+                return table.proxy(rows[0])
+        raise KeyError(seq)
+
+    def renumber(self):
+        """
+        Renumber the live annotations consecutively, in order of insertion,
+        matching the sequence numbers they obtain when saved and loaded again
+        """
+        tables, rows = self._ordered()
+        for t, table in enumerate(self.tables.values()):
+            mask = tables == t
+            table._data['seq'][rows[mask]] = np.flatnonzero(mask)
+        self._seq = len(rows)
+
+    def select(self, p, frame = None):
+        """
+        Return the annotation nearest to p among those hit, or None
+        If a frame is given, only annotations on that frame are considered
+        """
+        best = None
+        for table in self.tables.values():
+            rows, distance = table.hit(p, frame)
+            if len(rows):
+                i = np.argmin(distance)
+                if best is None or distance[i] < best[0]:
+                    best = distance[i], table, rows[i]
+        if best is None:
+            return None
+        return best[1].proxy(best[2])
+
+    def to_json(self):
+        """
+        Create JSON representations of all annotations, in order of insertion
+        """
+        records = []
+        for table in self.tables.values():
+            data = table.data[~table.data['removed']]
+            records.extend(zip(data['seq'].tolist(), table.to_json(data)))
+        records.sort(key=lambda r: r[0])
+        return [r for s, r in records]
+
+    def _ordered(self):
+        """
+        Return table and row indices of all live annotations, in order of insertion
+        """
+        if self._order is None:
+            tables, rows, seq = [], [], []
+            for t, table in enumerate(self.tables.values()):
+                data = table.data
+                live = np.flatnonzero(~data['removed'])
+                tables.append(np.full(len(live), t, np.int64))
+                rows.append(live)
+                seq.append(data['seq'][live])
+            order = np.argsort(np.concatenate(seq), kind='mergesort')
+            self._order = np.concatenate(tables)[order], np.concatenate(rows)[order]
+        return self._order
+
+    def __len__(self):
+        return len(self._ordered()[0])
+
+    def __getitem__(self, i):
+        tables, rows = self._ordered()
+        return list(self.tables.values())[tables[i]].proxy(rows[i])
+
+    def __iter__(self):
+        tables = list(self.tables.values())
+        for t, r in zip(*self._ordered()):
+            yield tables[t].proxy(r)
@@ -4,18 +4,73 @@ Chaco tools, facilitating interaction with the annotations
 """
 
 from traits.api import HasTraits, Instance, Button, Enum, Str, List, Bool
+from traitsui.api import Item, View, TextEditor, ListStrEditor
 
 from enable.api import BaseTool, AbstractOverlay
 
+import contours
+import datamodels
 
-class LabelPrompt(HasTraits):
+
+class LabelPicker(HasTraits):
     """
-    Simple dialog for setting a string
+    Label chooser, shown next to the plot, with prefix autocompletion over a vocabulary
+    The current label is given to every new annotation, until another one is chosen;
+    typing selects the first label matching the text, or else the text itself as a new label,
+    and the quick keys of the vocabulary choose a label directly
     """
-    label = Str()
+    text = Str()
+    matches = List(Str)
+    label = Str()       #label given to new annotations
+
+    def __init__(self, vocabulary):
+        super(LabelPicker, self).__init__()
+        self.vocabulary = vocabulary
+        self.matches = vocabulary.complete('')
+
+    def _text_changed(self):
+        self.matches = self.vocabulary.complete(self.text)
+        self.label = self.matches[0] if self.matches else self.text.strip()
 
+    def quick_key(self, key):
+        """Choose the label bound to a key; returns it, or None if the key is not bound"""
+        label = self.vocabulary.label_for(key)
+        if label is not None:
+            self.label = label
+        return label
 
-class RectangleTool(BaseTool):
+    traits_view = View(
+        Item('text', label='Label', editor=TextEditor(auto_set=True, enter_set=True)),
+        Item('matches', editor=ListStrEditor(selected='label', editable=False), show_label=False),
+        Item('label', style='readonly'))
+
+
+class LabelTool(BaseTool):
+
+    """
+    Base class of the tools adding annotations
+    New annotations get the current label of the label picker of the parent;
+    the quick keys choose another label, or relabel the selected annotation
+    """
+
+    def __init__(self, plot, parent):
+        super(LabelTool, self).__init__(plot)
+        self.parent = parent
+
+    def label(self):
+        """The label for a new annotation, or None if none is chosen yet"""
+        label = self.parent.picker.label
+        if not label:
+            self.parent.text = 'Choose a label first, by typing it or pressing its quick key'
+            return None
+        return label
+
+    def normal_key_pressed(self, event):
+        if not (event.control_down or event.alt_down) and self.parent.quick_key(event.character):
+            event.handled = True
+
+
+class RectangleTool(LabelTool):
 
     """
     Tool to add rectangle annotations
@@ -24,10 +79,6 @@ class RectangleTool(BaseTool):
 
     event_state = Enum("normal", "mousedown")
 
-    def __init__(self, plot, parent):
-        super(RectangleTool, self).__init__(plot)
-        self.parent = parent
-
     def coords(self, event):
         return map(int,  self.component.map_data((event.x, event.y)))
 
@@ -45,13 +96,12 @@ class RectangleTool(BaseTool):
         self.event_state = "normal"
         self.end = self.coords(event)
 
-        np = LabelPrompt()
-        ok = np.configure_traits(kind='modal')
-        if ok:
-            self.parent.add_rect(self.start, self.end, np.label)
+        label = self.label()
+        if label:
+            self.parent.add_rect(self.start, self.end, label)
         event.handled = True
 
-class MarkerTool(BaseTool):
+class MarkerTool(LabelTool):
 
     """
     Tool to add marker annotations
@@ -60,20 +110,110 @@ class MarkerTool(BaseTool):
 
     event_state = Enum("normal", "mousedown")
 
-    def __init__(self, plot, parent):
-        super(MarkerTool, self).__init__(plot)
-        self.parent = parent
-
     def coords(self, event):
         return map(int,  self.component.map_data((event.x, event.y)))
 
     def normal_left_up(self, event):
         p = self.coords(event)
 
-        np = LabelPrompt()
-        ok = np.configure_traits(kind='modal')
-        if ok:
-            self.parent.add_marker(p, np.label)
+        label = self.label()
+        if label:
+            self.parent.add_marker(p, label)
+        event.handled = True
+
+
+class PolygonTool(LabelTool):
+
+    """
+    Tool to add polygon annotations
+    Each click adds a vertex; a double click, or a click on the first vertex, closes the polygon
+    Escape discards the vertices placed so far
+    """
+
+    close = 10      #distance in pixels from the first vertex at which a click closes the polygon
+
+    def __init__(self, plot, parent):
+        super(PolygonTool, self).__init__(plot, parent)
+        self.points = []
+
+    def coords(self, event):
+        return tuple(map(int,  self.component.map_data((event.x, event.y))))
+
+    def normal_left_down(self, event):
+        if len(self.points) >= 3:
+            x, y = self.component.map_screen([self.points[0]])[0]
+            if abs(event.x - x) < self.close and abs(event.y - y) < self.close:
+                self.finish()
+                event.handled = True
+                return
+        self.points.append(self.coords(event))
+        self.parent.text = '{0} vertices'.format(len(self.points))
+        event.handled = True
+
+    def normal_left_dclick(self, event):
+        self.finish()
+        event.handled = True
+
+    def normal_key_pressed(self, event):
+        if event.character == 'Esc':
+            self.points = []
+            self.parent.text = ''
+            event.handled = True
+        else:
+            super(PolygonTool, self).normal_key_pressed(event)
+
+    def finish(self):
+        points, self.points = self.points, []
+        if len(points) < 3:
+            return
+        label = self.label()
+        if label:
+            self.parent.add_polygon(points, label)
+
+
+class FreehandTool(LabelTool):
+
+    """
+    Tool to add freehand contour annotations
+    The contour is drawn between a mousedown and mouseup event; the stroke is simplified while drawing,
+    one chunk of points at a time, such that the vertices already settled are not simplified again
+    """
+
+    event_state = Enum("normal", "mousedown")
+
+    chunk = 64      #number of new points after which the stroke is simplified
+
+    def coords(self, event):
+        return tuple(map(int,  self.component.map_data((event.x, event.y))))
+
+    def simplify(self):
+        """Simplify the points since the last settled vertex"""
+        tail = contours.simplify(self.points[self.settled:], datamodels.Freehand.tolerance)
+        self.points = self.points[:self.settled] + map(tuple, tail.tolist())
+        self.settled = len(self.points) - 1
+
+    def normal_left_down(self, event):
+        self.event_state = "mousedown"
+        self.points = [self.coords(event)]
+        self.settled = 0
+        event.handled = True
+
+    def mousedown_mouse_move(self, event):
+        p = self.coords(event)
+        if p != self.points[-1]:
+            self.points.append(p)
+        if len(self.points) - self.settled > self.chunk:
+            self.simplify()
+        self.parent.text = '{0} vertices'.format(len(self.points))
+        event.handled = True
+
+    def mousedown_left_up(self, event):
+        self.event_state = "normal"
+        self.simplify()
+        if len(self.points) >= 3:
+            label = self.label()
+            if label:
+                self.parent.add_polygon(self.points, label, freehand=True)
         event.handled = True
 
 
@@ -83,6 +223,9 @@ class SelectTool(BaseTool):
     Tool to select and manipulate annotations
     Only works on bulk annotations right now
     Future work would involve bringing up annotation control points upon selection,
+    All moves of a single drag are undone as one edit; ctrl-z and ctrl-y undo and redo
+    A second click on the selected annotation gives it the current label of the label picker,
+    as does pressing a quick key
     """
 
 ##    event_state = Enum("normal", "mousedown")
@@ -95,6 +238,7 @@ class SelectTool(BaseTool):
         self.event_state = "mousedown"
         self.last = self.coords(event)
         self.start = self.last
+        self.dragging = False
         self.prev_selected = self.parent.datamodel.selected
 
         self.parent.datamodel.select( self.last)
@@ -106,8 +250,9 @@ class SelectTool(BaseTool):
         self.last = new
 
         selected = self.parent.datamodel.selected
-        if selected:
-            selected.move(delta)
+        if selected and any(delta):
+            self.parent.datamodel.move(selected, delta, merge=self.dragging)
+            self.dragging = True
 
         event.handled = True
 
@@ -118,13 +263,60 @@ class SelectTool(BaseTool):
         if (self.start == self.coords(event)):              #no mouse movement
             selected = self.parent.datamodel.selected
             if selected is self.prev_selected and selected: #second click on this annotation
-                np = LabelPrompt(label=selected.label)
-                ok = np.configure_traits(kind='modal')
-                if ok:
-                    selected.label = np.label
+                label = self.parent.picker.label
+                if label and label != selected.label:
+                    self.parent.datamodel.relabel(selected, label)
 
         self.parent.datamodel.select( self.coords(event))
         event.handled = True
 
+    def normal_key_pressed(self, event):
+        if not event.control_down:
+            if not event.alt_down and self.parent.quick_key(event.character):
+                event.handled = True
+            return
+        if event.character in ('z', 'Z'):
+            self.parent.undo = True
+            event.handled = True
+        elif event.character in ('y', 'Y'):
+            self.parent.redo = True
+            event.handled = True
+
     def coords(self, event):
         return tuple( map(int,  self.component.map_data((event.x, event.y))))
+
+
+class WindowLevelTool(BaseTool):
+
+    """
+    Tool to adjust the display window
+    Dragging horizontally scales the window width, dragging vertically shifts the window center
+    """
+
+    event_state = Enum("normal", "mousedown")
+
+    def __init__(self, plot, parent):
+        super(WindowLevelTool, self).__init__(plot)
+        self.parent = parent
+
+    def normal_left_down(self, event):
+        self.event_state = "mousedown"
+        self.start = event.x, event.y
+        self.window = self.parent.display.window
+        event.handled = True
+
+    def mousedown_mouse_move(self, event):
+        if None in self.window:
+            #no window until the image has loaded; the drag continues from the first window set
+            self.start = event.x, event.y
+            self.window = self.parent.display.window
+            event.handled = True
+            return
+        center, width = self.window
+        dx, dy = event.x - self.start[0], event.y - self.start[1]
+        self.parent.set_window(center + dy * width / 256.0, width * 2 ** (dx / 128.0))
+        event.handled = True
+
+    def mousedown_left_up(self, event):
+        self.event_state = "normal"
+        event.handled = True
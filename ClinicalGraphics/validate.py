@@ -0,0 +1,244 @@
+"""
+Consistency checker for annotation archives
+
+Walks a directory tree for sidecar files, and checks every annotation against the schema
+of its type and against the DICOM header of its file: coordinates within the Rows and Columns
+of the image, frames within its number of frames, rectangles with l0 <= h0 and l1 <= h1,
+and no duplicated markers. Only DICOM headers are read; pixel data is never touched.
+Files are checked in a process pool, and all problems are written to a JSON report.
+
+Checks are incremental: the report of the previous run is read back, and files whose sidecar
+and DICOM modification times and sizes did not change are not read at all; files whose
+modification time changed but whose contents did not, by SHA1 digest, are not checked again.
+
+Usage:
+    python -m clinicalgraphics.validate <root> [--report PATH] [--full] [--processes N]
+"""
+
+import io
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+from collections import Counter
+
+import numpy as np
+
+from .datamodels import TYPES, REGISTRY, Rectangle, Marker
+from .store import AnnotationStore, InvalidAnnotation
+from .pixels import read_header
+from .batch import find
+from .journal import atomic_write, digest
+from .loader import iter_records, chunked, DECODE_ERRORS
+from . import sidecar
+
+
+VERSION = 1     #version of the report; reports of other versions are not reused
+REPORT = '.clinicalgraphics-validation.json'    #default location of the report, in the root directory
+
+
+def stat(path):
+    """Modification time and size of a file, or None if it does not exist"""
+    try:
+        s = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return [s.st_mtime, s.st_size]
+
+
+def issue(code, message, index = None, type = None):
+    return {'code': code, 'message': message, 'index': index, 'type': type}
+
+
+def read_records(data):
+    """
+    Parse the records of a JSON sidecar, and check each against the schema of its type
+    Returns the valid records, their positions in the file, and issues for the invalid ones
+    """
+    records, positions, issues = [], [], []
+    for i, attrs in enumerate(iter_records(io.BytesIO(data))):
+        try:
+            try:
+                cls = REGISTRY[attrs['type']]
+            except (KeyError, TypeError):
+                raise InvalidAnnotation('Invalid annotation type', 'type', attrs)
+            cls.validate(attrs)
+        except InvalidAnnotation as e:
+            issues.append(issue(e.code, str(e), i))
+            continue
+        records.append(attrs)
+        positions.append(i)
+    return records, positions, issues
+
+
+def check_table(cls, data, rows, columns, frames):
+    """
+    Check the live rows of a table against the image
+    Yields (rows, code, message) tuples, for the row indices failing each check
+    """
+    extent = cls.column_extent(data)
+    #markers are pixel positions; region extents may include the far edge of the image
+    edge = 1 if issubclass(cls, Marker) else 0
+    if rows is not None:
+        outside = (extent[:, 0] < 0) | (extent[:, 2] < 0) | \
+            (extent[:, 1] > columns - edge) | (extent[:, 3] > rows - edge)
+        yield outside, 'bounds', 'Outside the {0}x{1} image'.format(rows, columns)
+    if frames is not None:
+        yield data['frame'] >= frames, 'frame', 'Frame beyond the {0} frames of the image'.format(frames)
+    if issubclass(cls, Rectangle):
+        yield (data['l0'] > data['h0']) | (data['l1'] > data['h1']), 'inverted', 'Rectangle with l0 > h0 or l1 > h1'
+    if issubclass(cls, Marker) and len(data):
+        #duplicates of a marker at the same position, on the same frame and with the same label
+        #sorted by key, and by order of insertion within equal keys, so that all but the first
+        #of each run of equal keys are duplicates; lexsort sorts on its last key first
+        keys = np.column_stack([data['frame'], data['c0'], data['c1'], data['label']])
+        order = np.lexsort((data['seq'], data['label'], data['c1'], data['c0'], data['frame']))
+        ordered = keys[order]
+        duplicate = np.zeros(len(data), np.bool_)
+        duplicate[order[1:]] = np.all(ordered[1:] == ordered[:-1], axis=1)
+        yield duplicate, 'duplicate', 'Duplicate marker'
+
+
+def check_file(datapath, metadatapath):
+    """
+    Check a single sidecar file against the header of its DICOM file
+    Returns the entry of the file in the report
+    """
+    entry = {'dicom': datapath, 'sidecar': stat(metadatapath), 'header': stat(datapath),
+             'digest': None, 'annotations': 0, 'issues': []}
+    issues = entry['issues']
+
+    rows = columns = frames = None
+    if datapath is None:
+        issues.append(issue('dicom', 'No DICOM file; bounds not checked'))
+    else:
+        try:
+            header, offset = read_header(datapath)
+            rows, columns = int(header.Rows), int(header.Columns)
+            frames = int(getattr(header, 'NumberOfFrames', 1) or 1)
+        except Exception as e:
+            issues.append(issue('dicom', 'Unreadable DICOM header: {0}'.format(e)))
+
+    with open(metadatapath, 'rb') as fh:
+        data = fh.read()
+    entry['digest'] = digest(data)
+    store = AnnotationStore(TYPES)
+    positions = None
+    try:
+        if data.startswith(sidecar.MAGIC):
+            sidecar.load(store, metadatapath)
+        else:
+            records, positions, invalid = read_records(data)
+            issues.extend(invalid)
+            for chunk in chunked(records):
+                store.load(chunk)
+    except (InvalidAnnotation, KeyError, TypeError) + DECODE_ERRORS as e:
+        issues.append(issue('sidecar', 'Unreadable sidecar: {0}'.format(e)))
+        return entry
+
+    entry['annotations'] = len(store)
+    for name, table in store.tables.items():
+        live = table.data[~table.data['removed']]
+        for failed, code, message in check_table(table.cls, live, rows, columns, frames):
+            for seq in live['seq'][failed].tolist():
+                issues.append(issue(code, message, seq if positions is None else positions[seq], name))
+    issues.sort(key=lambda i: (i['index'] is not None, i['index']))
+    return entry
+
+
+def _check(task):
+    """
+    Check a single file in a worker process; failures are reported rather than raised
+    A file whose contents match the digest of its previous entry is not checked again
+    """
+    datapath, metadatapath, previous = task
+    try:
+        if previous is not None and previous['header'] == stat(datapath):
+            with open(metadatapath, 'rb') as fh:
+                if digest(fh.read()) == previous['digest']:
+                    previous['sidecar'] = stat(metadatapath)
+                    return metadatapath, previous, False
+        return metadatapath, check_file(datapath, metadatapath), True
+    except Exception as e:
+        entry = {'dicom': datapath, 'sidecar': None, 'header': None, 'digest': None, 'annotations': 0,
+                 'issues': [issue('sidecar', '{0}: {1}'.format(metadatapath, e))]}
+        return metadatapath, entry, True
+
+
+def read_report(path):
+    """The file entries of a previous report, or an empty dict"""
+    try:
+        with open(path, 'rb') as fh:
+            report = json.load(fh)
+    except (IOError, ValueError):
+        return {}
+    return report.get('files', {}) if report.get('version') == VERSION else {}
+
+
+def validate(root, report = None, full = False, processes = None, chunksize = 16):
+    """
+    Check all sidecar files below root, and write the report
+    Unless full, files unchanged since the report was last written are not checked again
+    Returns the report, and the number of files checked
+    """
+    report = os.path.join(root, REPORT) if report is None else report
+    previous = {} if full else read_report(report)
+    files, tasks = {}, []
+    for datapath, metadatapath in find(root):
+        key = os.path.relpath(metadatapath, root)
+        entry = previous.get(key)
+        if entry is not None and entry['dicom'] == datapath and \
+                entry['sidecar'] == stat(metadatapath) and entry['header'] == stat(datapath):
+            files[key] = entry
+        else:
+            tasks.append((datapath, metadatapath, entry if entry is not None and entry['dicom'] == datapath else None))
+
+    checked = 0
+    if tasks:
+        pool = multiprocessing.Pool(processes)
+        try:
+            for metadatapath, entry, rechecked in pool.imap_unordered(_check, tasks, chunksize):
+                files[os.path.relpath(metadatapath, root)] = entry
+                checked += rechecked
+        finally:
+            pool.close()
+            pool.join()
+
+    codes = Counter(i['code'] for entry in files.values() for i in entry['issues'])
+    result = {
+        'version': VERSION,
+        'root': os.path.abspath(root),
+        'summary': {
+            'files': len(files),
+            'annotations': sum(entry['annotations'] for entry in files.values()),
+            'issues': sum(codes.values()),
+            'codes': dict(codes),
+        },
+        'files': files,
+    }
+    atomic_write(report, json.dumps(result, indent=4, sort_keys=True))
+    return result, checked
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Check the annotations of an archive for consistency')
+    parser.add_argument('root', help='directory to scan for sidecar files')
+    parser.add_argument('--report', default=None, help='JSON report to write; by default {0} in root'.format(REPORT))
+    parser.add_argument('--full', action='store_true', help='check all files, not only those changed since the last report')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    report, checked = validate(args.root, args.report, args.full, args.processes)
+    summary = report['summary']
+    for path, entry in sorted(report['files'].items()):
+        for i in entry['issues']:
+            location = path if i['index'] is None else '{0}[{1}]'.format(path, i['index'])
+            sys.stderr.write('{0}: {1}: {2}\n'.format(location, i['code'], i['message']))
+    sys.stdout.write('{0} issues in {1} annotations of {2} files, {3} checked\n'.format(
+        summary['issues'], summary['annotations'], summary['files'], checked))
+    return 1 if summary['issues'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
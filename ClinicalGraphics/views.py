@@ -16,15 +16,44 @@ from enable.api import ComponentEditor
 import chaco.default_colormaps as dc
 
 import datamodels
+import instrument
+from instrument import timed
 
 
 from enable.api import BaseTool, AbstractOverlay
+from kiva.trait_defs.kiva_font_trait import KivaFont
+from pyface.timer.api import do_after
 
 
+class Deferred(object):
+    """
+    Mixin coalescing redraw requests into a single update per display frame
+    Subclasses implement update, which modifies the existing plot components in place
+    """
 
-class Rectangle(HasTraits):
+    frame = 16          #ms between updates; about the display refresh rate
+    _pending = False
+
+    def schedule(self):
+        """Request an update at the end of the current frame"""
+        if not self._pending:
+            self._pending = True
+            do_after(self.frame, self._flush)
+
+    @timed('redraw')
+    def _flush(self):
+        self._pending = False
+        self.update()
+
+    def update(self):
+        raise NotImplemented()
+
+
+
+class Rectangle(Deferred, HasTraits):
 
     rectangle = Instance(datamodels.Rectangle)
+    shown = False       #whether the plot components exist
 
     def __init__(self, rectangle, plot):
         super(Rectangle, self).__init__()
@@ -37,14 +66,12 @@ class Rectangle(HasTraits):
         """
         create plot components for a rectangle view
         """
+        if self.shown:
+            return
         r = self.rectangle
-        points = [(r.l0, r.l1),
-                  (r.h0, r.l1),
-                  (r.h0, r.h1),
-                  (r.l0, r.h1)]
-        px, py = zip(*points)
-        nx = 'px_{0}'.format(r.name)
-        ny = 'py_{0}'.format(r.name)
+        px, py = self.points()
+        nx = self.nx = 'px_{0}'.format(r.name)
+        ny = self.ny = 'py_{0}'.format(r.name)
 
         data = self.plot.data
         data.set_data(nx, px)
@@ -71,21 +98,66 @@ class Rectangle(HasTraits):
                            label_text = self.rectangle.label)
 
         self.plot.overlays.append(self.datalabel)
+        self.shown = True
         self.set_selection()
 
-    @on_trait_change('rectangle.removed')
+    def points(self):
+        """Corner coordinates of the rectangle"""
+        r = self.rectangle
+        points = [(r.l0, r.l1),
+                  (r.h0, r.l1),
+                  (r.h0, r.h1),
+                  (r.l0, r.h1)]
+        return zip(*points)
+
     def remove_visuals(self):
+        if self.rectangle is None or not self.shown:
+            return
         self.plot.delplot(self.rectangle.name)
         self.plot.overlays.remove(self.datalabel)
+        self.plot.data.del_data(self.nx)
+        self.plot.data.del_data(self.ny)
+        self.shown = False
+
+    @on_trait_change('rectangle.removed')
+    def toggle_visuals(self):
+        """Remove the visuals of a removed rectangle, and recreate them if it is restored"""
+        if self.rectangle is None or getattr(self, 'plot', None) is None:
+            return
+        if self.rectangle.removed:
+            self.remove_visuals()
+        else:
+            self.add_visuals()
 
     @on_trait_change('rectangle.changed')
     def redraw(self):
+        self.schedule()
+
+    def detach(self):
+        """
+        Remove the visuals, and stop listening to the annotation
+        """
         self.remove_visuals()
-        self.add_visuals()
+        self.rectangle = None
+
+    def update(self):
+        """
+        Update the existing data arrays and label in place
+        """
+        if self.rectangle is None or self.rectangle.removed:
+            return
+        px, py = self.points()
+        data = self.plot.data
+        data.set_data(self.nx, px)
+        data.set_data(self.ny, py)
+        self.datalabel.data_point = (px[3], py[3])
+        self.datalabel.label_text = self.rectangle.label
         self.plot.request_redraw()
 
     @on_trait_change('rectangle.selected')
     def set_selection(self):
+        if self.rectangle is None or not self.shown:
+            return
         if self.rectangle.selected:
             self.polygon.edge_color = (0.5,0.5,0.5,1.0)
             self.datalabel.bgcolor  = (0.5,0.5,0.5,1.0)
@@ -95,8 +167,9 @@ class Rectangle(HasTraits):
         self.plot.request_redraw()
 
 
-class Marker(HasTraits):
+class Marker(Deferred, HasTraits):
     marker = Instance(datamodels.Marker)
+    shown = False       #whether the plot components exist
 
     def __init__(self, marker, plot):
         super(Marker, self).__init__()
@@ -108,10 +181,12 @@ class Marker(HasTraits):
         """
         create plot components for a bounding rectangle
         """
+        if self.shown:
+            return
         m = self.marker
         px, py = [[m.c0], [m.c1]]
-        nx = 'px_{0}'.format(m.name)
-        ny = 'py_{0}'.format(m.name)
+        nx = self.nx = 'px_{0}'.format(m.name)
+        ny = self.ny = 'py_{0}'.format(m.name)
 
         data = self.plot.data
         data.set_data(nx, px)
@@ -137,21 +212,57 @@ class Marker(HasTraits):
                            label_text = self.marker.label)
 
         self.plot.overlays.append(self.datalabel)
+        self.shown = True
         self.set_selection()
 
-    @on_trait_change('marker.removed')
     def remove_visuals(self):
+        if self.marker is None or not self.shown:
+            return
         self.plot.delplot(self.marker.name)
         self.plot.overlays.remove(self.datalabel)
+        self.plot.data.del_data(self.nx)
+        self.plot.data.del_data(self.ny)
+        self.shown = False
+
+    @on_trait_change('marker.removed')
+    def toggle_visuals(self):
+        """Remove the visuals of a removed marker, and recreate them if it is restored"""
+        if self.marker is None or getattr(self, 'plot', None) is None:
+            return
+        if self.marker.removed:
+            self.remove_visuals()
+        else:
+            self.add_visuals()
 
     @on_trait_change('marker.changed')
     def redraw(self):
+        self.schedule()
+
+    def detach(self):
+        """
+        Remove the visuals, and stop listening to the annotation
+        """
         self.remove_visuals()
-        self.add_visuals()
+        self.marker = None
+
+    def update(self):
+        """
+        Update the existing data arrays and label in place
+        """
+        m = self.marker
+        if m is None or m.removed:
+            return
+        data = self.plot.data
+        data.set_data(self.nx, [m.c0])
+        data.set_data(self.ny, [m.c1])
+        self.datalabel.data_point = (m.c0, m.c1)
+        self.datalabel.label_text = m.label
         self.plot.request_redraw()
 
     @on_trait_change('marker.selected')
     def set_selection(self):
+        if self.marker is None or not self.shown:
+            return
         if self.marker.selected:
             self.point.color = (0.5,0.5,0.5,1.0)
             self.datalabel.bgcolor  = (0.5,0.5,0.5,1.0)
@@ -159,3 +270,285 @@ class Marker(HasTraits):
             self.point.color = (1.0,1.0,1.0,1.0)
             self.datalabel.bgcolor  = (1.0,1.0,1.0,1.0)
         self.plot.request_redraw()
+
+
+class Polygon(Deferred, HasTraits):
+    """
+    View of a polygon or freehand contour
+    """
+    polygon = Instance(datamodels.Polygon)
+    shown = False       #whether the plot components exist
+
+    def __init__(self, polygon, plot):
+        super(Polygon, self).__init__()
+        self.polygon = polygon
+        self.plot = plot
+        self.add_visuals()
+
+    def add_visuals(self):
+        """
+        create plot components for a polygon view
+        """
+        if self.shown:
+            return
+        p = self.polygon
+        px, py = p.vertices.T.tolist()
+        nx = self.nx = 'px_{0}'.format(p.name)
+        ny = self.ny = 'py_{0}'.format(p.name)
+
+        data = self.plot.data
+        data.set_data(nx, px)
+        data.set_data(ny, py)
+
+        self.outline = self.plot.plot(
+             (nx, ny),
+              type='polygon',
+              name = p.name,
+              edge_width = 3,
+              edge_color = 'white',
+              face_color = 'transparent')[0]
+
+        self.datalabel = DataLabel(component=self.plot, data_point=(p.l0, p.h1),
+                           label_position="top right", padding_bottom=10,
+                           border_visible=False,
+                           bgcolor="white",
+                           marker_color="transparent",
+                           marker_line_color="transparent",
+                           show_label_coords=False,
+                           marker="diamond",
+                           font='modern 20',
+                           label_text = p.label)
+
+        self.plot.overlays.append(self.datalabel)
+        self.shown = True
+        self.set_selection()
+
+    def remove_visuals(self):
+        if self.polygon is None or not self.shown:
+            return
+        self.plot.delplot(self.polygon.name)
+        self.plot.overlays.remove(self.datalabel)
+        self.plot.data.del_data(self.nx)
+        self.plot.data.del_data(self.ny)
+        self.shown = False
+
+    @on_trait_change('polygon.removed')
+    def toggle_visuals(self):
+        """Remove the visuals of a removed polygon, and recreate them if it is restored"""
+        if self.polygon is None or getattr(self, 'plot', None) is None:
+            return
+        if self.polygon.removed:
+            self.remove_visuals()
+        else:
+            self.add_visuals()
+
+    @on_trait_change('polygon.changed')
+    def redraw(self):
+        self.schedule()
+
+    def detach(self):
+        """
+        Remove the visuals, and stop listening to the annotation
+        """
+        self.remove_visuals()
+        self.polygon = None
+
+    def update(self):
+        """
+        Update the existing data arrays and label in place
+        """
+        p = self.polygon
+        if p is None or p.removed:
+            return
+        px, py = p.vertices.T.tolist()
+        data = self.plot.data
+        data.set_data(self.nx, px)
+        data.set_data(self.ny, py)
+        self.datalabel.data_point = (p.l0, p.h1)
+        self.datalabel.label_text = p.label
+        self.plot.request_redraw()
+
+    @on_trait_change('polygon.selected')
+    def set_selection(self):
+        if self.polygon is None or not self.shown:
+            return
+        if self.polygon.selected:
+            self.outline.edge_color = (0.5,0.5,0.5,1.0)
+            self.datalabel.bgcolor  = (0.5,0.5,0.5,1.0)
+        else:
+            self.outline.edge_color = (1.0,1.0,1.0,1.0)
+            self.datalabel.bgcolor  = (1.0,1.0,1.0,1.0)
+        self.plot.request_redraw()
+
+
+class LabelOverlay(AbstractOverlay):
+    """
+    Single overlay drawing the label texts of all annotations in a layer
+    """
+
+    font = KivaFont('modern 20')
+
+    def __init__(self, layer, **traits):
+        super(LabelOverlay, self).__init__(component=layer.plot, **traits)
+        self.layer = layer
+
+    def overlay(self, component, gc, view_bounds=None, mode="normal"):
+        points, texts, selected = self.layer.labels
+        if not len(points):
+            return
+        screen = component.map_screen(points)
+        x0, y0 = component.position
+        x1, y1 = x0 + component.width, y0 + component.height
+        visible = np.flatnonzero((screen[:, 0] >= x0) & (screen[:, 0] <= x1) &
+                                 (screen[:, 1] >= y0) & (screen[:, 1] <= y1))
+        with gc:
+            gc.clip_to_rect(x0, y0, component.width, component.height)
+            gc.set_font(self.font)
+            for i in visible:
+                x, y = screen[i]
+                y += 10
+                w, h = gc.get_full_text_extent(texts[i])[:2]
+                gc.set_fill_color((0.5,0.5,0.5,1.0) if selected[i] else (1.0,1.0,1.0,1.0))
+                gc.rect(x, y, w, h)
+                gc.fill_path()
+                gc.set_fill_color((0.0,0.0,0.0,1.0))
+                gc.show_text_at_point(texts[i], x, y)
+
+
+class TimingOverlay(AbstractOverlay):
+    """
+    Overlay showing the frame rate and the latest timings of the instrumented stages
+    Also records each redraw of the plot, and the number of live renderers and overlays
+    """
+
+    font = KivaFont('modern 12')
+    stages = ['decode', 'colormap', 'redraw', 'select', 'save']
+
+    def overlay(self, component, gc, view_bounds=None, mode="normal"):
+        stats = instrument.stats
+        stats.frame()
+        stats.count('renderers', len(component.plots))
+        stats.count('overlays', len(component.overlays))
+
+        fps = stats.fps
+        lines = ['{0:.0f} fps'.format(fps) if fps else '- fps']
+        for name in self.stages:
+            last = stats.last(name)
+            if last is not None:
+                lines.append('{0} {1:.1f} ms'.format(name, last * 1000))
+        lines.append('{0} renderers, {1} overlays'.format(len(component.plots), len(component.overlays)))
+
+        with gc:
+            gc.set_font(self.font)
+            gc.set_fill_color((1.0,1.0,0.0,1.0))
+            x = component.x + 10
+            y = component.y2 - 20
+            for line in lines:
+                gc.show_text_at_point(line, x, y)
+                y -= 16
+
+
+class AnnotationLayer(Deferred, HasTraits):
+    """
+    Batched view of all annotations on the current frame of a datamodel
+
+    All markers share a single scatter renderer, and all rectangles and all contours
+    a single line renderer each, driven by one coordinate array built from the columns
+    of the annotation store; the selected annotation is drawn on top by a second set of renderers
+    """
+
+    datamodel = Instance(datamodels.DataModel)
+
+    def __init__(self, datamodel, plot):
+        super(AnnotationLayer, self).__init__()
+        self.plot = plot
+        self.datamodel = datamodel
+
+        self.update()
+        for name, color in [('', 'white'), ('selected_', (0.5,0.5,0.5,1.0))]:
+            plot.plot((name+'marker_x', name+'marker_y'), type='scatter',
+                      color=color, name=name+'markers')
+            plot.plot((name+'rect_x', name+'rect_y'), type='line',
+                      line_width=5, color=color, name=name+'rectangles')
+            plot.plot((name+'contour_x', name+'contour_y'), type='line',
+                      line_width=3, color=color, name=name+'contours')
+
+        self.overlay = LabelOverlay(self)
+        plot.overlays.append(self.overlay)
+
+    @staticmethod
+    def outline(data):
+        """
+        Closed outlines of a set of rectangle rows, separated by NaN
+        """
+        l0, h0, l1, h1 = [data[f].astype(np.float64) for f in datamodels.Rectangle.fields]
+        nan = np.full(len(data), np.nan)
+        x = np.column_stack([l0, h0, h0, l0, l0, nan]).ravel()
+        y = np.column_stack([l1, l1, h1, h1, l1, nan]).ravel()
+        return x, y
+
+    @staticmethod
+    def contour_outline(table, rows):
+        """
+        Closed outlines of a set of contour rows, separated by NaN
+        """
+        if not len(rows):
+            return np.zeros(0), np.zeros(0)
+        parts = []
+        for r in rows:
+            v = table.vertices(r).astype(np.float64)
+            parts.extend([v, v[:1], [(np.nan, np.nan)]])
+        return np.concatenate(parts).T
+
+    @on_trait_change('datamodel.updated, datamodel.frame')
+    def redraw(self):
+        self.schedule()
+
+    def detach(self):
+        """
+        Remove the renderers and overlay, and stop listening to the datamodel
+        """
+        for name in ['', 'selected_']:
+            self.plot.delplot(name+'markers', name+'rectangles', name+'contours')
+        self.plot.overlays.remove(self.overlay)
+        self.datamodel = None
+
+    def update(self):
+        """
+        Rebuild the shared coordinate arrays from the annotation store
+        """
+        if self.datamodel is None:
+            return
+        store = self.datamodel._annotations
+        frame = self.datamodel.frame
+        markers = store.table(datamodels.Marker).data
+        markers = markers[~markers['removed'] & (markers['frame'] == frame)]
+        rects = store.table(datamodels.Rectangle).data
+        rects = rects[~rects['removed'] & (rects['frame'] == frame)]
+
+        tables = [store.table(datamodels.Polygon), store.table(datamodels.Freehand)]
+        contours = [(t, np.flatnonzero(~t.data['removed'] & (t.data['frame'] == frame))) for t in tables]
+        boxes = np.concatenate([t.data[r] for t, r in contours])
+
+        data = self.plot.data
+        for name, m, r in [('', markers, rects),
+                           ('selected_', markers[markers['selected']], rects[rects['selected']])]:
+            data.set_data(name+'marker_x', m['c0'].astype(np.float64))
+            data.set_data(name+'marker_y', m['c1'].astype(np.float64))
+            x, y = self.outline(r)
+            data.set_data(name+'rect_x', x)
+            data.set_data(name+'rect_y', y)
+            parts = [self.contour_outline(t, rows[t.data['selected'][rows]] if name else rows) for t, rows in contours]
+            data.set_data(name+'contour_x', np.concatenate([x for x, y in parts]))
+            data.set_data(name+'contour_y', np.concatenate([y for x, y in parts]))
+
+        points = np.concatenate([
+            np.column_stack([markers['c0'], markers['c1']]),
+            np.column_stack([rects['l0'], rects['h1']]),
+            np.column_stack([boxes['l0'], boxes['h1']])]).reshape(-1, 2)
+        labels = store.labels.strings
+        texts = [labels[l] for l in np.concatenate([markers['label'], rects['label'], boxes['label']]).tolist()]
+        selected = np.concatenate([markers['selected'], rects['selected'], boxes['selected']])
+        self.labels = points, texts, selected
+
+        self.plot.request_redraw()
@@ -0,0 +1,97 @@
+"""
+Per-project label vocabulary
+
+A vocabulary is the label table shared by all datamodels of a project, such that a label
+has the same integer id in every file; it is stored as JSON, by default in the root directory
+of the archive. Labels are kept in a sorted prefix index for autocompletion.
+The digit quick keys select the first labels, in order of their ids, unless bound explicitly
+to another label, to label new annotations with a single keystroke.
+"""
+
+import os
+import json
+import bisect
+import threading
+
+from store import LabelTable
+from journal import atomic_write
+
+
+FILENAME = '.clinicalgraphics-labels.json'     #default location of the vocabulary, in the root directory
+QUICK_KEYS = '123456789'                        #keys bound to the first labels, unless bound explicitly
+
+
+class Vocabulary(LabelTable):
+    """
+    Label table with quick keys and prefix completion, persisted as JSON
+    Labels are only ever added, so that their ids remain valid
+    """
+
+    def __init__(self, labels = (), keys = None, path = None):
+        """
+        labels is a sequence of label strings, in order of their ids
+        keys is a dict of quick key to label; digits not bound explicitly select the first labels
+        """
+        super(Vocabulary, self).__init__()
+        self.path = path
+        self._prefix = []       #sorted (lowercase label, label) pairs
+        self._lock = threading.Lock()   #datamodels sharing the vocabulary may be loaded concurrently
+        for label in labels:
+            self.intern(label)
+        self.keys = dict(keys or {})
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a vocabulary from a JSON file, or a directory holding one
+        An empty vocabulary is returned if the file does not exist yet; it is created on save
+        """
+        if os.path.isdir(path):
+            path = os.path.join(path, FILENAME)
+        try:
+            with open(path, 'rb') as fh:
+                data = json.load(fh)
+        except IOError:
+            return cls(path=path)
+        return cls(data['labels'], data.get('keys'), path)
+
+    def save(self, path = None):
+        path = self.path if path is None else path
+        atomic_write(path, json.dumps({'labels': self.strings, 'keys': self.keys}, indent=4, sort_keys=True))
+
+    def intern(self, label):
+        """Return the id of a label string, adding it to the vocabulary if needed"""
+        try:
+            return self.ids[label]
+        except KeyError:
+            with self._lock:
+                if label not in self.ids:
+                    bisect.insort(self._prefix, (label.lower(), label))
+                return super(Vocabulary, self).intern(label)
+
+    def complete(self, prefix, limit = 10):
+        """
+        Return at most limit labels starting with prefix, case insensitive, in sorted order
+        """
+        prefix = prefix.lower()
+        i = bisect.bisect_left(self._prefix, (prefix,))
+        matches = []
+        for key, label in self._prefix[i:i + limit]:
+            if not key.startswith(prefix):
+                break
+            matches.append(label)
+        return matches
+
+    def bind(self, key, label):
+        """Bind a quick key to a label, adding the label if needed"""
+        self.intern(label)
+        self.keys[key] = label
+
+    def label_for(self, key):
+        """The label bound to a quick key, or None"""
+        try:
+            return self.keys[key]
+        except KeyError:
+            pass
+        i = QUICK_KEYS.find(key) if key else -1
+        return self.strings[i] if 0 <= i < len(self.strings) else None
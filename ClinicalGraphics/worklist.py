@@ -0,0 +1,158 @@
+"""
+Worklists of DICOM files
+Steps through a series of files, while the next ones are loaded and decoded
+in background threads into a bounded cache
+"""
+
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from traits.api import HasTraits, Int
+
+from datamodels import DataModel
+import pyramid
+import pixels
+
+
+def scan(directory):
+    """
+    Return the sorted paths of the DICOM files below a directory, as found by the index and batch tools
+    """
+    return list(pixels.find(directory))
+
+
+def load(path, size, **kwargs):
+    """
+    Load a datamodel with its annotations, and decode its image
+    up to the pyramid level displayed in a window of the given size
+    """
+    datamodel = DataModel(path, **kwargs)
+    image = pyramid.get(path, datamodel.data, datamodel.frame)
+    image[image.level_for(max(datamodel.shape[:2]) / float(size))]
+    return datamodel
+
+
+class Worklist(HasTraits):
+    """
+    Navigable list of DICOM files
+
+    The next prefetch files, and the previous one, are loaded by a thread pool
+    into an LRU cache of at most cache_size datamodels
+    """
+
+    index = Int(0)
+
+    def __init__(self, paths, prefetch = 3, cache_size = 8, workers = 2, size = 800, **kwargs):
+        """
+        paths is either a list of DICOM files, or a directory containing them
+        Additional keyword arguments are passed on to the DataModel of each file
+        """
+        super(Worklist, self).__init__()
+        if isinstance(paths, basestring):
+            paths = scan(paths)
+        self.paths = list(paths)
+        self.prefetch = prefetch
+        self.cache_size = max(cache_size, prefetch + 2)
+        self.size = size
+        self.kwargs = kwargs
+        self.pool = ThreadPool(workers)
+        self._cache = OrderedDict()     #path -> AsyncResult, in order of use
+        self._lock = threading.Lock()   #guards the state of each load, shared with the completion callbacks
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _request(self, i):
+        """
+        Return the pending or completed load of the i-th file, marking it as most recently used
+        """
+        path = self.paths[i]
+        try:
+            result = self._cache.pop(path)
+        except KeyError:
+            state = {}
+            result = self.pool.apply_async(self._load, (path, state),
+                                           callback=lambda datamodel: self._loaded(state, datamodel))
+            result.state = state
+        self._cache[path] = result
+        return result
+
+    def _load(self, path, state):
+        """Load a file on the pool, unless its entry was evicted before the load started"""
+        with self._lock:
+            if state.get('evicted', False):
+                return None
+        return load(path, self.size, **self.kwargs)
+
+    def _loaded(self, state, datamodel):
+        """
+        Completion callback of a load, on the result thread of the pool
+        The datamodel is closed right away if its entry was evicted while it was loading
+        """
+        if datamodel is None:
+            return
+        with self._lock:
+            state['datamodel'] = datamodel
+            evicted = state.get('evicted', False)
+        if evicted:
+            datamodel.close()
+
+    def _drop(self, result):
+        """Close the datamodel of a dropped entry once loaded; now, if it already is"""
+        with self._lock:
+            result.state['evicted'] = True
+            datamodel = result.state.get('datamodel')
+        if datamodel is not None:
+            datamodel.close()
+
+    def _evict(self):
+        """Drop the least recently used entries beyond the cache size"""
+        while len(self._cache) > self.cache_size:
+            path, result = self._cache.popitem(last=False)
+            self._drop(result)
+
+    @property
+    def current(self):
+        """
+        The datamodel of the current file
+        Blocks until it is loaded, and schedules prefetching of its neighbours
+        """
+        current = self._request(self.index)
+        neighbours = range(self.index + 1, min(self.index + 1 + self.prefetch, len(self)))
+        if self.index > 0:
+            neighbours.append(self.index - 1)
+        for i in neighbours:
+            self._request(i)
+        self._request(self.index)
+        self._evict()
+        return current.get()
+
+    def step(self, delta):
+        """
+        Move delta files forward or backward in the list, and return the new current datamodel
+        """
+        self.index = min(max(self.index + delta, 0), len(self) - 1)
+        return self.current
+
+    def next(self):
+        return self.step(1)
+
+    def previous(self):
+        return self.step(-1)
+
+    def owns(self, datamodel):
+        """Whether a datamodel is held in the cache; it is closed by the worklist once evicted"""
+        with self._lock:
+            return any(result.state.get('datamodel') is datamodel for result in self._cache.values())
+
+    def close(self):
+        """
+        Close all loaded datamodels, and stop the thread pool
+        Loads not yet started are skipped; those in progress are waited for, and closed once done
+        """
+        for result in self._cache.values():
+            self._drop(result)
+        self._cache.clear()
+        self.pool.close()
+        self.pool.join()
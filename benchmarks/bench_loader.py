@@ -0,0 +1,66 @@
+"""
+Benchmark of sidecar loading
+
+Compares the registry-based bulk loader of DataModel.load_metadata with the
+previous path, which constructed every annotation through eval and its constructor
+
+Usage:
+    python benchmarks/bench_loader.py [n ...]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+
+from clinicalgraphics import datamodels
+from clinicalgraphics.datamodels import DataModel
+
+
+def synthetic(n, seed = 0):
+    """
+    Generate n random annotation records, half of them markers and half rectangles
+    """
+    r = random.Random(seed)
+    records = []
+    for i in range(n):
+        if i % 2:
+            x, y = r.randint(0, 3000), r.randint(0, 3000)
+            records.append({'type': 'Rectangle', 'label': 'r{0}'.format(i % 10),
+                            'l0': x, 'h0': x + r.randint(1, 200), 'l1': y, 'h1': y + r.randint(1, 200)})
+        else:
+            records.append({'type': 'Marker', 'label': 'm{0}'.format(i % 10),
+                            'c0': r.randint(0, 3000), 'c1': r.randint(0, 3000)})
+    return records
+
+
+def legacy_load(path):
+    """The previous loading path; eval of the type and per-record construction"""
+    metadata = json.load(open(path))
+    return [eval('datamodels.' + m['type'])(**m) for m in metadata]
+
+
+def timed(f, *args):
+    t = time.time()
+    f(*args)
+    return time.time() - t
+
+
+def main(sizes):
+    fh, path = tempfile.mkstemp('.json')
+    os.close(fh)
+    try:
+        for n in sizes:
+            json.dump(synthetic(n), open(path, 'w'), indent=4)
+            legacy = timed(legacy_load, path)
+            bulk = timed(DataModel, None, path)
+            print('{0:>8} records: legacy {1:8.3f}s, registry {2:8.3f}s, speedup {3:6.1f}x'.format(
+                n, legacy, bulk, legacy / bulk))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [100, 1000, 10000, 100000])
@@ -0,0 +1,200 @@
+"""
+Benchmark suite of the datamodel, persistence and view layers
+
+Times DataModel construction, load_metadata, save, select and move on a synthetic
+DICOM file with synthetic annotation sets, and the loading and redrawing of annotation
+views rendered offscreen, if Chaco is available.
+Results are written as JSON, so that regressions can be tracked between releases.
+
+Usage:
+    python benchmarks/bench_suite.py [--output results.json] [--repeat N] [n ...]
+"""
+
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+
+from bench_loader import synthetic
+
+#the view layer is benchmarked without a window
+os.environ.setdefault('ETS_TOOLKIT', 'null')
+
+from clinicalgraphics.datamodels import DataModel
+
+
+SIZES = [10, 100, 1000, 10000, 100000]
+SHAPE = (2048, 2048)
+VIEWS_LIMIT = 10000     #largest set drawn with a view per annotation, rather than batched
+SAMPLES = 1000          #calls per timing of select and move
+
+
+def write_dicom(path, shape = SHAPE, seed = 0):
+    """
+    Write a synthetic uncompressed 16 bit DICOM image
+    """
+    import dicom
+    from dicom.dataset import Dataset, FileDataset
+
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.7'      #secondary capture
+    meta.MediaStorageSOPInstanceUID = '1.2.826.0.1.3680043.2.1143.1'
+    meta.ImplementationClassUID = '1.2.826.0.1.3680043.2.1143'
+    meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'                  #explicit VR little endian
+
+    ds = FileDataset(path, {}, file_meta=meta, preamble=b'\0' * 128)
+    ds.is_little_endian, ds.is_implicit_VR = True, False
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Rows, ds.Columns = shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 12, 11
+    ds.PixelRepresentation = 0
+    image = np.random.RandomState(seed).randint(0, 4096, shape).astype('<u2')
+    ds.PixelData = image.tostring()
+    ds[0x7FE00010].VR = 'OW'
+    ds.save_as(path)
+
+
+def best(f, repeat, setup = None):
+    """
+    Return the best of repeat timings of f, in seconds
+    If given, setup is called before each timing, and its result passed to f
+    """
+    times = []
+    for i in range(repeat):
+        arg = setup() if setup is not None else None
+        t = time.time()
+        f(arg)
+        times.append(time.time() - t)
+    return min(times)
+
+
+def points(n, seed = 0):
+    r = random.Random(seed)
+    return [(r.randint(0, SHAPE[0]), r.randint(0, SHAPE[1])) for i in range(n)]
+
+
+def bench_model(datapath, metadatapath, repeat):
+    """
+    Time the datamodel and persistence layers
+    select and move are timed per call
+    """
+    load = lambda arg: DataModel(datapath, metadatapath)
+    results = {'construct': best(load, repeat)}
+
+    datamodel = DataModel(datapath, metadatapath)
+    results['load_metadata'] = best(lambda arg: datamodel.load_metadata(), repeat)
+    results['save'] = best(lambda arg: datamodel.save(), repeat)
+
+    ps = points(SAMPLES)
+    def select(arg):
+        for p in ps:
+            datamodel.select(p)
+    results['select'] = best(select, repeat) / SAMPLES
+
+    annotations = datamodel._annotations
+    if len(annotations):
+        targets = [annotations[i % len(annotations)] for i in range(SAMPLES)]
+        def move(arg):
+            for a in targets:
+                datamodel.move(a, (1, -1))
+        results['move'] = best(move, repeat) / SAMPLES
+    return results
+
+
+def bench_views(datapath, metadatapath, repeat):
+    """
+    Time the creation of the annotation views, and an offscreen redraw of the plot
+    Returns None if Chaco is not available
+    """
+    try:
+        from chaco.api import PlotGraphicsContext
+        from clinicalgraphics.gui import Main
+    except ImportError:
+        return None
+
+    n = DataModel(None, metadatapath).annotations
+    results = {}
+    for batched in [True, False]:
+        if not batched and n > VIEWS_LIMIT:
+            continue
+        name = 'batched' if batched else 'views'
+
+        def setup():
+            main = Main(DataModel(datapath, metadatapath), batched=batched)
+            main._unload_visuals()
+            return main
+        results['load_visuals_' + name] = best(lambda main: main._load_visuals(), repeat, setup)
+
+        main = Main(DataModel(datapath, metadatapath), batched=batched)
+        plot = main.plot
+        plot.outer_bounds = [main.width, main.width]
+        plot.do_layout(force=True)
+        def redraw(arg):
+            for view in [main.layer] if batched else main._annotations:
+                view.update()
+            gc = PlotGraphicsContext(plot.outer_bounds)
+            gc.render_component(plot)
+        results['redraw_' + name] = best(redraw, repeat)
+    return results
+
+
+def environment():
+    """Description of the environment the benchmarks ran in"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time':     time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit':   commit,
+        'python':   platform.python_version(),
+        'numpy':    np.__version__,
+        'platform': platform.platform(),
+    }
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('sizes', nargs='*', type=int, default=SIZES, help='numbers of annotations')
+    parser.add_argument('--output', default='benchmarks.json', help='JSON results file')
+    parser.add_argument('--repeat', type=int, default=3, help='timings per benchmark; the best is reported')
+    args = parser.parse_args(argv)
+
+    root = tempfile.mkdtemp()
+    try:
+        datapath = os.path.join(root, 'image.dcm')
+        metadatapath = os.path.join(root, 'image.json')
+        write_dicom(datapath)
+        runs = []
+        for n in args.sizes:
+            json.dump(synthetic(n), open(metadatapath, 'w'), indent=4)
+            results = bench_model(datapath, metadatapath, args.repeat)
+            json.dump(synthetic(n), open(metadatapath, 'w'), indent=4)
+            views = bench_views(datapath, metadatapath, args.repeat)
+            if views is not None:
+                results.update(views)
+            else:
+                print('Chaco not available; view benchmarks skipped')
+            for name, seconds in sorted(results.items()):
+                print('{0:>8} annotations: {1:<22} {2:12.6f}s'.format(n, name, seconds))
+            runs.append({'annotations': n, 'results': results})
+    finally:
+        shutil.rmtree(root)
+
+    with open(args.output, 'w') as fh:
+        json.dump({'environment': environment(), 'shape': list(SHAPE), 'runs': runs}, fh, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Synthetic DICOM files for the test cases
+"""
+
+import struct
+import itertools
+
+import numpy as np
+from dicom.dataset import Dataset, FileDataset
+
+
+RLE = '1.2.840.10008.1.2.5'
+
+_instances = itertools.count(1)
+
+
+def packbits(data):
+    """
+    PackBits encode a byte string; runs of three or more equal bytes are replicated
+    """
+    data = bytearray(data)
+    out, literal = bytearray(), bytearray()
+    i, n = 0, len(data)
+
+    def flush():
+        for j in range(0, len(literal), 128):
+            chunk = literal[j:j+128]
+            out.append(len(chunk) - 1)
+            out.extend(chunk)
+        del literal[:]
+
+    while i < n:
+        run = 1
+        while i + run < n and run < 128 and data[i + run] == data[i]:
+            run += 1
+        if run >= 3:
+            flush()
+            out.append(257 - run)
+            out.append(data[i])
+            i += run
+        else:
+            literal.extend(data[i:i+run])
+            i += run
+    flush()
+    return bytes(out)
+
+
+def rle_frame(frame):
+    """
+    RLE encode a 16 bit frame, as two segments holding the high and low bytes
+    """
+    frame = np.asarray(frame).astype('>u2').ravel()
+    planes = frame.view(np.uint8).reshape(-1, 2)
+    segments = [packbits(planes[:, b].tostring()) for b in range(2)]
+    segments = [s + b'\0' * (len(s) % 2) for s in segments]
+    offsets = [64, 64 + len(segments[0])]
+    header = struct.pack('<16L', *([len(segments)] + offsets + [0] * 13))
+    return header + b''.join(segments)
+
+
+def encapsulate(frames):
+    """
+    Encapsulated pixel data element, with an empty basic offset table, one fragment per frame
+    """
+    items = [struct.pack('<HHL', 0xFFFE, 0xE000, 0)]
+    for f in frames:
+        items.append(struct.pack('<HHL', 0xFFFE, 0xE000, len(f)) + f)
+    items.append(struct.pack('<HHL', 0xFFFE, 0xE0DD, 0))
+    return struct.pack('<HH2sHL', 0x7FE0, 0x0010, b'OB', 0, 0xFFFFFFFF) + b''.join(items)
+
+
+def write_dicom(path, image, frames = None, rle = False):
+    """
+    Write an image, or a stack of frames, as a 16 bit explicit VR little endian DICOM file
+    If rle is set, the pixel data is RLE compressed
+    Every file gets a unique SOPInstanceUID
+    """
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
+    meta.MediaStorageSOPInstanceUID = '1.2.826.0.1.3680043.2.1143.{0}'.format(next(_instances))
+    meta.ImplementationClassUID = '1.2.826.0.1.3680043.2.1143'
+    meta.TransferSyntaxUID = RLE if rle else '1.2.840.10008.1.2.1'
+
+    ds = FileDataset(path, {}, file_meta=meta, preamble=b'\0' * 128)
+    ds.is_little_endian, ds.is_implicit_VR = True, False
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = 'OT'
+    ds.Rows, ds.Columns = image.shape[-2:]
+    if frames:
+        ds.NumberOfFrames = frames
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 16, 15
+    ds.PixelRepresentation = 0
+    if rle:
+        ds.save_as(path)
+        stack = np.asarray(image).reshape((-1,) + image.shape[-2:])
+        with open(path, 'ab') as fh:
+            fh.write(encapsulate([rle_frame(f) for f in stack]))
+        return
+    ds.PixelData = np.asarray(image).astype('<u2').tostring()
+    ds[0x7FE00010].VR = 'OW'
+    ds.save_as(path)
@@ -0,0 +1,56 @@
+"""
+Test cases for the headless batch export
+"""
+
+import tempfile
+import shutil
+import os
+import json
+
+import unittest
+
+from clinicalgraphics import batch, index, worklist
+from test_datamodels import example_JSON
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'sub'))
+        for name in ['a.json', os.path.join('sub', 'b.json')]:
+            with open(os.path.join(self.root, name), 'w') as fh:
+                fh.write(example_JSON)
+
+    def test_find(self):
+        """Sidecar files are found recursively; no DICOM files are present"""
+        pairs = list(batch.find(self.root))
+        self.assertEqual(len(pairs), 2)
+        self.assertTrue(all(d is None for d, m in pairs))
+
+    def test_discovery(self):
+        """The batch export, the index and worklists see the same DICOM files, in any extension case"""
+        os.mkdir(os.path.join(self.root, '.hidden'))
+        for name in ['a.DCM', os.path.join('sub', 'b.Dicom'), os.path.join('sub', 'c.dcm'),
+                     '.d.dcm', os.path.join('.hidden', 'e.dcm'), 'notes.txt',
+                     os.path.join('sub', 'c.json'), '.d.json', os.path.join('.hidden', 'e.json')]:
+            open(os.path.join(self.root, name), 'w').close()
+
+        paired = sorted(d for d, m in batch.find(self.root) if d is not None)
+        found = [d for d, m in index.find(self.root)]
+        expected = [os.path.join(self.root, name) for name in
+                    ['a.DCM', os.path.join('sub', 'b.Dicom'), os.path.join('sub', 'c.dcm')]]
+        self.assertEqual(found, expected)
+        self.assertEqual(worklist.scan(self.root), expected)
+        self.assertEqual(paired, expected)
+
+    def test_export_jsonl(self):
+        """All annotations of all files end up in the export"""
+        output = os.path.join(self.root, 'export.jsonl')
+        files, annotations, errors = batch.export(self.root, output, 'jsonl', processes=1)
+        self.assertEqual((files, annotations, errors), (2, 4, []))
+        rows = [json.loads(l) for l in open(output)]
+        self.assertEqual(sorted(r['label'] for r in rows), ['amarker', 'amarker', 'arect', 'arect'])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
@@ -0,0 +1,55 @@
+"""
+Test cases for the geometry of contour annotations
+"""
+
+import base64
+import unittest
+
+import numpy as np
+
+from clinicalgraphics import contours
+
+
+class TestContours(unittest.TestCase):
+
+    def test_simplify(self):
+        """Simplified strokes keep their end points, and stay within the tolerance"""
+        x = np.arange(200)
+        stroke = np.column_stack([x, 10 * np.sin(x / 20.0)])
+        simple = contours.simplify(stroke, 1.0)
+        self.assertLess(len(simple), 40)
+        self.assertEqual(simple[0].tolist(), [0, 0])
+        self.assertEqual(simple[-1].tolist(), stroke[-1].astype(np.int32).tolist())
+        error = np.abs(np.interp(x, simple[:, 0], simple[:, 1]) - stroke[:, 1])
+        self.assertLess(error.max(), 2.0)       #tolerance, plus rounding to integer vertices
+
+    def test_distance(self):
+        square = np.array([(0, 0), (10, 0), (10, 10), (0, 10)])
+        inside, edge = contours.distance([square, square + 100], (5, 2))
+        self.assertEqual(inside.tolist(), [True, False])
+        self.assertAlmostEqual(edge[0], 2)
+
+    def test_encode(self):
+        for vertices in [[(0, 0), (1, 2), (3, -4)], [(70000, 5), (0, 0), (200, 100)], [(5, 5)]]:
+            code = contours.encode(vertices)
+            self.assertEqual(contours.decode(code).tolist(), [list(v) for v in vertices])
+        self.assertEqual(contours.encode([(0, 0), (1, 2)])[0], 'b')
+        self.assertEqual(contours.decode([[1, 2], [3, 4]]).tolist(), [[1, 2], [3, 4]])
+        for invalid in ['', 'x1234', 'b!!', [1, 2, 3], None]:
+            self.assertRaises(ValueError, contours.decode, invalid)
+
+    def test_encode_range(self):
+        """Deltas beyond int32 use a wider type; vertices beyond int32 are rejected rather than wrapped"""
+        extreme = [(-2 ** 31, 2 ** 31 - 1), (2 ** 31 - 1, -2 ** 31), (0, 0)]
+        code = contours.encode(extreme)
+        self.assertEqual(code[0], 'q')
+        self.assertEqual(contours.decode(code).tolist(), [list(v) for v in extreme])
+        self.assertEqual(contours.encode([(0, 0), (70000, 0)])[0], 'i')
+        self.assertRaises(ValueError, contours.encode, [(0, 0), (2 ** 31, 0)])
+
+        #a delta pushing a vertex beyond int32 on decoding
+        self.assertRaises(ValueError, contours.decode, 'q' + base64.b64encode(
+            np.array([2 ** 31 - 1, 0], '<i4').tostring() + np.array([1, 0], '<i8').tostring()))
+        for invalid in [[(0, 0), (10.5, 0)], [(0, 0), (2 ** 31, 0)], [(0, 0), (float('nan'), 0)]]:
+            self.assertRaises(ValueError, contours.decode, invalid)
+        self.assertEqual(contours.decode([(0.0, 1.0), (2, 3)]).dtype, np.int32)
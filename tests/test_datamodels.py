@@ -26,12 +26,18 @@ example_JSON = """
 """
 
 import tempfile
+import threading
 import os
 import json
 
 import unittest
 
-from clinicalgraphics.datamodels import DataModel
+import numpy as np
+
+from clinicalgraphics.datamodels import DataModel, Marker, Polygon, Freehand
+from clinicalgraphics import contours
+from clinicalgraphics.store import InvalidAnnotation
+from clinicalgraphics.journal import Compactor
 
 
 class TestModel(unittest.TestCase):
@@ -52,6 +58,41 @@ class TestModel(unittest.TestCase):
         for e, t in zip(json.loads(example_JSON), json.load(open(self.fname))):
             self.assertDictEqual(e, t, "Unable to handle annotation: "+ str(e))
 
+    def test_coordinates(self):
+        """Integral float coordinates round trip; fractional and out of range ones are rejected, not truncated"""
+        records = json.loads(example_JSON)
+        records[1].update(c0=1633.0, c1=969.0)
+        with open(self.fname, 'w') as fh:
+            json.dump(records, fh)
+        datamodel = DataModel(None, self.fname)
+        datamodel.save()
+        self.assertEqual(json.load(open(self.fname))[1], json.loads(example_JSON)[1])
+
+        for c0 in [10.7, 3000000000, float('nan')]:
+            records[1]['c0'] = c0
+            with open(self.fname, 'w') as fh:
+                json.dump(records, fh)
+            self.assertRaises(InvalidAnnotation, DataModel, None, self.fname)
+
+    def test_load_invalid(self):
+        """A sidecar with a bad record, or which breaks off, raises rather than loading and saving as empty"""
+        text = '[{"type": "Marker", "label": "good", "c0": 1, "c1": 2}, ' \
+               '{"type": "Marker", "label": "bad", "c0": 1e12, "c1": NaN}]'
+        for contents in [text, text[:70], 'not json']:
+            with open(self.fname, 'w') as fh:
+                fh.write(contents)
+            self.assertRaises(InvalidAnnotation, DataModel, None, self.fname)
+            self.assertEqual(open(self.fname).read(), contents, "Sidecar overwritten")
+
+        with open(self.fname, 'w') as fh:
+            fh.write(text.replace('1e12', '3').replace('NaN', '4'))
+        datamodel = DataModel(None, self.fname)
+        datamodel.save()
+        self.assertEqual([r['label'] for r in json.load(open(self.fname))], ['good', 'bad'])
+
+        open(self.fname, 'w').close()
+        self.assertEqual(DataModel(None, self.fname).annotations, 0)
+
     def test_select_delete(self):
         """Test selecting and deleting one of the annotations"""
         datamodel = DataModel(None, self.fname)
@@ -62,9 +103,176 @@ class TestModel(unittest.TestCase):
         datamodel.delete_selected()
         self.assertEqual(datamodel.annotations, annotations-1, "Deleting selected annotation failed")
 
+    def test_select_nearest(self):
+        """Test that of multiple overlapping hits, the nearest annotation is selected"""
+        datamodel = DataModel(None, self.fname)
+        near = Marker('near', 1653, 969)
+        datamodel.add_annotation(near)
+        self.assertEqual(datamodel.select((1660, 969)), near, "Nearest annotation not selected")
+
+    def test_select_moved(self):
+        """Test that annotations can be selected at their new position after moving"""
+        datamodel = DataModel(None, self.fname)
+        annotation = datamodel._annotations[1]
+        datamodel.move(annotation, (1000, 1000))
+        self.assertIsNone(datamodel.select((1633, 969)), "Moved annotation selected at old position")
+        self.assertEqual(datamodel.select(annotation.center), annotation, "Cannot select moved annotation")
+
+    def test_add_save(self):
+        """Test that an added annotation is stored and saved after the loaded ones"""
+        datamodel = DataModel(None, self.fname)
+        marker = Marker('added', 10, 20)
+        datamodel.add_annotation(marker)
+        datamodel.move(marker, (1, 2))
+        datamodel.save()
+        saved = json.load(open(self.fname))
+        self.assertEqual(len(saved), 3, "Added annotation not saved")
+        self.assertDictEqual(saved[-1], {'type': 'Marker', 'label': 'added', 'c0': 11, 'c1': 22})
+
+    def test_frames(self):
+        """Test that annotations are selected only on their own frame, and saved with it"""
+        datamodel = DataModel(None, self.fname)
+        marker = Marker('second', 10, 20, frame=1)
+        datamodel.add_annotation(marker)
+        self.assertIsNone(datamodel.select((10, 20)), "Annotation selected on another frame")
+        datamodel.frame = 1
+        self.assertEqual(datamodel.select((10, 20)), marker, "Cannot select annotation on its frame")
+        datamodel.save()
+        saved = json.load(open(self.fname))
+        self.assertEqual(saved[:2], json.loads(example_JSON), "Frame stored for first frame annotations")
+        self.assertEqual(saved[-1]['frame'], 1, "Frame not saved")
+        self.assertEqual(DataModel(None, self.fname)._annotations[2].frame, 1, "Frame not loaded")
+
+    def test_journal(self):
+        """Test that journaled edits are replayed on load, and survive compaction"""
+        datamodel = DataModel(None, self.fname, journaled=True)
+        datamodel.add_annotation(Marker('added', 10, 20))
+        datamodel.move(datamodel._annotations[1], (1, 1))
+        datamodel.select(datamodel._annotations[0].center)
+        datamodel.delete_selected()
+        expected = datamodel._annotations.to_json()
+        datamodel.close()
+        self.assertEqual(json.load(open(self.fname)), json.loads(example_JSON), "Sidecar written before compaction")
+
+        datamodel = DataModel(None, self.fname, journaled=True)
+        self.assertEqual(datamodel._annotations.to_json(), expected, "Journal not replayed")
+        datamodel.relabel(datamodel._annotations[0], 'relabeled')
+        datamodel.save()
+        datamodel.relabel(datamodel._annotations[1], 'after')
+        expected = datamodel._annotations.to_json()
+        datamodel.close()
+
+        datamodel = DataModel(None, self.fname, journaled=True)
+        self.assertEqual(datamodel._annotations.to_json(), expected, "Edits lost after compaction")
+        datamodel.close()
+        datamodel.close()
+        self.assertFalse(any(t.is_alive() for t in threading.enumerate() if isinstance(t, Compactor)),
+                         "Compaction not stopped on close")
+
+    def test_undo_redo(self):
+        """Test undoing and redoing edits, with the moves of a drag merged into one"""
+        datamodel = DataModel(None, self.fname, journaled=True)
+        original = datamodel._annotations.to_json()
+        marker = Marker('added', 10, 20)
+        datamodel.add_annotation(marker)
+        for i in range(10):
+            datamodel.move(marker, (1, 2), merge=i > 0)
+        datamodel.relabel(marker, 'relabeled')
+        datamodel.select(datamodel._annotations[0].center)
+        datamodel.delete_selected()
+        self.assertEqual(len(datamodel.history), 4, "Drag moves not merged")
+        edited = datamodel._annotations.to_json()
+
+        datamodel.undo()
+        self.assertEqual(datamodel.annotations, 3, "Delete not undone")
+        datamodel.undo()
+        self.assertEqual(marker.label, 'added', "Relabel not undone")
+        datamodel.undo()
+        self.assertEqual(marker.coords, (10, 20), "Drag not undone as a whole")
+        datamodel.undo()
+        self.assertFalse(datamodel.undo(), "Undo beyond the first edit")
+        self.assertEqual(datamodel._annotations.to_json(), original)
+
+        while datamodel.redo():
+            pass
+        self.assertEqual(datamodel._annotations.to_json(), edited, "Edits not redone")
+        expected = datamodel._annotations.to_json()
+        datamodel.close()
+
+        datamodel = DataModel(None, self.fname, journaled=True)
+        self.assertEqual(datamodel._annotations.to_json(), expected, "Undo and redo not journaled")
+        datamodel.close()
+
+    def test_bulk(self):
+        """Test bulk queries and edits, and undoing them as one edit"""
+        datamodel = DataModel(None, self.fname, journaled=True)
+        for i in range(100):
+            datamodel.add_annotation(Marker('m{0}'.format(i % 3), i * 10, 0))
+        original = datamodel._annotations.to_json()
+
+        markers = datamodel.query(label='m0')
+        self.assertEqual(len(markers), 34)
+        self.assertEqual(len(datamodel.query(bbox=(0, 95, -10, 10))), 10)
+        self.assertEqual(datamodel.translate((5, 5), markers), 34)
+        self.assertEqual(len(datamodel.query(label='m0', bbox=(0, 4, -10, 10))), 0)
+        datamodel.scale(2, selection=datamodel.query(label='m1'))
+        datamodel.remap_labels({'m2': 'two'})
+        self.assertEqual(len(datamodel.query(label='two')), 33)
+        mask = [a.label == 'amarker' for a in datamodel._annotations]
+        self.assertEqual(datamodel.delete_where(mask), 1)
+        self.assertEqual(datamodel.annotations, 101)
+        edited = datamodel._annotations.to_json()
+
+        for i in range(4):
+            datamodel.undo()
+        self.assertEqual(datamodel._annotations.to_json(), original, "Bulk edits not undone")
+        while datamodel.redo():
+            pass
+        self.assertEqual(datamodel._annotations.to_json(), edited, "Bulk edits not redone")
+        datamodel.close()
+
+        datamodel = DataModel(None, self.fname, journaled=True)
+        self.assertEqual(datamodel._annotations.to_json(), edited, "Bulk edits not journaled")
+        datamodel.close()
+
+    def test_polygons(self):
+        """Test hit-testing, editing and storing polygon and freehand contours"""
+        datamodel = DataModel(None, self.fname, journaled=True)
+        triangle = Polygon('triangle', [(0, 0), (400, 0), (0, 400)])
+        datamodel.add_annotation(triangle)
+        t = np.linspace(0, 2 * np.pi, 1000, endpoint=False)
+        stroke = np.column_stack([3000 + 500 * np.cos(t), 3000 + 300 * np.sin(t)])
+        ring = Freehand('ring', contours.simplify(stroke, Freehand.tolerance))
+        datamodel.add_annotation(ring)
+        self.assertLess(len(ring.vertices), 100, "Stroke not simplified")
+
+        self.assertEqual(datamodel.select((100, 100)), triangle, "Cannot select inside polygon")
+        self.assertIsNone(datamodel.select((350, 350)), "Polygon selected within its box but outside its edges")
+        self.assertEqual(datamodel.select((3000, 3000)), ring, "Cannot select inside contour")
+        self.assertEqual(datamodel.select((3520, 3000)), ring, "Cannot select near contour edge")
+
+        datamodel.move(triangle, (10, 20))
+        self.assertEqual(triangle.vertices.tolist(), [[10, 20], [410, 20], [10, 420]])
+        datamodel.scale(2, selection=datamodel.query(label='triangle'))
+        self.assertEqual(triangle.vertices.tolist(), [[20, 40], [820, 40], [20, 840]])
+        datamodel.undo()
+        self.assertEqual((triangle.l0, triangle.h0), (10, 410), "Scale not undone")
+        expected = datamodel._annotations.to_json()
+        datamodel.close()
+
+        datamodel = DataModel(None, self.fname, journaled=True)
+        self.assertEqual(datamodel._annotations.to_json(), expected, "Contour edits not journaled")
+        datamodel.save()
+        datamodel.close()
+        saved = json.load(open(self.fname))
+        self.assertLess(len(json.dumps(saved[-1])), 400, "Vertices not stored compactly")
+        self.assertTrue(np.array_equal(contours.decode(saved[-1]['vertices']), ring.vertices))
+
     def tearDown(self):
         """Remove the """
         os.remove(self.fname)
+        if os.path.exists(self.fname + '.journal'):
+            os.remove(self.fname + '.journal')
 
 
 
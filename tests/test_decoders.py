@@ -0,0 +1,85 @@
+"""
+Test cases for decoding compressed pixel data
+"""
+
+import tempfile
+import shutil
+import os
+
+import unittest
+
+import numpy as np
+
+from clinicalgraphics import decoders
+from clinicalgraphics.datamodels import DataModel
+from synthetic import write_dicom, packbits
+
+
+class TestDecoders(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'image.dcm')
+        image = np.random.RandomState(0).randint(0, 4096, (3, 60, 100))
+        image[:, 10:30, 20:80] = 1000       #long runs
+        self.image = image
+
+    def test_packbits(self):
+        data = b'\0' * 300 + b'abcabc' + b'x' * 3 + b'y'
+        self.assertEqual(decoders.packbits(packbits(data)), data)
+
+    def test_rle(self):
+        """RLE frames are decoded without pydicom, and cached"""
+        self.assertIsNotNone(decoders.decoder_for('1.2.840.10008.1.2.5'))
+        write_dicom(self.path, self.image, frames=3, rle=True)
+        datamodel = DataModel(self.path)
+        self.assertTrue(datamodel.pixels.compressed)
+        datamodel.frame = 1
+        frame = datamodel.data
+        self.assertTrue(np.array_equal(frame, self.image[1]))
+        self.assertFalse(frame.flags.writeable)
+        self.assertFalse(datamodel.pixels.loaded)
+        self.assertIs(datamodel.pixels.frame(1), frame)
+        self.assertTrue(np.array_equal(datamodel.pixels.array, self.image))
+
+    def test_readahead(self):
+        """A frame missing from the cache is decoded in one batch with the next frames not yet cached"""
+        image = np.concatenate([self.image] * 2)
+        write_dicom(self.path, image, frames=6, rle=True)
+        pixels = DataModel(self.path).pixels
+        batches = []
+        decode_frames = decoders.decode_frames
+
+        def counted(transfer_syntax, frames, format):
+            batches.append(len(frames))
+            return decode_frames(transfer_syntax, frames, format)
+        decoders.decode_frames = counted
+        try:
+            for i in range(6):
+                self.assertTrue(np.array_equal(pixels.frame(i), image[i]))
+        finally:
+            decoders.decode_frames = decode_frames
+        self.assertEqual(batches, [4, 2])
+        self.assertFalse(pixels.frame(5).flags.writeable)
+        self.assertFalse(pixels.loaded)
+
+    def test_single(self):
+        write_dicom(self.path, self.image[0], rle=True)
+        datamodel = DataModel(self.path)
+        self.assertTrue(np.array_equal(datamodel.data, self.image[0]))
+
+    def test_parallel(self):
+        """Frames, and the segments of a single frame, are decoded in the process pool"""
+        threshold = decoders.PARALLEL_BYTES
+        decoders.PARALLEL_BYTES = 0
+        try:
+            write_dicom(self.path, self.image, frames=3, rle=True)
+            self.assertTrue(np.array_equal(DataModel(self.path).pixels.array, self.image))
+            path = os.path.join(self.root, 'single.dcm')
+            write_dicom(path, self.image[2], rle=True)
+            self.assertTrue(np.array_equal(DataModel(path).data, self.image[2]))
+        finally:
+            decoders.PARALLEL_BYTES = threshold
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
@@ -0,0 +1,52 @@
+"""
+Test cases for the window/level display pipeline
+"""
+
+import unittest
+
+import numpy as np
+
+from clinicalgraphics.display import Pipeline
+
+
+class Header(object):
+    """Minimal stand-in for the DICOM header fields used by the pipeline"""
+    RescaleSlope = 2
+    RescaleIntercept = -1024
+    WindowCenter = [40, 400]
+    WindowWidth = [400, 2000]
+
+
+class TestDisplay(unittest.TestCase):
+
+    def setUp(self):
+        self.palette = np.repeat(np.arange(256, dtype=np.uint8)[:, None], 4, axis=1)
+        self.image = np.random.RandomState(0).randint(-2000, 2000, (64, 48)).astype(np.int16)
+
+    def test_lut(self):
+        """The lookup table path matches direct evaluation of the window function"""
+        pipeline = Pipeline(Header(), self.palette)
+        self.assertEqual(pipeline.window, (40.0, 400.0))
+        rgba = pipeline.render(self.image)
+        self.assertEqual(rgba.shape, self.image.shape + (4,))
+        self.assertTrue(np.array_equal(rgba[..., 0], pipeline.grey(self.image)))
+
+    def test_cache(self):
+        """The display buffer is cached until the window changes"""
+        pipeline = Pipeline(Header(), self.palette)
+        rgba = pipeline.render(self.image)
+        self.assertIs(pipeline.render(self.image), rgba)
+        pipeline.set_window(0, 100)
+        self.assertIsNot(pipeline.render(self.image), rgba)
+
+    def test_big_endian(self):
+        """Byte order of the stored values is respected"""
+        pipeline = Pipeline(Header(), self.palette)
+        swapped = self.image.astype('>i2')
+        self.assertTrue(np.array_equal(pipeline.render(swapped), pipeline.render(self.image)))
+
+    def test_float(self):
+        """Images without a lookup table are colormapped in blocks, matching direct evaluation"""
+        pipeline = Pipeline(Header(), self.palette)
+        image = np.random.RandomState(1).uniform(-2000, 2000, (1500, 400)).astype(np.float32)
+        self.assertTrue(np.array_equal(pipeline.render(image), self.palette[pipeline.grey(image)]))
@@ -0,0 +1,67 @@
+"""
+Test cases for the archive index
+"""
+
+import tempfile
+import shutil
+import os
+
+import unittest
+
+import numpy as np
+
+from clinicalgraphics.index import Index
+from clinicalgraphics import decoders
+from test_datamodels import example_JSON
+from synthetic import write_dicom
+
+
+class TestIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'sub'))
+        self.image = np.arange(200 * 300).reshape(200, 300) % 4096
+        for name in ['a.dcm', os.path.join('sub', 'b.dcm')]:
+            write_dicom(os.path.join(self.root, name), self.image)
+        with open(os.path.join(self.root, 'a.json'), 'w') as fh:
+            fh.write(example_JSON)
+
+    def test_update(self):
+        """Headers, thumbnails and labels are indexed, and only modified files rescanned"""
+        index = Index(self.root)
+        self.assertEqual(index.update(processes=1), (2, []))
+        a = os.path.join(self.root, 'a.dcm')
+        self.assertEqual([r['path'] for r in index.query(label='amarker')], [a])
+        self.assertEqual(len(index.query(annotated=False)), 1)
+        self.assertEqual(index.labels(a), {'arect': 1, 'amarker': 1})
+        thumbnail = index.thumbnail(a)
+        self.assertEqual(thumbnail.dtype, np.uint8)
+        self.assertTrue(max(thumbnail.shape) <= 64)
+        self.assertEqual(index.update(processes=1), (0, []))
+
+        os.remove(os.path.join(self.root, 'a.json'))
+        self.assertEqual(index.update(processes=1), (1, []))
+        self.assertEqual(index.query(annotated=True), [])
+        index.close()
+
+        os.remove(os.path.join(self.root, 'sub', 'b.dcm'))
+        index = Index(self.root)
+        self.assertEqual(index.update(processes=1), (0, []))
+        self.assertEqual([r['path'] for r in index.query()], [a])
+        self.assertEqual(index.labels(), {})
+        index.close()
+
+    def test_compressed(self):
+        """Large compressed files are decoded within the pool workers of the index, not in a nested pool"""
+        image = np.random.RandomState(0).randint(0, 65536, (1024, 1024))
+        path = os.path.join(self.root, 'sub', 'b.dcm')
+        write_dicom(path, image, rle=True)
+        self.assertGreater(os.path.getsize(path), decoders.PARALLEL_BYTES)
+        index = Index(self.root)
+        self.assertEqual(index.update(processes=1), (2, []))
+        self.assertIsNotNone(index.thumbnail(path))
+        index.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
@@ -0,0 +1,49 @@
+"""
+Test cases for the instrumentation of the hot paths
+"""
+
+import tempfile
+import os
+import json
+
+import unittest
+
+from clinicalgraphics import instrument
+from clinicalgraphics.datamodels import DataModel
+from test_datamodels import example_JSON
+
+
+class TestInstrument(unittest.TestCase):
+
+    def setUp(self):
+        self.fname = tempfile.mktemp()
+        with open(self.fname, 'w') as fh:
+            fh.write(example_JSON)
+        self.report = tempfile.mktemp()
+        instrument.stats.reset()
+
+    def test_disabled(self):
+        """Nothing is recorded unless instrumentation is enabled"""
+        datamodel = DataModel(None, self.fname)
+        datamodel.select((0, 0))
+        self.assertEqual(instrument.stats.to_json()['stages'], {})
+
+    def test_report(self):
+        """Timed stages are counted, and written to the report"""
+        instrument.enable(self.report, interval=60)
+        try:
+            datamodel = DataModel(None, self.fname)
+            for i in range(3):
+                datamodel.select((0, 0))
+            datamodel.save()
+        finally:
+            instrument.disable()
+        stages = json.load(open(self.report))['stages']
+        self.assertEqual(stages['select']['count'], 3)
+        self.assertEqual(stages['load_metadata']['count'], 1)
+        self.assertEqual(stages['save']['count'], 1)
+
+    def tearDown(self):
+        for path in [self.fname, self.report]:
+            if os.path.exists(path):
+                os.remove(path)
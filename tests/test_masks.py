@@ -0,0 +1,105 @@
+"""
+Test cases for the rasterized label mask export
+"""
+
+import tempfile
+import shutil
+import os
+import json
+
+import unittest
+
+import numpy as np
+
+from clinicalgraphics import masks
+from clinicalgraphics.datamodels import DataModel, Rectangle, Marker, Polygon
+from synthetic import write_dicom
+
+
+class TestMasks(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'image.dcm')
+        write_dicom(self.path, np.zeros((2, 60, 100)), frames=2)
+        datamodel = DataModel(self.path)
+        datamodel.add_annotation(Rectangle('box', 10, 30, 5, 15))
+        datamodel.add_annotation(Polygon('triangle', [(20, 10), (60, 10), (20, 50)]))
+        datamodel.add_annotation(Marker('point', 90, 50))
+        datamodel.add_annotation(Marker('point', 5, 5, frame=1))
+        datamodel.add_annotation(Marker('other', 6, 6, frame=1))
+        datamodel.save()
+        self.labels = ['box', 'point', 'triangle']
+
+    def test_rasterize(self):
+        """Regions are painted, markers on top; unknown labels are skipped"""
+        frames = list(masks.rasterize(DataModel(self.path), self.labels, radius=1))
+        self.assertEqual(len(frames), 2)
+        mask = frames[0][1]
+        self.assertEqual((mask.shape, mask.dtype), ((60, 100), np.uint8))
+        self.assertEqual(mask[7, 12], 1)
+        self.assertEqual(mask[12, 25], 3, "Polygon with a later label not painted over rectangle")
+        self.assertEqual(mask[40, 50], 0, "Pixel outside the polygon painted")
+        self.assertEqual(mask[35, 22], 3)
+        self.assertEqual((mask == 2).sum(), 5, "Marker not painted as a disk")
+        mask = frames[1][1]
+        self.assertEqual(mask[5, 5], 2)
+        self.assertEqual(mask[6, 6], 0, "Marker with label outside the vocabulary painted")
+
+    def test_overlap(self):
+        """All regions of a frame are painted at once, equal to painting each pixel inside them,
+        with the later label of the vocabulary on top where they overlap"""
+        random = np.random.RandomState(0)
+        path = os.path.join(self.root, 'random.dcm')
+        write_dicom(path, np.zeros((60, 100)))
+        datamodel = DataModel(path)
+        reference = np.zeros((60, 100), np.uint8)
+        y, x = np.mgrid[:60, :100] + 0.5
+        regions = []
+        for i in range(30):
+            label = random.randint(3)
+            if i % 2:
+                l0, l1 = random.randint(-10, 100, 2)
+                h0, h1 = l0 + random.randint(1, 25), l1 + random.randint(1, 15)
+                datamodel.add_annotation(Rectangle(self.labels[label], l0, h0, l1, h1))
+                inside = (x >= l0) & (x < h0) & (y >= l1) & (y < h1)
+            else:
+                vertices = random.randint(-5, 105, 2) + random.randint(-15, 15, (random.randint(3, 7), 2))
+                datamodel.add_annotation(Polygon(self.labels[label], vertices))
+                #even-odd rule, at the center of each pixel
+                inside = np.zeros(x.shape, np.bool_)
+                for (x0, y0), (x1, y1) in zip(vertices, np.roll(vertices, -1, axis=0)):
+                    if y0 != y1:
+                        inside ^= ((y0 <= y) != (y1 <= y)) & (x < x0 + (y - y0) * (x1 - x0) / float(y1 - y0))
+            regions.append((label + 1, inside))
+        for value, inside in sorted(regions, key=lambda r: r[0]):
+            reference[inside] = value
+        frame, mask = next(masks.rasterize(datamodel, self.labels))
+        self.assertTrue(np.array_equal(mask, reference))
+
+    def test_formats(self):
+        """Masks read back from each format are equal"""
+        expected = np.array([m for f, m in masks.rasterize(DataModel(self.path), self.labels)])
+        output = os.path.join(self.root, 'mask')
+        masks.export_file(self.path, None, output + '.npy', self.labels, 'npy')
+        self.assertTrue(np.array_equal(np.load(output + '.npy'), expected))
+        masks.export_file(self.path, None, output + '.npz', self.labels, 'npz')
+        data = np.load(output + '.npz')
+        self.assertEqual(list(data['labels']), self.labels)
+        self.assertTrue(np.array_equal(data['frame_00001'], expected[1]))
+        masks.export_file(self.path, None, output + '.rle', self.labels, 'rle')
+        data = np.load(output + '.rle')
+        decoded = masks.rle_decode(data['values_00000'], data['lengths_00000'], data['shape'])
+        self.assertTrue(np.array_equal(decoded, expected[0]))
+
+    def test_export(self):
+        """Directory export builds a shared vocabulary of all labels in use"""
+        output = os.path.join(self.root, 'masks')
+        files, annotations, errors = masks.export(self.root, output, processes=1)
+        self.assertEqual((files, annotations, errors), (1, 5, []))
+        labels = json.load(open(os.path.join(output, 'labels.json')))
+        self.assertEqual(labels, ['box', 'other', 'point', 'triangle'])
+        self.assertEqual(np.load(os.path.join(output, 'image.npz'))['frame_00001'][6, 6], 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
@@ -0,0 +1,90 @@
+"""
+Test cases for pixel data access, and the memory used per open image
+"""
+
+import tempfile
+import shutil
+import os
+
+import unittest
+
+import numpy as np
+import dicom
+
+from clinicalgraphics.datamodels import DataModel
+from clinicalgraphics.pyramid import Pyramid, footprint
+from clinicalgraphics.display import Pipeline
+from synthetic import write_dicom
+
+
+class TestPixels(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'image.dcm')
+        self.image = np.random.RandomState(0).randint(0, 4096, (3, 600, 1000))
+        write_dicom(self.path, self.image, frames=3)
+
+    def test_frames(self):
+        """Frames are read-only views on the mapped pixel data"""
+        datamodel = DataModel(self.path)
+        self.assertEqual(datamodel.frames, 3)
+        self.assertEqual(datamodel.shape, (600, 1000))
+        datamodel.frame = 2
+        frame = datamodel.data
+        self.assertTrue(np.array_equal(frame, self.image[2]))
+        self.assertFalse(frame.flags.writeable)
+        self.assertTrue(np.may_share_memory(frame, datamodel.pixels.array))
+
+    def test_pydicom(self):
+        """Mapped pixels equal those decoded by pydicom, after a long header, for single and multi-frame files"""
+        single = os.path.join(self.root, 'single.dcm')
+        write_dicom(single, self.image[0])
+        for path in [self.path, single]:
+            ds = dicom.read_file(path)
+            ds.PatientName = 'Header^Padding'
+            ds.ImageComments = 'x' * 1001
+            ds.StudyDescription = 'odd length'
+            ds.PixelRepresentation = 1
+            ds.save_as(path)
+            expected = dicom.read_file(path).pixel_array
+            pixels = DataModel(path).pixels
+            self.assertGreater(pixels.offset, 1132)
+            self.assertIsInstance(pixels.array, np.memmap)
+            self.assertEqual(pixels.dtype.kind, 'i')
+            self.assertEqual(pixels.array.shape, expected.shape)
+            self.assertTrue(np.array_equal(pixels.array, expected))
+            frames = expected.reshape((-1,) + expected.shape[-2:])
+            for i, frame in enumerate(frames):
+                self.assertTrue(np.array_equal(pixels.frame(i), frame))
+
+    def test_preview(self):
+        """Previews are subsampled copies of a frame"""
+        datamodel = DataModel(self.path)
+        preview = datamodel.pixels.preview(1, 256)
+        self.assertTrue(max(preview.shape) <= 256)
+        self.assertTrue(np.array_equal(preview, self.image[1, ::4, ::4]))
+
+    def test_footprint(self):
+        """The image is shared rather than copied, and the estimated memory use is accurate"""
+        datamodel = DataModel(self.path)
+        image = datamodel.data
+        pyramid = Pyramid(image)
+        levels = [pyramid[i] for i in range(len(pyramid))]
+        self.assertIs(levels[0], image)
+        self.assertFalse(any(l.flags.writeable for l in levels))
+
+        pipeline = Pipeline(datamodel.header, np.zeros((256, 4), np.uint8))
+        pipeline.auto_window(levels[-1])
+        rgba = pipeline.render(image)
+        self.assertFalse(np.may_share_memory(rgba, image))
+
+        estimate = footprint(datamodel.pixels)
+        self.assertEqual(estimate['mapped'], datamodel.pixels.nbytes)
+        self.assertEqual(estimate['decoded'], 0)
+        self.assertEqual(estimate['pyramid'], sum(l.nbytes for l in levels[1:]))
+        self.assertEqual(estimate['display'], rgba.nbytes)
+        self.assertEqual(estimate['lut'], pipeline.lut(image.dtype).nbytes)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
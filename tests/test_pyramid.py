@@ -0,0 +1,54 @@
+"""
+Test cases for the image pyramid: level selection and downsampling
+"""
+
+import unittest
+
+import numpy as np
+
+from clinicalgraphics.pyramid import Pyramid, downsample
+
+
+class TestPyramid(unittest.TestCase):
+
+    def test_level_for(self):
+        """The coarsest level with at least one pixel per screen pixel is chosen, up to the coarsest level"""
+        pyramid = Pyramid(np.zeros((3000, 2000), np.uint16))
+        self.assertEqual(len(pyramid), 5)
+        for scale, level in [(0, 0), (0.5, 0), (1, 0), (1.5, 0), (2, 1), (3.9, 1), (4, 2),
+                             (15.9, 3), (16, 4), (1e6, 4), (float('nan'), 0)]:
+            self.assertEqual(pyramid.level_for(scale), level, "Level for scale {0}".format(scale))
+        self.assertEqual(Pyramid(np.zeros((100, 100), np.uint16)).level_for(8), 0)
+
+    def test_odd_sizes(self):
+        """A trailing odd row or column is kept, averaged over its partial blocks, at every level"""
+        image = np.arange(35, dtype=np.uint16).reshape(5, 7) * 4
+        half = downsample(image)
+        self.assertEqual(half.shape, (3, 4))
+        self.assertEqual(half.dtype, image.dtype)
+        self.assertEqual(half[0, 0], image[:2, :2].mean())
+        self.assertEqual(half[1, 3], image[2:4, 6].mean(), "Last column misaligned")
+        self.assertEqual(half[2, 1], image[4, 2:4].mean(), "Last row misaligned")
+        self.assertEqual(half[2, 3], image[4, 6])
+
+        #constant over aligned 4x4 blocks, so that each pixel of levels 0 to 2 takes the value of its block
+        rows, columns = np.mgrid[:9, :7]
+        image = ((rows // 4) * 10 + columns // 4).astype(np.uint8)
+        pyramid = Pyramid(np.dstack([image] * 3), minsize=2)
+        self.assertEqual([pyramid[i].shape for i in range(len(pyramid))],
+                         [(9, 7, 3), (5, 4, 3), (3, 2, 3), (2, 1, 3)])
+        for level in range(3):
+            step = 2 ** level
+            i, j = np.mgrid[:pyramid[level].shape[0], :pyramid[level].shape[1]]
+            expected = (i * step // 4) * 10 + j * step // 4
+            self.assertTrue(np.array_equal(pyramid[level][..., 1], expected), "Level {0} misaligned".format(level))
+
+    def test_even_sizes(self):
+        """Even sizes are averaged in exact 2x2 blocks"""
+        image = np.random.RandomState(1).randint(0, 4096, (6, 8)).astype(np.uint16)
+        expected = image.reshape(3, 2, 4, 2).astype(np.float32).mean(axis=(1, 3)).astype(np.uint16)
+        self.assertTrue(np.array_equal(downsample(image), expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+"""
+Test cases for the binary sidecar format
+"""
+
+import tempfile
+import shutil
+import json
+import os
+
+import unittest
+
+import numpy as np
+
+from clinicalgraphics.datamodels import DataModel, Rectangle, Marker, Polygon
+from clinicalgraphics import sidecar
+from clinicalgraphics.store import InvalidAnnotation
+from test_datamodels import example_JSON
+
+
+class TestSidecar(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.json = os.path.join(self.root, 'image.json')
+        self.cgs = os.path.join(self.root, 'image.cgs')
+        with open(self.json, 'w') as fh:
+            fh.write(example_JSON)
+
+    def test_round_trip(self):
+        """All annotation types survive conversion in both directions, in order of insertion"""
+        datamodel = DataModel(None, self.json)
+        datamodel.add_annotation(Polygon('triangle', [(10, 10), (50, 12), (30, 40)], frame=2))
+        datamodel.add_annotation(Marker('amarker', 5, 6, frame=1))
+        datamodel.select(datamodel._annotations[0].center)
+        datamodel.delete_selected()
+        datamodel.save()
+        expected = datamodel._annotations.to_json()
+
+        sidecar.main([self.json, self.cgs])
+        self.assertTrue(sidecar.is_binary(self.cgs))
+        self.assertFalse(sidecar.is_binary(self.json))
+        loaded = DataModel(None, self.cgs)
+        self.assertEqual(loaded._annotations.to_json(), expected)
+        self.assertEqual(list(loaded.query(label='amarker', frame=1)), [loaded._annotations[2]])
+
+        back = os.path.join(self.root, 'back.json')
+        sidecar.convert(self.cgs, back)
+        self.assertEqual(json.load(open(back)), expected)
+
+    def test_columns(self):
+        """Columns are memory-mapped views with the documented layout"""
+        datamodel = DataModel(None, self.json)
+        datamodel.metadatapath = self.cgs
+        datamodel.save()
+        binary = sidecar.Sidecar(self.cgs)
+        self.assertEqual(binary.labels, ['arect', 'amarker'])
+        self.assertEqual(binary.types, ['Rectangle', 'Marker'])
+        self.assertEqual(binary.column('Rectangle', 'l1').tolist(), [1263])
+        self.assertEqual(binary.column('Marker', 'order').tolist(), [1])
+        self.assertIsInstance(binary.column('Marker', 'c0'), np.memmap)
+
+    def test_edit_journaled(self):
+        """Edits to a binary sidecar are journaled and compacted in the binary format"""
+        sidecar.convert(self.json, self.cgs)
+        os.remove(self.json)
+        datamodel = DataModel(None, self.cgs, journaled=True)
+        datamodel.add_annotation(Rectangle('added', 1, 2, 3, 4))
+        expected = datamodel._annotations.to_json()
+        datamodel.close()
+        datamodel = DataModel(None, self.cgs, journaled=True)
+        self.assertEqual(datamodel._annotations.to_json(), expected, "Journal not replayed on binary sidecar")
+        datamodel.save()
+        datamodel.close()
+        self.assertTrue(sidecar.is_binary(self.cgs))
+        self.assertEqual(DataModel(None, self.cgs)._annotations.to_json(), expected)
+
+    def test_compact(self):
+        """Binary sidecars of many annotations are much smaller than JSON ones, and detected by default"""
+        datamodel = DataModel(None, self.json)
+        markers = np.random.randint(0, 4096, (1000, 2))
+        for c0, c1 in markers.tolist():
+            datamodel.add_annotation(Marker('detection', c0, c1))
+        datamodel.save()
+        sidecar.convert(self.json, self.cgs)
+        self.assertLess(os.path.getsize(self.cgs) * 3, os.path.getsize(self.json))
+        os.remove(self.json)
+        self.assertEqual(sidecar.sidecar_path(os.path.join(self.root, 'image.dcm')), self.cgs)
+        self.assertEqual(len(DataModel(None, self.cgs)._annotations), 1002)
+
+    def test_convert_directory(self):
+        """Only the sidecars of DICOM files are converted; failures are reported, and the source replaced on request"""
+        other = os.path.join(self.root, 'sub', 'other.json')
+        os.mkdir(os.path.dirname(other))
+        for path in [os.path.join(self.root, 'image.dcm'), os.path.join(self.root, 'sub', 'other.dcm')]:
+            open(path, 'w').close()
+        with open(other, 'w') as fh:
+            fh.write('not json')
+        unrelated = [os.path.join(self.root, name) for name in ['.clinicalgraphics-labels.json', 'labels.json']]
+        for path in unrelated:
+            with open(path, 'w') as fh:
+                json.dump(['arect', 'amarker'], fh)
+
+        self.assertEqual(sidecar.main([self.root, '--to', 'cgs']), 1)
+        converted, errors = sidecar.convert_all(self.root, 'cgs', replace=True)
+        self.assertEqual((converted, [path for path, e in errors]), (1, [other]))
+        self.assertFalse(os.path.exists(self.json), "Source not replaced")
+        self.assertTrue(sidecar.is_binary(self.cgs))
+        self.assertEqual(sidecar.sidecar_path(os.path.join(self.root, 'image.dcm')), self.cgs)
+        self.assertEqual(json.load(open(unrelated[0])), ['arect', 'amarker'])
+        self.assertFalse(any(os.path.exists(os.path.splitext(path)[0] + '.cgs') for path in unrelated + [other]))
+
+        self.assertEqual(sidecar.convert_all(self.root, 'json'), (1, []))
+        self.assertEqual(DataModel(None, self.json)._annotations.to_json(),
+                         DataModel(None, self.cgs)._annotations.to_json())
+
+    def test_invalid(self):
+        """Corrupt binary sidecars raise rather than loading as empty, and are left as they are"""
+        sidecar.convert(self.json, self.cgs)
+        data = open(self.cgs, 'rb').read()
+        for corrupt in [data[:-8], data[:12]]:
+            with open(self.cgs, 'wb') as fh:
+                fh.write(corrupt)
+            self.assertRaises(InvalidAnnotation, DataModel, None, self.cgs)
+            self.assertEqual(open(self.cgs, 'rb').read(), corrupt)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
@@ -0,0 +1,56 @@
+"""
+Test cases for the interactive tools; skipped where enable is not installed
+"""
+
+import unittest
+
+import numpy as np
+
+from clinicalgraphics.display import Pipeline
+
+try:
+    from clinicalgraphics.tools import WindowLevelTool
+except ImportError:
+    WindowLevelTool = None
+
+
+class Event(object):
+    """Minimal stand-in for an enable mouse event"""
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+        self.handled = False
+
+
+class Parent(object):
+    """Minimal stand-in for the editor, recording the windows set"""
+    def __init__(self):
+        self.display = Pipeline(object(), np.zeros((256, 4), np.uint8))
+        self.windows = []
+
+    def set_window(self, center, width):
+        self.display.set_window(center, width)
+        self.windows.append(self.display.window)
+
+
+@unittest.skipIf(WindowLevelTool is None, 'enable is not installed')
+class TestWindowLevelTool(unittest.TestCase):
+
+    def test_drag_before_load(self):
+        """Dragging before the image has loaded does nothing, and continues once it has"""
+        parent = Parent()
+        tool = WindowLevelTool(None, parent)
+        tool.normal_left_down(Event(0, 0))
+        event = Event(10, 10)
+        tool.mousedown_mouse_move(event)
+        self.assertTrue(event.handled)
+        self.assertEqual(parent.windows, [])
+
+        parent.display.auto_window(np.array([0, 100]))
+        tool.mousedown_mouse_move(Event(20, 10))
+        tool.mousedown_mouse_move(Event(20, 10 + 256))
+        self.assertEqual(parent.windows, [(150.0, 100.0)])
+        tool.mousedown_left_up(Event(20, 266))
+
+
+if __name__ == '__main__':
+    unittest.main()
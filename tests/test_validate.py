@@ -0,0 +1,105 @@
+"""
+Test cases for the archive consistency checker
+"""
+
+import tempfile
+import shutil
+import os
+import json
+
+import unittest
+
+import numpy as np
+
+from clinicalgraphics import validate
+from clinicalgraphics.datamodels import DataModel, Marker, Polygon
+from synthetic import write_dicom
+
+
+class TestValidate(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'image.dcm')
+        self.sidecar = os.path.join(self.root, 'image.json')
+        write_dicom(self.path, np.zeros((2, 60, 100)), frames=2)
+        records = [
+            {'type': 'Rectangle', 'label': 'box', 'l0': 10, 'h0': 30, 'l1': 5, 'h1': 15},
+            {'type': 'Rectangle', 'label': 'inverted', 'l0': 30, 'h0': 10, 'l1': 5, 'h1': 15},
+            {'type': 'Marker', 'label': 'point', 'c0': 99, 'c1': 59},
+            {'type': 'Marker', 'label': 'outside', 'c0': 100, 'c1': 10},
+            {'type': 'Marker', 'label': 'point', 'c0': 99, 'c1': 59},
+            {'type': 'Marker', 'label': 'point', 'c0': 99, 'c1': 59, 'frame': 1},
+            {'type': 'Marker', 'label': 'late', 'c0': 1, 'c1': 1, 'frame': 2},
+            {'type': 'Polygon', 'label': 'triangle', 'vertices': [[20, 10], [60, 10], [20, 61]]},
+            {'type': 'Marker', 'label': 'bad', 'c0': 'x', 'c1': 1},
+            {'type': 'Ellipse', 'label': 'unknown'},
+        ]
+        with open(self.sidecar, 'w') as fh:
+            json.dump(records, fh)
+
+    def codes(self, entry):
+        return [(i['index'], i['code']) for i in entry['issues']]
+
+    def test_check_file(self):
+        """Every problem is reported once, at the position of its record in the sidecar file"""
+        entry = validate.check_file(self.path, self.sidecar)
+        self.assertEqual(entry['annotations'], 8)
+        self.assertEqual(self.codes(entry), [
+            (1, 'inverted'), (3, 'bounds'), (4, 'duplicate'), (6, 'frame'),
+            (7, 'bounds'), (8, 'attributes'), (9, 'type')])
+
+    def test_duplicates(self):
+        """Later copies of a marker are duplicates; without np.unique along an axis, missing before numpy 1.13"""
+        unique = np.unique
+
+        def unique_1_10(ar, *args, **kwargs):
+            if 'axis' in kwargs:
+                raise TypeError("unique() got an unexpected keyword argument 'axis'")
+            return unique(ar, *args, **kwargs)
+        np.unique = unique_1_10
+        self.addCleanup(setattr, np, 'unique', unique)
+
+        datamodel = DataModel(None, os.path.join(self.root, 'markers.json'))
+        for label, c0, c1, frame in [('a', 1, 1, 0), ('b', 1, 1, 0), ('a', 1, 1, 0), ('a', 2, 1, 0),
+                                     ('a', 1, 1, 1), ('a', 1, 1, 0), ('b', 1, 1, 0)]:
+            datamodel.add_annotation(Marker(label, c0, c1, frame=frame))
+        table = datamodel._annotations.tables['Marker']
+        data = table.data[~table.data['removed']]
+        checks = dict((code, failed) for failed, code, message in
+                      validate.check_table(Marker, data, 60, 100, 2))
+        self.assertEqual(np.flatnonzero(checks['duplicate']).tolist(), [2, 5, 6])
+        self.assertFalse(checks['bounds'].any() or checks['frame'].any())
+
+    def test_incremental(self):
+        """Unchanged files are not checked again; changed files are"""
+        report, checked = validate.validate(self.root, processes=1)
+        self.assertEqual((report['summary']['files'], report['summary']['issues'], checked), (1, 7, 1))
+        self.assertEqual(report['summary']['codes']['bounds'], 2)
+        saved = json.load(open(os.path.join(self.root, validate.REPORT)))
+        self.assertEqual(saved['files'], report['files'])
+
+        report, checked = validate.validate(self.root, processes=1)
+        self.assertEqual(checked, 0)
+        os.utime(self.sidecar, (0, 0))
+        report, checked = validate.validate(self.root, processes=1)
+        self.assertEqual((checked, report['summary']['issues']), (0, 7), "Unchanged contents checked again")
+
+        records = json.load(open(self.sidecar))
+        with open(self.sidecar, 'w') as fh:
+            json.dump(records[:1] + records[2:-1], fh)
+        report, checked = validate.validate(self.root, processes=1)
+        self.assertEqual((checked, report['summary']['issues']), (1, 5))
+
+    def test_binary(self):
+        """Binary sidecars are checked alike, at the insertion order of their annotations"""
+        datamodel = DataModel(self.path, os.path.join(self.root, 'other.cgs'))
+        datamodel.add_annotation(Marker('point', 5, 5))
+        datamodel.add_annotation(Polygon('triangle', [(20, 10), (60, 10), (20, 70)]))
+        datamodel.add_annotation(Marker('point', 5, 5))
+        datamodel.save()
+        entry = validate.check_file(self.path, os.path.join(self.root, 'other.cgs'))
+        self.assertEqual(self.codes(entry), [(1, 'bounds'), (2, 'duplicate')])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
@@ -0,0 +1,58 @@
+"""
+Test cases for the project label vocabulary
+"""
+
+import tempfile
+import shutil
+import os
+
+import unittest
+
+from clinicalgraphics.vocabulary import Vocabulary
+from clinicalgraphics.datamodels import DataModel, Marker
+from test_datamodels import example_JSON
+
+
+class TestVocabulary(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def test_complete(self):
+        """Completion is case insensitive, and quick keys select the first labels unless bound"""
+        vocabulary = Vocabulary(['nodule', 'Node', 'mass', 'normal', 'calcification'])
+        self.assertEqual(vocabulary.complete('no'), ['Node', 'nodule', 'normal'])
+        self.assertEqual(vocabulary.complete('NOD'), ['Node', 'nodule'])
+        self.assertEqual(vocabulary.complete('x'), [])
+        self.assertEqual(vocabulary.complete('', limit=2), ['calcification', 'mass'])
+        self.assertEqual(vocabulary.label_for('3'), 'mass')
+        vocabulary.bind('3', 'cyst')
+        self.assertEqual(vocabulary.label_for('3'), 'cyst')
+        self.assertEqual(vocabulary.ids['cyst'], 5)
+        self.assertIsNone(vocabulary.label_for('9'))
+        self.assertIsNone(vocabulary.label_for('q'))
+
+    def test_shared(self):
+        """Datamodels sharing a vocabulary give labels the same ids, and add new labels to it"""
+        vocabulary = Vocabulary.load(self.root)
+        vocabulary.intern('first')
+        paths = [os.path.join(self.root, name) for name in ['a.json', 'b.json']]
+        with open(paths[0], 'w') as fh:
+            fh.write(example_JSON)
+        a = DataModel(None, paths[0], vocabulary=vocabulary)
+        b = DataModel(None, paths[1], vocabulary=vocabulary)
+        b.add_annotation(Marker('amarker', 1, 2))
+        self.assertEqual(len(b.query(label='amarker')), 1)
+        table = lambda d: d._annotations.table(Marker).data['label'].tolist()
+        self.assertEqual(table(a), table(b))
+        self.assertEqual(vocabulary.strings, ['first', 'arect', 'amarker'])
+
+        vocabulary.bind('a', 'arect')
+        vocabulary.save()
+        loaded = Vocabulary.load(self.root)
+        self.assertEqual(loaded.strings, vocabulary.strings)
+        self.assertEqual(loaded.label_for('a'), 'arect')
+        self.assertEqual(loaded.complete('a'), ['amarker', 'arect'])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
@@ -0,0 +1,105 @@
+"""
+Test cases for the worklist: prefetching and eviction of its cache
+"""
+
+import tempfile
+import threading
+import shutil
+import os
+
+import unittest
+
+import numpy as np
+
+from clinicalgraphics import worklist
+from clinicalgraphics.worklist import Worklist
+from synthetic import write_dicom
+
+
+class TestWorklist(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for i in range(5):
+            write_dicom(os.path.join(self.root, 'image{0}.dcm'.format(i)), np.full((16, 24), i))
+        self.loads = []
+        load = worklist.load
+
+        def counted(path, size, **kwargs):
+            self.loads.append(os.path.basename(path))
+            return load(path, size, **kwargs)
+        worklist.load = counted
+        self.addCleanup(setattr, worklist, 'load', load)
+
+    def step(self, work, delta):
+        """Step and wait for prefetching to finish; returns the cached files, least recently used first"""
+        datamodel = work.step(delta)
+        for result in work._cache.values():
+            result.wait()
+        return datamodel, [os.path.basename(p) for p in work._cache]
+
+    def test_navigation(self):
+        """Neighbours are prefetched once, the least recently used file is evicted and closed"""
+        work = Worklist(self.root, prefetch=1, cache_size=3, workers=1, journaled=True)
+        self.assertEqual(len(work), 5)
+        first, cached = self.step(work, 0)
+        self.assertEqual(cached, ['image1.dcm', 'image0.dcm'])
+        self.assertEqual(self.loads, ['image0.dcm', 'image1.dcm'])
+        self.assertTrue(work.owns(first))
+
+        datamodel, cached = self.step(work, 1)
+        self.assertEqual(cached, ['image2.dcm', 'image0.dcm', 'image1.dcm'])
+        self.assertEqual(self.loads, ['image0.dcm', 'image1.dcm', 'image2.dcm'], "Cached file loaded again")
+
+        datamodel, cached = self.step(work, 1)
+        self.assertEqual(os.path.basename(datamodel.datapath), 'image2.dcm')
+        self.assertEqual(cached, ['image3.dcm', 'image1.dcm', 'image2.dcm'])
+        self.assertFalse(work.owns(first))
+        self.assertIsNone(first._compactor, "Evicted datamodel not closed")
+
+        datamodel, cached = self.step(work, -1)
+        self.assertEqual(cached, ['image2.dcm', 'image0.dcm', 'image1.dcm'])
+        self.assertEqual(self.loads[3:], ['image3.dcm', 'image0.dcm'], "Evicted file not loaded again")
+
+        del self.loads[:]
+        datamodel, cached = self.step(work, -1)
+        self.assertEqual(os.path.basename(datamodel.datapath), 'image0.dcm')
+        self.assertEqual(cached, ['image2.dcm', 'image1.dcm', 'image0.dcm'])
+        datamodel, cached = self.step(work, -1)
+        self.assertEqual(os.path.basename(datamodel.datapath), 'image0.dcm', "Stepped before the first file")
+        self.assertEqual(self.loads, [], "Prefetch scheduled for cached files")
+
+        work.close()
+        self.assertIsNone(datamodel._compactor)
+        self.assertEqual(len(work._cache), 0)
+
+    def test_evict_pending(self):
+        """A file evicted while it is still being prefetched is closed once loaded"""
+        gate = threading.Event()
+        counted = worklist.load
+
+        def gated(path, size, **kwargs):
+            if path.endswith('image1.dcm'):
+                gate.wait()
+            return counted(path, size, **kwargs)
+        worklist.load = gated
+
+        work = Worklist(self.root, prefetch=1, cache_size=3, workers=2, journaled=True)
+        work.step(0)
+        pending = work._cache[os.path.join(self.root, 'image1.dcm')]
+        work.step(3)
+        self.assertNotIn(os.path.join(self.root, 'image1.dcm'), work._cache)
+        self.assertFalse(pending.ready(), "Entry not evicted while loading")
+
+        gate.set()
+        datamodel = pending.get(5)
+        self.assertIsNone(datamodel._compactor, "Evicted datamodel not closed once loaded")
+        self.assertFalse(work.owns(datamodel))
+        work.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+
+if __name__ == '__main__':
+    unittest.main()